@@ -0,0 +1,598 @@
+"""
+sage_index.py
+
+On-disk indexes of the Sage library, shared by all sessions of the sage
+server, so that looking up documentation does not have to inspect and
+re-read the library every time.
+"""
+
+#########################################################################################
+#       Copyright (C) 2016, Sagemath Inc.
+#                                                                                       #
+#  Distributed under the terms of the GNU General Public License (GPL), version 2+      #
+#                                                                                       #
+#                  http://www.gnu.org/licenses/                                         #
+#########################################################################################
+
+from __future__ import absolute_import
+import heapq
+import mmap
+import os
+import shutil
+import sqlite3
+import struct
+import threading
+import time
+from array import array
+
+import six
+
+# The index databases are kept in this directory, one per Sage version.
+INDEX_DIR = os.environ.get('COCALC_SAGE_INDEX_DIR') or os.path.join(
+    os.environ.get('SMC', os.path.join(os.path.expanduser('~'), '.smc')),
+    'sage_server')
+
+
+def sage_version():
+    try:
+        from sage.version import version
+        return version
+    except ImportError:
+        return 'unknown'
+
+
+def qualified_name(O):
+    """
+    Return a name that identifies the library function, class or method O
+    (e.g., 'sage.rings.integer.Integer.is_prime'), or None if O is not
+    one, e.g., if O is an instance or was defined in the worksheet.
+    """
+    O = getattr(O, '__func__', O)
+    qualname = getattr(O, '__qualname__', None)
+    if not isinstance(qualname, six.string_types):
+        return None
+    module = getattr(O, '__module__', None)
+    cls = O if isinstance(O, type) else None
+    if module is None:
+        # methods of extension types, e.g., ZZ.is_prime
+        owner = getattr(O, '__self__', None)
+        if owner is None or isinstance(owner, type(os)):
+            return None
+        cls = type(owner)
+        module = cls.__module__
+    if not isinstance(module, six.string_types) or module == '__main__':
+        return None
+    if module == six.moves.builtins.__name__ and cls is not None:
+        # classes defined in the worksheet (or by load) have no module, so
+        # they claim to be builtins and would share their entries
+        if getattr(six.moves.builtins, cls.__qualname__, None) is not cls:
+            return None
+    return module + '.' + qualname
+
+
+class DocIndex(object):
+    """
+    Maps qualified names of library objects to what obj? and obj?? show:
+    the source file, the argument list, the docstring, and the span of the
+    source code in the file (first line and number of lines).
+
+    Entries are added whenever an object is looked up for the first time,
+    and for all objects of a namespace by build().  Every entry records the
+    modification time of its file and is ignored once the file changes.
+
+    The database is opened separately in each process and thread, since
+    SQLite connections must not be used across fork() or shared between
+    threads.  All errors are ignored -- the index is only a cache.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self._dbs = {}  # (pid, thread id) --> connection
+
+    def _connect(self):
+        key = (os.getpid(), threading.current_thread().ident)
+        db = self._dbs.get(key)
+        if db is not None:
+            return db
+        path = self.path
+        if path is None:
+            if not os.path.exists(INDEX_DIR):
+                os.makedirs(INDEX_DIR)
+            path = os.path.join(INDEX_DIR,
+                                'doc-index-%s.sqlite' % sage_version())
+        db = sqlite3.connect(path, timeout=1, isolation_level=None)
+        try:
+            # readers do not block the writer and vice versa
+            db.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.Error:
+            pass
+        db.execute('CREATE TABLE IF NOT EXISTS docs (name TEXT PRIMARY KEY, '
+                   'file TEXT, mtime REAL, args TEXT, doc TEXT, '
+                   'start INTEGER, count INTEGER)')
+        db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, '
+                   'value TEXT)')
+        self._dbs[key] = db
+        return db
+
+    def get(self, name):
+        """
+        Return the entry for the qualified name as a dict, or None.
+        """
+        try:
+            row = self._connect().execute(
+                'SELECT file, mtime, args, doc, start, count FROM docs '
+                'WHERE name=?', (name, )).fetchone()
+        except (sqlite3.Error, OSError):
+            return None
+        if row is None:
+            return None
+        entry = dict(
+            zip(('file', 'mtime', 'args', 'doc', 'start', 'count'), row))
+        try:
+            if os.stat(entry['file']).st_mtime != entry['mtime']:
+                return None
+        except OSError:
+            return None
+        return entry
+
+    def put(self, name, entry):
+        try:
+            self._connect().execute(
+                'INSERT OR REPLACE INTO docs VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (name, entry['file'], entry['mtime'], entry['args'],
+                 entry['doc'], entry['start'], entry['count']))
+        except (sqlite3.Error, OSError):
+            pass
+
+    def lookup(self, O):
+        """
+        Return the entry for the object O (computing and storing it if
+        necessary), or None if O can not be indexed.
+        """
+        name = qualified_name(O)
+        if name is None:
+            return None
+        entry = self.get(name)
+        if entry is None:
+            entry = doc_entry(O)
+            if entry is not None:
+                self.put(name, entry)
+        return entry
+
+    def source(self, entry):
+        """
+        Return the source code of the object of the entry, read directly
+        from its span in the file, or None if the span is not known.
+        """
+        if entry['start'] is None:
+            return None
+        try:
+            with open(entry['file']) as f:
+                lines = f.readlines()
+        except (IOError, OSError, UnicodeDecodeError):
+            return None
+        start = entry['start']
+        return ''.join(lines[start:start + entry['count']])
+
+    def is_built(self):
+        try:
+            row = self._connect().execute(
+                "SELECT value FROM meta WHERE key='built'").fetchone()
+        except (sqlite3.Error, OSError):
+            return False
+        return row is not None
+
+    def build(self, namespace):
+        """
+        Add the entries for all objects in namespace (e.g., the namespace
+        after 'from sage.all import *') and their methods.  This takes
+        minutes for all of Sage, so sage_server runs it in a separate,
+        niced process.
+        """
+        seen = set()
+
+        def add(O):
+            name = qualified_name(O)
+            if name is None or name in seen:
+                return
+            seen.add(name)
+            if self.get(name) is None:
+                entry = doc_entry(O)
+                if entry is not None:
+                    self.put(name, entry)
+
+        for O in list(namespace.values()):
+            try:
+                add(O)
+                if isinstance(O, type):
+                    for attr in list(vars(O).values()):
+                        add(attr)
+            except Exception:
+                pass
+        try:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO meta VALUES ('built', ?)",
+                (sage_version(), ))
+        except (sqlite3.Error, OSError):
+            pass
+
+
+def doc_entry(O):
+    """
+    Inspect O with sage.misc.sageinspect and return its DocIndex entry, or
+    None if its source file or docstring can not be determined.
+    """
+    import sage.misc.sageinspect as sageinspect
+    try:
+        filename = sageinspect.sage_getfile(O)
+        mtime = os.stat(filename).st_mtime
+        doc = sageinspect.sage_getdoc(O)
+        if isinstance(doc, bytes):
+            doc = doc.decode('utf-8')
+    except Exception:
+        return None
+    try:
+        x = sageinspect.sage_getargspec(O)
+        defaults = list(x.defaults) if x.defaults else []
+        args = list(x.args) if x.args else []
+        v = []
+        if x.keywords:
+            v.insert(0, '**kwds')
+        if x.varargs:
+            v.insert(0, '*args')
+        while defaults:
+            d = defaults.pop()
+            k = args.pop()
+            v.insert(0, '%s=%r' % (k, d))
+        args = ', '.join(args + v)
+    except Exception:
+        args = None
+    start = count = None
+    try:
+        lines, lineno = sageinspect.sage_getsourcelines(O)
+        with open(filename) as f:
+            file_lines = f.readlines()
+        # only keep the span if it really is where the source comes from
+        for i in (lineno - 1, lineno):
+            if i >= 0 and file_lines[i:i + len(lines)] == list(lines):
+                start, count = i, len(lines)
+                break
+    except Exception:
+        pass
+    return {
+        'file': filename,
+        'mtime': mtime,
+        'args': args,
+        'doc': doc,
+        'start': start,
+        'count': count
+    }
+
+
+doc_index = DocIndex()
+
+# Files larger than this many bytes are only indexed up to this size.
+MAX_INDEXED_FILE_SIZE = 4 * 1024 * 1024
+
+# While building a TrigramIndex, at most about this many postings are kept
+# in memory; the others are written to temporary files and merged.
+BUILD_BATCH_POSTINGS = 4 * 1024 * 1024
+
+# At most this many files are read to count the matches of a search.
+MAX_SEARCH_CANDIDATES = 2000
+
+
+def _trigrams(data):
+    return set([data[i:i + 3] for i in range(len(data) - 2)])
+
+
+def _trigram_key(t):
+    return struct.unpack('>I', b'\0' + t)[0]
+
+
+def _little_endian(v):
+    if struct.pack('=I', 1) != struct.pack('<I', 1):
+        v.byteswap()
+    return v
+
+
+class TrigramIndex(object):
+    """
+    Index of the trigrams (three byte substrings, ignoring ASCII case) of
+    the files below a directory, for fast case-insensitive substring
+    search.  The index is written once by build() and then memory-mapped
+    read-only by every session that searches it.
+
+    File format, all integers are little endian unsigned 32 bit:
+
+    - MAGIC, number of files, number of trigrams
+    - for each trigram, in increasing order: trigram, offset and number
+      of its postings
+    - the postings: for each trigram the numbers of the files containing it
+    - the root directory and the file names relative to it, utf-8, one
+      per line
+    """
+    MAGIC = b'SMCTRI01'
+    HEADER = struct.Struct('<8sII')
+    RECORD = struct.Struct('<III')
+
+    def __init__(self, path):
+        self.path = path
+        self._mm = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    @classmethod
+    def build(cls, path, root, extensions):
+        """
+        Index all files below root whose names end with one of the given
+        extensions and write the index to path.
+
+        The postings of consecutive files are collected in memory until
+        there are BUILD_BATCH_POSTINGS of them, and then written to a
+        temporary file (a run), sorted by trigram; the runs are merged in
+        the end.
+        """
+        tmp = '%s.%s.tmp' % (path, os.getpid())
+        files = []
+        runs = []  # names of the temporary files
+        postings = {}  # trigram key --> array of file numbers
+        size = 0
+        try:
+            for dirpath, dirnames, filenames in os.walk(root):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    if not name.endswith(tuple(extensions)):
+                        continue
+                    filename = os.path.join(dirpath, name)
+                    try:
+                        with open(filename, 'rb') as f:
+                            data = f.read(MAX_INDEXED_FILE_SIZE).lower()
+                    except (IOError, OSError):
+                        continue
+                    n = len(files)
+                    files.append(os.path.relpath(filename, root))
+                    for t in _trigrams(data):
+                        key = _trigram_key(t)
+                        v = postings.get(key)
+                        if v is None:
+                            v = postings[key] = array('I')
+                        v.append(n)
+                        size += 1
+                    if size >= BUILD_BATCH_POSTINGS:
+                        runs.append(cls._write_run(tmp, len(runs), postings))
+                        postings = {}
+                        size = 0
+            runs.append(cls._write_run(tmp, len(runs), postings))
+            postings = None  # free the last batch before merging
+            cls._merge(tmp, runs, root, files)
+            os.rename(tmp, path)
+        finally:
+            for name in runs + [tmp, tmp + '.postings']:
+                if os.path.exists(name):
+                    os.unlink(name)
+
+    @staticmethod
+    def _write_run(tmp, i, postings):
+        """
+        Write postings to the i-th run: for each trigram in increasing
+        order, its key, the number of its postings and the postings.
+        """
+        name = '%s.%s' % (tmp, i)
+        with open(name, 'wb') as out:
+            for key in sorted(postings):
+                v = postings[key]
+                out.write(struct.pack('<II', key, len(v)))
+                out.write(_little_endian(v).tobytes())
+        return name
+
+    @staticmethod
+    def _read_run(f, i):
+        while True:
+            head = f.read(8)
+            if not head:
+                return
+            key, count = struct.unpack('<II', head)
+            yield key, i, f.read(4 * count)
+
+    @classmethod
+    def _merge(cls, tmp, runs, root, files):
+        """
+        Merge the runs into the index file tmp.  The runs hold the postings
+        of consecutive files, so the postings of a trigram are in order if
+        they are taken from the runs in order.
+        """
+        inputs = [open(name, 'rb') for name in runs]
+        try:
+            with open(tmp, 'wb') as out, open(tmp + '.postings',
+                                              'w+b') as postings:
+                out.write(cls.HEADER.pack(cls.MAGIC, len(files), 0))
+                num_trigrams = offset = 0
+                last, count = None, 0
+                for key, i, data in heapq.merge(
+                        *[cls._read_run(f, i) for i, f in enumerate(inputs)]):
+                    if key != last and last is not None:
+                        out.write(cls.RECORD.pack(last, offset, count))
+                        num_trigrams += 1
+                        offset += count
+                        count = 0
+                    last = key
+                    count += len(data) // 4
+                    postings.write(data)
+                if last is not None:
+                    out.write(cls.RECORD.pack(last, offset, count))
+                    num_trigrams += 1
+                postings.seek(0)
+                shutil.copyfileobj(postings, out)
+                out.write('\n'.join([root] + files).encode('utf-8'))
+                out.seek(0)
+                out.write(
+                    cls.HEADER.pack(cls.MAGIC, len(files), num_trigrams))
+        finally:
+            for f in inputs:
+                f.close()
+
+    def _open(self):
+        if self._mm is None:
+            with open(self.path, 'rb') as f:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, self._num_files, self._num_trigrams = self.HEADER.unpack_from(
+                self._mm, 0)
+            if magic != self.MAGIC:
+                self._mm = None
+                raise ValueError("%s is not a trigram index" % self.path)
+            self._records = self.HEADER.size
+            self._postings = self._records + self._num_trigrams * self.RECORD.size
+            n = self._postings + 4 * self._count_postings()
+            names = self._mm[n:].decode('utf-8').split('\n')
+            self.root, self.files = names[0], names[1:]
+        return self._mm
+
+    def _count_postings(self):
+        if self._num_trigrams == 0:
+            return 0
+        _, offset, count = self.RECORD.unpack_from(
+            self._mm,
+            self._records + (self._num_trigrams - 1) * self.RECORD.size)
+        return offset + count
+
+    def _lookup(self, t):
+        """
+        Return the numbers of the files containing the trigram t.
+        """
+        key = _trigram_key(t)
+        lo, hi = 0, self._num_trigrams
+        while lo < hi:
+            mid = (lo + hi) // 2
+            k, offset, count = self.RECORD.unpack_from(
+                self._mm, self._records + mid * self.RECORD.size)
+            if k == key:
+                start = self._postings + 4 * offset
+                v = array('I')
+                v.frombytes(self._mm[start:start + 4 * count])
+                return _little_endian(v)
+            elif k < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return array('I')
+
+    def candidates(self, query):
+        """
+        Return the numbers of the files that contain all trigrams of the
+        (lower case, utf-8 encoded) query, i.e., that may contain it.
+        """
+        self._open()
+        if len(query) < 3:
+            return range(len(self.files))
+        found = None
+        for v in sorted([self._lookup(t) for t in _trigrams(query)], key=len):
+            found = set(v) if found is None else found.intersection(v)
+            if not found:
+                break
+        return sorted(found)
+
+    def search(self, query, max_results=None,
+               max_candidates=MAX_SEARCH_CANDIDATES):
+        """
+        Return a list of (score, file name) for the files that contain the
+        string query, ignoring case, best matches first.  The score is the
+        number of occurrences, plus 100 if the file name contains query.
+
+        Only max_candidates of the files that may contain query are read,
+        those whose names contain it first.
+        """
+        q = query.encode('utf-8') if not isinstance(query, bytes) else query
+        q = q.lower()
+        name_query = q.decode('utf-8', 'replace')
+        candidates = self.candidates(q)
+        if len(candidates) > max_candidates:
+            candidates = sorted(
+                candidates,
+                key=lambda n: name_query not in self.files[n].lower())
+            candidates = candidates[:max_candidates]
+        results = []
+        for n in candidates:
+            name = self.files[n]
+            try:
+                with open(os.path.join(self.root, name), 'rb') as f:
+                    count = f.read(MAX_INDEXED_FILE_SIZE).lower().count(q)
+            except (IOError, OSError):
+                continue
+            if count:
+                score = count + (100 if name_query in name.lower() else 0)
+                results.append((score, name))
+        results.sort(key=lambda x: (-x[0], x[1]))
+        return results[:max_results] if max_results else results
+
+
+# Source files and documentation searched by search_src and search_doc.
+SEARCH_EXTENSIONS = {
+    'src': ('.py', '.pyx', '.pxd', '.pxi', '.h', '.c'),
+    'doc': ('.html', )
+}
+
+
+def search_index(kind, root):
+    """
+    Return the TrigramIndex of the given kind ('src' or 'doc') for the
+    directory root, or None if it has not been built yet.
+    """
+    path = os.path.join(INDEX_DIR,
+                        '%s-trigrams-%s.idx' % (kind, sage_version()))
+    index = TrigramIndex(path)
+    if not index.exists():
+        return None
+    try:
+        index._open()
+    except (ValueError, OSError, IOError):
+        return None
+    return index if index.root == root else None
+
+
+def build_search_index(kind, root):
+    """
+    Build the TrigramIndex of the given kind for root, unless another
+    process is building it already.
+    """
+    if not os.path.exists(INDEX_DIR):
+        os.makedirs(INDEX_DIR)
+    path = os.path.join(INDEX_DIR,
+                        '%s-trigrams-%s.idx' % (kind, sage_version()))
+    lock = path + '.lock'
+    try:
+        if time.time() - os.stat(lock).st_mtime > 3600:
+            os.unlink(lock)  # left behind by a builder that died
+    except OSError:
+        pass
+    try:
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError:
+        return
+    try:
+        TrigramIndex.build(path, root, SEARCH_EXTENSIONS[kind])
+    finally:
+        os.close(fd)
+        os.unlink(lock)
+
+
+def build_search_index_in_background(kind, root):
+    """
+    Build the search index in a niced, detached process, which does not
+    keep the sockets and files of the session open.
+    """
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    try:
+        # fork again, so the builder is not left behind as a zombie
+        if os.fork() == 0:
+            os.setsid()
+            os.closerange(3, os.sysconf('SC_OPEN_MAX'))
+            os.nice(10)
+            build_search_index(kind, root)
+    except Exception:
+        pass
+    finally:
+        os._exit(0)
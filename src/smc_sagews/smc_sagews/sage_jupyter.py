@@ -72,6 +72,8 @@ class JUPYTER(object):
 
         Each call to jupyter creates its own Jupyter kernel. So you can have more than
         one instance of the same kernel type in the same worksheet session.
+        Kernels are taken from a pool of kernels that the Sage server started
+        in advance, where possible, so that they are ready right away.
 
             | p1 = jupyter('python3')
             | p2 = jupyter('python3')
@@ -94,6 +96,126 @@ class JUPYTER(object):
 jupyter = JUPYTER()
 
 
+class JupyterCompleter(object):
+    """
+    Tab completion with the Jupyter kernel of the client kc.
+
+    complete() sends a complete_request and waits for the reply on the
+    shell channel for at most timeout seconds, and gives up earlier if the
+    request is superseded by a newer one.  Replies are cached by line, so
+    that typing more characters of the same name is answered from the cached
+    matches of a shorter line without asking the kernel again.  Replies to
+    requests that were given up still end up in the cache.  The cache is
+    cleared whenever the kernel executes code.
+
+    INPUT:
+
+    - ``kc`` -- a jupyter_client BlockingKernelClient
+    - ``cache_size`` -- number of lines whose matches are kept
+    - ``ttl`` -- cached matches older than this many seconds are not used
+    """
+    def __init__(self, kc, cache_size=64, ttl=60):
+        from collections import OrderedDict
+        self.kc = kc
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self._cache = OrderedDict()  # line --> (time, cursor_start, matches)
+        self._pending = OrderedDict()  # msg_id of a request --> its line
+
+    def invalidate(self):
+        self._cache.clear()
+
+    def _cached(self, line):
+        """
+        Return (completions, target) for line from the cached matches of
+        line, or of a prefix of it that only lacks the end of the name
+        being completed; None if there are none.
+        """
+        import re, time
+        best = None
+        for key in self._cache:
+            if line.startswith(key) and (best is None or len(key) > len(best)):
+                if re.match(r'\w*$', line[len(key):], re.U):
+                    best = key
+        if best is None:
+            return None
+        t, start, matches = self._cache[best]
+        if time.time() - t > self.ttl or start > len(best):
+            del self._cache[best]
+            return None
+        # jupyter kernels return matches like "xyz.append" and smc wants just "append"
+        target = line[start:]
+        offset = len(target)
+        return [m[offset:] for m in matches if m.startswith(target)], target
+
+    def _handle(self, msg):
+        """
+        Cache the matches of a reply to one of our complete requests.
+        """
+        import time
+        line = self._pending.pop(msg['parent_header'].get('msg_id'), None)
+        content = msg['content']
+        if (line is None or msg['msg_type'] != 'complete_reply'
+                or content.get('status') != 'ok'):
+            return
+        self._cache.pop(line, None)
+        self._cache[line] = (time.time(), content['cursor_start'],
+                             content['matches'])
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def complete(self, line, timeout=2, superseded=None):
+        """
+        Return (completions, target) for line, or None if the kernel did not
+        answer within timeout seconds, or superseded() became true.
+        """
+        import time
+        result = self._cached(line)
+        if result is not None:
+            return result
+        shell = self.kc.shell_channel
+        msg_id = self.kc.complete(line)
+        self._pending[msg_id] = line
+        while len(self._pending) > self.cache_size:
+            self._pending.popitem(last=False)
+        deadline = time.time() + timeout
+        while msg_id in self._pending:
+            wait = deadline - time.time()
+            if wait <= 0 or (superseded is not None and superseded()):
+                return None
+            # look at superseded every 50ms
+            if shell.socket.poll(1000 * min(wait, 0.05)):
+                while shell.msg_ready():
+                    self._handle(shell.get_msg(timeout=0))
+        return self._cached(line)
+
+
+def _leased_kernel_client(kernel_name):
+    """
+    Return a client connected to a kernel leased from the pool of the sage
+    server (see sage_server.JupyterKernelPool), or None if there is none.
+    """
+    import sys
+    # the module of the running server (not necessarily smc_sagews.sage_server)
+    sage_server = sys.modules[type(salvus).__module__]
+    info = sage_server.lease_jupyter_kernel(kernel_name)
+    if info is None:
+        return None
+    import jupyter_client
+    kc = jupyter_client.BlockingKernelClient()
+    kc.load_connection_info(info)
+    kc.start_channels()
+    try:
+        # a spare kernel might not have finished starting yet
+        kc.wait_for_ready(timeout=60)
+    except RuntimeError as err:
+        sage_server.log("leased %s kernel is not usable -- %s" %
+                        (kernel_name, err))
+        kc.stop_channels()
+        return None
+    return kc
+
+
 def _jkmagic(kernel_name, **kwargs):
     r"""
     Called when user issues `my_kernel = jupyter("kernel_name")` from a cell.
@@ -111,19 +233,26 @@ def _jkmagic(kernel_name, **kwargs):
     # of CPU time to import.
     import jupyter_client  # TIMING: takes a bit of time
     from ansi2html import Ansi2HTMLConverter  # TIMING: this is surprisingly bad.
-    from six.moves.queue import Empty  # TIMING: cheap
+    import zmq  # TIMING: cheap, since jupyter_client imports it
     import base64, tempfile, sys, re  # TIMING: cheap
 
     import warnings
+    import atexit
     import sage.misc.latex
     with warnings.catch_warnings():
         warnings.simplefilter("ignore", DeprecationWarning)
-        km, kc = jupyter_client.manager.start_new_kernel(
-            kernel_name=kernel_name)
-        import atexit
-        atexit.register(km.shutdown_kernel)
+        kc = _leased_kernel_client(kernel_name)
+        if kc is not None:
+            # the sage server kills the kernel when this session ends
+            km = None
+        else:
+            km, kc = jupyter_client.manager.start_new_kernel(
+                kernel_name=kernel_name)
+            atexit.register(km.shutdown_kernel)
         atexit.register(kc.hb_channel.close)
 
+    completer = JupyterCompleter(kc)
+
     # inline: no header or style tags, useful for full == False
     # linkify: little gimmik, translates URLs to anchor tags
     conv = Ansi2HTMLConverter(inline=True, linkify=True)
@@ -177,6 +306,9 @@ def _jkmagic(kernel_name, **kwargs):
         if kwargs.get('get_kernel_name', False):
             return kernel_name
 
+        if kwargs.get('get_kernel_completer', False):
+            return completer
+
         if code is None:
             return
 
@@ -192,180 +324,120 @@ def _jkmagic(kernel_name, **kwargs):
         # until shell execute_reply message is received with status 'ok' or 'error'
         capture_mode = not hasattr(sys.stdout._f, 'im_func')
 
-        # handle iopub messages
-        while True:
-            try:
-                msg = iopub.get_msg()
-                msg_type = msg['msg_type']
-                content = msg['content']
-
-            except Empty:
-                # shouldn't happen
-                p("iopub channel empty")
-                break
-
+        def display_mime(msg_data):
+            '''
+            jupyter server does send data dictionaries, that do contain mime-type:data mappings
+            depending on the type, handle them in the salvus API
+            '''
+            # sometimes output is sent in several formats
+            # 1. if there is an image format, prefer that
+            # 2. elif default text or image mode is available, prefer that
+            # 3. else choose first matching format in modes list
+            from smc_sagews.sage_salvus import show
+
+            def show_plot(data, suffix):
+                r"""
+                If an html style is defined for this kernel, use it.
+                Otherwise use salvus.file().
+                """
+                suffix = '.' + suffix
+                fname = tempfile.mkstemp(suffix=suffix)[1]
+                fmode = 'wb' if six.PY3 else 'w'
+                with open(fname, fmode) as fo:
+                    fo.write(data)
+
+                if run_code.smc_image_scaling is None:
+                    salvus.file(fname)
+                else:
+                    img_src = salvus.file(fname, show=False)
+                    # The max-width is because this smc-image-scaling is very difficult
+                    # to deal with when using React to render this on the share server,
+                    # and not scaling down is really ugly.  When the width gets set
+                    # as normal in a notebook, this won't impact anything, but when
+                    # it is displayed on share server (where width is not set) at least
+                    # it won't look like total crap.  See https://github.com/sagemathinc/cocalc/issues/4421
+                    htms = '<img src="{0}" smc-image-scaling="{1}" style="max-width:840px"/>'.format(
+                        img_src, run_code.smc_image_scaling)
+                    salvus.html(htms)
+                os.unlink(fname)
+
+            mkeys = list(msg_data.keys())
+            imgmodes = ['image/svg+xml', 'image/png', 'image/jpeg']
+            txtmodes = [
+                'text/html', 'text/plain', 'text/latex', 'text/markdown'
+            ]
+            if any('image' in k for k in mkeys):
+                dfim = run_code.default_image_fmt
+                #print('default_image_fmt %s'%dfim)
+                dispmode = next((m for m in mkeys if dfim in m), None)
+                if dispmode is None:
+                    dispmode = next(m for m in imgmodes if m in mkeys)
+                #print('dispmode is %s'%dispmode)
+                # https://en.wikipedia.org/wiki/Data_scheme#Examples
+                # <img src="data:image/png;base64,iVBORw0KGgoAAAANSUhEU
+                # <img src='data:image/svg+xml;utf8,<svg ... > ... </svg>'>
+                if dispmode == 'image/svg+xml':
+                    data = msg_data[dispmode]
+                    show_plot(data, 'svg')
+                elif dispmode == 'image/png':
+                    data = base64.standard_b64decode(msg_data[dispmode])
+                    show_plot(data, 'png')
+                elif dispmode == 'image/jpeg':
+                    data = base64.standard_b64decode(msg_data[dispmode])
+                    show_plot(data, 'jpg')
+                return
+            elif any('text' in k for k in mkeys):
+                dftm = run_code.default_text_fmt
+                if capture_mode:
+                    dftm = 'plain'
+                dispmode = next((m for m in mkeys if dftm in m), None)
+                if dispmode is None:
+                    dispmode = next(m for m in txtmodes if m in mkeys)
+                if dispmode == 'text/plain':
+                    p('text/plain', msg_data[dispmode])
+                    # override if plain text is object marker for latex output
+                    if re.match(r'<IPython.core.display.\w+ object>',
+                                msg_data[dispmode]):
+                        p("overriding plain -> latex")
+                        show(msg_data['text/latex'])
+                    else:
+                        txt = re.sub(r"^\[\d+\] ", "", msg_data[dispmode])
+                        hout(txt)
+                elif dispmode == 'text/html':
+                    salvus.html(msg_data[dispmode])
+                elif dispmode == 'text/latex':
+                    p('text/latex', msg_data[dispmode])
+                    sage.misc.latex.latex.eval(msg_data[dispmode])
+                elif dispmode == 'text/markdown':
+                    salvus.md(msg_data[dispmode])
+                return
+
+        def iopub_message(msg):
+            """
+            Handle a message of the iopub channel; returns True once the
+            kernel is idle, i.e., it executed all of the code.
+            """
+            msg_type = msg['msg_type']
+            content = msg['content']
             p('iopub', msg_type, str(content)[:300])
 
             if msg['parent_header'].get('msg_id') != msg_id:
                 p('*** non-matching parent header')
-                continue
+                return False
 
-            if msg_type == 'status' and content['execution_state'] == 'idle':
-                break
-
-            def display_mime(msg_data):
-                '''
-                jupyter server does send data dictionaries, that do contain mime-type:data mappings
-                depending on the type, handle them in the salvus API
-                '''
-                # sometimes output is sent in several formats
-                # 1. if there is an image format, prefer that
-                # 2. elif default text or image mode is available, prefer that
-                # 3. else choose first matching format in modes list
-                from smc_sagews.sage_salvus import show
-
-                def show_plot(data, suffix):
-                    r"""
-                    If an html style is defined for this kernel, use it.
-                    Otherwise use salvus.file().
-                    """
-                    suffix = '.' + suffix
-                    fname = tempfile.mkstemp(suffix=suffix)[1]
-                    fmode = 'wb' if six.PY3 else 'w'
-                    with open(fname, fmode) as fo:
-                        fo.write(data)
-
-                    if run_code.smc_image_scaling is None:
-                        salvus.file(fname)
-                    else:
-                        img_src = salvus.file(fname, show=False)
-                        # The max-width is because this smc-image-scaling is very difficult
-                        # to deal with when using React to render this on the share server,
-                        # and not scaling down is really ugly.  When the width gets set
-                        # as normal in a notebook, this won't impact anything, but when
-                        # it is displayed on share server (where width is not set) at least
-                        # it won't look like total crap.  See https://github.com/sagemathinc/cocalc/issues/4421
-                        htms = '<img src="{0}" smc-image-scaling="{1}" style="max-width:840px"/>'.format(
-                            img_src, run_code.smc_image_scaling)
-                        salvus.html(htms)
-                    os.unlink(fname)
-
-                mkeys = list(msg_data.keys())
-                imgmodes = ['image/svg+xml', 'image/png', 'image/jpeg']
-                txtmodes = [
-                    'text/html', 'text/plain', 'text/latex', 'text/markdown'
-                ]
-                if any('image' in k for k in mkeys):
-                    dfim = run_code.default_image_fmt
-                    #print('default_image_fmt %s'%dfim)
-                    dispmode = next((m for m in mkeys if dfim in m), None)
-                    if dispmode is None:
-                        dispmode = next(m for m in imgmodes if m in mkeys)
-                    #print('dispmode is %s'%dispmode)
-                    # https://en.wikipedia.org/wiki/Data_scheme#Examples
-                    # <img src="data:image/png;base64,iVBORw0KGgoAAAANSUhEU
-                    # <img src='data:image/svg+xml;utf8,<svg ... > ... </svg>'>
-                    if dispmode == 'image/svg+xml':
-                        data = msg_data[dispmode]
-                        show_plot(data, 'svg')
-                    elif dispmode == 'image/png':
-                        data = base64.standard_b64decode(msg_data[dispmode])
-                        show_plot(data, 'png')
-                    elif dispmode == 'image/jpeg':
-                        data = base64.standard_b64decode(msg_data[dispmode])
-                        show_plot(data, 'jpg')
-                    return
-                elif any('text' in k for k in mkeys):
-                    dftm = run_code.default_text_fmt
-                    if capture_mode:
-                        dftm = 'plain'
-                    dispmode = next((m for m in mkeys if dftm in m), None)
-                    if dispmode is None:
-                        dispmode = next(m for m in txtmodes if m in mkeys)
-                    if dispmode == 'text/plain':
-                        p('text/plain', msg_data[dispmode])
-                        # override if plain text is object marker for latex output
-                        if re.match(r'<IPython.core.display.\w+ object>',
-                                    msg_data[dispmode]):
-                            p("overriding plain -> latex")
-                            show(msg_data['text/latex'])
-                        else:
-                            txt = re.sub(r"^\[\d+\] ", "", msg_data[dispmode])
-                            hout(txt)
-                    elif dispmode == 'text/html':
-                        salvus.html(msg_data[dispmode])
-                    elif dispmode == 'text/latex':
-                        p('text/latex', msg_data[dispmode])
-                        sage.misc.latex.latex.eval(msg_data[dispmode])
-                    elif dispmode == 'text/markdown':
-                        salvus.md(msg_data[dispmode])
-                    return
-
-            # reminder of iopub loop is switch on value of msg_type
-
-            if msg_type == 'execute_input':
-                # the following is a cheat to avoid forking a separate thread to listen on stdin channel
-                # most of the time, ignore "execute_input" message type
-                # but if code calls python3 input(), wait for message on stdin channel
-                if 'code' in content:
-                    ccode = content['code']
-                    if kernel_name.startswith(
-                        ('python', 'anaconda', 'octave')) and re.match(
-                            r'^[^#]*\W?input\(', ccode):
-                        # FIXME input() will be ignored if it's aliased to another name
-                        p('iopub input call: ', ccode)
-                        try:
-                            # do nothing if no messsage on stdin channel within 0.5 sec
-                            imsg = stdinj.get_msg(timeout=0.5)
-                            imsg_type = imsg['msg_type']
-                            icontent = imsg['content']
-                            p('stdin', imsg_type, str(icontent)[:300])
-                            # kernel is now blocked waiting for input
-                            if imsg_type == 'input_request':
-                                prompt = '' if icontent[
-                                    'password'] else icontent['prompt']
-                                value = salvus.raw_input(prompt=prompt)
-                                xcontent = dict(value=value)
-                                xmsg = kc.session.msg('input_reply', xcontent)
-                                p('sending input_reply', xcontent)
-                                stdinj.send(xmsg)
-                        except:
-                            pass
-                    elif kernel_name == 'octave' and re.search(
-                            r"\s*pause\s*([#;\n].*)?$", ccode, re.M):
-                        # FIXME "1+2\npause\n3+4" pauses before executing any code
-                        # would need block parser here
-                        p('iopub octave pause: ', ccode)
-                        try:
-                            # do nothing if no messsage on stdin channel within 0.5 sec
-                            imsg = stdinj.get_msg(timeout=0.5)
-                            imsg_type = imsg['msg_type']
-                            icontent = imsg['content']
-                            p('stdin', imsg_type, str(icontent)[:300])
-                            # kernel is now blocked waiting for input
-                            if imsg_type == 'input_request':
-                                prompt = "Paused, enter any value to continue"
-                                value = salvus.raw_input(prompt=prompt)
-                                xcontent = dict(value=value)
-                                xmsg = kc.session.msg('input_reply', xcontent)
-                                p('sending input_reply', xcontent)
-                                stdinj.send(xmsg)
-                        except:
-                            pass
-            elif msg_type == 'execute_result':
-                if not 'data' in content:
-                    continue
-                p('execute_result data keys: ', list(content['data'].keys()))
-                display_mime(content['data'])
+            if msg_type == 'execute_result':
+                if 'data' in content:
+                    p('execute_result data keys: ',
+                      list(content['data'].keys()))
+                    display_mime(content['data'])
 
             elif msg_type == 'display_data':
                 if 'data' in content:
                     display_mime(content['data'])
 
             elif msg_type == 'status':
-                if content['execution_state'] == 'idle':
-                    # when idle, kernel has executed all input
-                    break
+                # when idle, kernel has executed all input
+                return content['execution_state'] == 'idle'
 
             elif msg_type == 'clear_output':
                 salvus.clear()
@@ -388,33 +460,68 @@ def _jkmagic(kernel_name, **kwargs):
                             hout(tr + '\n', error=True)
                     else:
                         hout(tr, error=True)
-
-        # handle shell messages
-        while True:
-            try:
-                msg = shell.get_msg(timeout=0.2)
-                msg_type = msg['msg_type']
-                content = msg['content']
-            except Empty:
-                # shouldn't happen
-                p("shell channel empty")
-                break
-            if msg['parent_header'].get('msg_id') == msg_id:
-                p('shell', msg_type, len(str(content)), str(content)[:300])
-                if msg_type == 'execute_reply':
-                    if content['status'] == 'ok':
-                        if 'payload' in content:
-                            payload = content['payload']
-                            if len(payload) > 0:
-                                if 'data' in payload[0]:
-                                    data = payload[0]['data']
-                                    if 'text/plain' in data:
-                                        text = data['text/plain']
-                                        hout(text, scroll=True)
+            return False
+
+        def stdin_message(msg):
+            # the kernel is blocked waiting for input, e.g., from input() in
+            # python or pause in octave
+            p('stdin', msg['msg_type'], str(msg['content'])[:300])
+            if msg['msg_type'] != 'input_request':
+                return
+            icontent = msg['content']
+            prompt = '' if icontent.get('password') else icontent['prompt']
+            if not prompt and kernel_name == 'octave':
+                prompt = "Paused, enter any value to continue"
+            value = salvus.raw_input(prompt=prompt)
+            xcontent = dict(value=value)
+            xmsg = kc.session.msg('input_reply', xcontent)
+            p('sending input_reply', xcontent)
+            stdinj.send(xmsg)
+
+        def shell_reply(content):
+            if content['status'] == 'ok' and content.get('payload'):
+                data = content['payload'][0].get('data', {})
+                if 'text/plain' in data:
+                    hout(data['text/plain'], scroll=True)
+
+        # Wait for the messages of all three channels at once, so that output
+        # is shown as soon as it arrives and input requests are answered
+        # whenever the kernel makes them.  The execute_reply on the shell
+        # channel is only handled once the kernel is idle, since its
+        # payload comes after the output.
+        poller = zmq.Poller()
+        channels = {}
+        for channel in (iopub, shell, stdinj):
+            poller.register(channel.socket, zmq.POLLIN)
+            channels[channel.socket] = channel
+        idle = False
+        reply = None
+        while not idle or reply is None:
+            ready = dict(poller.poll(1000))
+            if not ready:
+                if not kc.is_alive():
+                    hout("kernel %s died\n" % kernel_name, error=True)
                     break
-            else:
-                # not our reply
                 continue
+            for sock, channel in channels.items():
+                if sock not in ready:
+                    continue
+                while channel.msg_ready():
+                    msg = channel.get_msg(timeout=0)
+                    if channel is iopub:
+                        if iopub_message(msg):
+                            idle = True
+                    elif channel is stdinj:
+                        stdin_message(msg)
+                    elif msg['parent_header'].get('msg_id') == msg_id:
+                        p('shell', msg['msg_type'], len(str(msg['content'])),
+                          str(msg['content'])[:300])
+                        if msg['msg_type'] == 'execute_reply':
+                            reply = msg['content']
+        # the code may have defined new names
+        completer.invalidate()
+        if reply is not None:
+            shell_reply(reply)
         return
 
     # 'html', 'plain', 'latex', 'markdown' - support depends on jupyter kernel
@@ -17,6 +17,15 @@ import string
 import traceback
 import __future__ as future
 import ast
+import re
+import bisect
+import threading
+from collections import OrderedDict
+
+try:
+    from . import sage_index
+except:
+    import sage_index
 
 # for the "input()" call
 import six
@@ -97,9 +106,45 @@ def preparse_code(code):
     return sage.all_cmdline.preparse(code, ignore_prompts=True)
 
 
-def strip_string_literals(code, state=None):
+def preparser_state():
+    """
+    The preparser settings that preparse_code depends on besides the code,
+    i.e., the level set with implicit_multiplication().
+    """
+    import sage.all_cmdline
+    return sage.all_cmdline.implicit_multiplication()
+
+
+class SourceScan(object):
+    """
+    The result of scanning code once for string literals and comments.
+
+    - ``code`` -- the code with every string literal and comment replaced by a
+      template %(L<n>)s, and every other % doubled, so ``code % literals``
+      gives back the input
+    - ``literals`` -- dict mapping labels L<n> to the literals and comments
+    - ``comments`` -- list of (start, end) positions of the comments in the input
+    - ``state`` -- (in_quote, raw) at the end of the input; in_quote is False
+      or the quote that is still open
+
+    Instances are shared via the scan cache, so treat them as read-only.
+    """
+
+    def __init__(self, code, literals, comments, state):
+        self.code = code
+        self.literals = literals
+        self.comments = comments
+        self.state = state
+
+
+_QUOTE_OR_HASH = re.compile('[\'"#]')
+_QUOTE = re.compile('[\'"]')
+
+
+def _scan(code, state=None):
     new_code = []
     literals = {}
+    comments = []
     counter = 0
     start = q = 0
     if state is None:
@@ -108,18 +153,19 @@ def strip_string_literals(code, state=None):
     else:
         in_quote, raw = state
     while True:
-        sig_q = code.find("'", q)
-        dbl_q = code.find('"', q)
-        hash_q = code.find('#', q)
-        q = min(sig_q, dbl_q)
-        if q == -1: q = max(sig_q, dbl_q)
-        if not in_quote and hash_q != -1 and (q == -1 or hash_q < q):
+        # find the next quote (or, outside of strings, the next quote or #);
+        # searching for all of them at once keeps this linear in len(code).
+        m = (_QUOTE if in_quote else _QUOTE_OR_HASH).search(code, q)
+        q = -1 if m is None else m.start()
+        if not in_quote and q != -1 and code[q] == '#':
             # it's a comment
+            hash_q = q
             newline = code.find('\n', hash_q)
             if newline == -1: newline = len(code)
             counter += 1
             label = "L%s" % counter
             literals[label] = code[hash_q:newline]
+            comments.append((hash_q, newline))
             new_code.append(code[start:hash_q].replace('%', '%%'))
             new_code.append("%%(%s)s" % label)
             start = q = newline
@@ -159,7 +205,38 @@ def strip_string_literals(code, state=None):
             start = q
             q += len(in_quote)
 
-    return "".join(new_code), literals, (in_quote, raw)
+    return SourceScan("".join(new_code), literals, comments, (in_quote, raw))
+
+
+# recently scanned code --> SourceScan; the same cell is usually scanned by
+# several consumers (block splitting, introspection, error messages), and
+# introspection also runs in the session reader thread while a cell runs
+_scans = OrderedDict()
+_scans_lock = threading.Lock()
+SCAN_CACHE_SIZE = 32
+
+
+def scan(code):
+    """
+    Return the SourceScan of code, reusing the result for recently scanned code.
+    """
+    with _scans_lock:
+        s = _scans.pop(code, None)
+    if s is None:
+        s = _scan(code)
+    with _scans_lock:
+        _scans[code] = s
+        while len(_scans) > SCAN_CACHE_SIZE:
+            _scans.popitem(last=False)
+    return s
+
+
+def strip_string_literals(code, state=None):
+    if state is None:
+        s = scan(code)
+    else:
+        s = _scan(code, state)
+    return s.code, s.literals, s.state
 
 
 def end_of_expr(s):
@@ -197,8 +274,14 @@ dec_counter = 0
 dec_args = {}
 
 
-# Divide the input code (a string) into blocks of code.
-def divide_into_blocks(code):
+def _code_lines(code):
+    """
+    Strip string literals and comments from code and turn code decorators
+    into calls to salvus.execute_with_code_decorators.
+
+    Returns the list of lines that are neither empty nor only a comment, in
+    which literals are replaced by %(L...)s templates, and the dict of literals.
+    """
     global dec_counter
 
     # strip string literals from the input, so that we can parse it without having to worry about strings
@@ -267,70 +350,102 @@ def divide_into_blocks(code):
     # take only non-whitespace lines now for Python code (string literals have already been removed).
     code = [x for x in code if x.strip()]
 
-    # Compute the blocks
-    i = len(code) - 1
+    return code, literals
+
+
+def _bracket_depths(line):
+    return (line.count('(') - line.count(')'), line.count('[') -
+            line.count(']'), line.count('{') - line.count('}'))
+
+
+# Divide the input code (a string) into blocks of code.
+#
+# A block ends at the last line of the code, and starts at the closest line
+# before it that is not indented and after which all brackets are balanced
+# or open; then the same is done for the code before that block.  Finally
+# blocks that belong together (try/except, decorators, if/elif/else, ...)
+# are merged.  The search for the start of a block only looks at lines that
+# are not indented, using the bracket depths of all lines before each line,
+# and gives up right away if none of them can be the start.
+def divide_into_blocks(code):
+    return _split_blocks(*_code_lines(code))
+
+
+def _split_blocks(code, literals):
+    # depths[k]: the bracket depths of the lines before line k, so lines i
+    # to j have the depths depths[j + 1] - depths[i];
+    # starts[k]: the last line up to line k that is not indented, or -1;
+    # lowest[k]: the lowest depths[i] of those lines, for each kind of bracket
+    depths = [(0, 0, 0)]
+    starts = []
+    lowest = []
+    start, low = -1, None
+    for k, line in enumerate(code):
+        d = depths[-1]
+        if line[0] not in string.whitespace:
+            start = k
+            low = d if low is None else tuple(map(min, low, d))
+        depths.append(tuple(x + y for x, y in zip(d, _bracket_depths(line))))
+        starts.append(start)
+        lowest.append(low)
+
+    # Compute the blocks, from the last one to the first one
     blocks = []
-    while i >= 0:
-        stop = i
-        paren_depth = code[i].count('(') - code[i].count(')')
-        brack_depth = code[i].count('[') - code[i].count(']')
-        curly_depth = code[i].count('{') - code[i].count('}')
-        while i >= 0 and (
-            (len(code[i]) > 0 and (code[i][0] in string.whitespace))
-                or paren_depth < 0 or brack_depth < 0 or curly_depth < 0):
-            i -= 1
-            if i >= 0:
-                paren_depth += code[i].count('(') - code[i].count(')')
-                brack_depth += code[i].count('[') - code[i].count(']')
-                curly_depth += code[i].count('{') - code[i].count('}')
-        block = ('\n'.join(code[i:])) % literals
-        bs = block.strip()
-        if bs:  # has to not be only whitespace
-            blocks.insert(0, [i, stop, bs])
-        code = code[:i]
-        i = len(code) - 1
-
-    # merge try/except/finally/decorator/else/elif blocks
-    i = 1
-
-    def merge():
-        "Merge block i-1 with block i."
-        blocks[i - 1][-1] += '\n' + blocks[i][-1]
-        blocks[i - 1][1] = blocks[i][1]
-        del blocks[i]
-
-    while i < len(blocks):
-        s = blocks[i][-1].lstrip()
-
-        # finally/except lines after a try
-        if (s.startswith('finally') or s.startswith('except')
-            ) and blocks[i - 1][-1].lstrip().startswith('try'):
-            merge()
-
-        # function definitions
-        elif (s.startswith('def') or s.startswith('@')) and blocks[
-                i - 1][-1].splitlines()[-1].lstrip().startswith('@'):
-            merge()
-
-        # lines starting with else conditions (if *and* for *and* while!)
-        elif s.startswith('else') and (
-                blocks[i - 1][-1].lstrip().startswith('if')
-                or blocks[i - 1][-1].lstrip().startswith('while')
-                or blocks[i - 1][-1].lstrip().startswith('for')
-                or blocks[i - 1][-1].lstrip().startswith('try')
-                or blocks[i - 1][-1].lstrip().startswith('elif')):
-            merge()
-
-        # lines starting with elif
-        elif s.startswith('elif') and blocks[i -
-                                             1][-1].lstrip().startswith('if'):
-            merge()
-
-        # do not merge blocks -- move on to next one
+    stop = len(code) - 1
+    while stop >= 0:
+        top = depths[stop + 1]
+        i = starts[stop]
+        if i >= 0 and all(x <= y for x, y in zip(lowest[stop], top)):
+            while i >= 0 and any(x > y for x, y in zip(depths[i], top)):
+                i = starts[i - 1] if i > 0 else -1
         else:
-            i += 1
+            i = -1
+        if i >= 0:
+            block = code[i:stop + 1]
+            next_stop = i - 1
+        else:
+            # no line qualifies as the start (e.g., everything is indented):
+            # then the last line is a block by itself
+            block = code[stop:stop + 1]
+            next_stop = stop - 1
+        bs = ('\n'.join(block) % literals).strip()
+        if bs:  # has to not be only whitespace
+            blocks.append([i, stop, bs])
+        stop = next_stop
+    blocks.reverse()
+
+    # merge try/except/finally/decorator/else/elif blocks; the text of each
+    # merged block is kept as a list of parts, joined at the end.
+    merged = []
+    for start, stop, bs in blocks:
+        if merged:
+            prev = merged[-1][2]
+            first = prev[0].lstrip()
+            s = bs.lstrip()
+            if ((s.startswith('finally') or s.startswith('except'))
+                    and first.startswith('try')):
+                # finally/except lines after a try
+                merge = True
+            elif s.startswith('def') or s.startswith('@'):
+                # function definitions
+                merge = prev[-1].splitlines()[-1].lstrip().startswith('@')
+            elif s.startswith('else'):
+                # lines starting with else conditions (if *and* for *and* while!)
+                merge = (first.startswith('if') or first.startswith('while')
+                         or first.startswith('for') or first.startswith('try')
+                         or first.startswith('elif'))
+            elif s.startswith('elif'):
+                # lines starting with elif
+                merge = first.startswith('if')
+            else:
+                merge = False
+            if merge:
+                merged[-1][1] = stop
+                prev.append(bs)
+                continue
+        merged.append([start, stop, [bs]])
 
-    return blocks
+    return [[start, stop, '\n'.join(parts)] for start, stop, parts in merged]
 
 
 ############################################
@@ -366,7 +481,160 @@ _builtin_completions = list(__builtins__.keys()) + [
 ]
 
 
-def introspect(code, namespace, preparse=True):
+def complete_prefix(names, prefix):
+    """
+    Return the names in the sorted list names that start with prefix.
+    """
+    i = bisect.bisect_left(names, prefix)
+    v = []
+    while i < len(names) and names[i].startswith(prefix):
+        v.append(names[i])
+        i += 1
+    return v
+
+
+_ROOT_NAME = re.compile(r'\s*([A-Za-z_][A-Za-z0-9_]*)')
+
+
+class CompletionCache(object):
+    """
+    Caches the work TAB completion repeats on every keystroke: evaluating
+    the object before the dot, and the sorted attribute names of objects
+    (dir() of a Sage parent has hundreds of entries).
+
+    Code that runs in the worksheet can change any object, so sage_server
+    calls invalidate() whenever it executes code.  In between, a cached
+    object is only used while the variable its expression starts with is
+    still bound to the same object, which catches variables being rebound
+    without having to observe every assignment to the namespace.
+
+    The cache may be used from several threads.
+    """
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self.generation = 0
+        self.hits = self.misses = 0
+        self._lock = threading.RLock()
+        # (before_expr, obj, preparse) --> (root object, object, obj)
+        self._objects = OrderedDict()
+        # id(object) --> (object, sorted attribute names)
+        self._names = OrderedDict()
+        # (generation, namespace size, namespace changes) and the sorted
+        # names of the namespace
+        self._global_names = (None, [])
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+            self._objects.clear()
+            self._names.clear()
+            self._global_names = (None, [])
+
+    def _add(self, d, key, value):
+        d[key] = value
+        while len(d) > self.max_size:
+            d.popitem(last=False)
+
+    def _root(self, obj, namespace):
+        m = _ROOT_NAME.match(obj)
+        return namespace.get(m.group(1)) if m else None
+
+    def get_object(self, key, namespace):
+        """
+        Return (object, obj) for the cached evaluation of key, or None.
+        """
+        with self._lock:
+            entry = self._objects.get(key)
+            if entry is None or entry[0] is not self._root(key[1], namespace):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def set_object(self, key, namespace, O, obj):
+        with self._lock:
+            self._add(self._objects, key,
+                      (self._root(key[1], namespace), O, obj))
+
+    def names(self, O):
+        """
+        Return the sorted attribute names of O, including its trait_names().
+        """
+        with self._lock:
+            entry = self._names.get(id(O))
+            if entry is not None and entry[0] is O:
+                return entry[1]
+        v = dir(O)
+        if hasattr(O, 'trait_names'):
+            v += O.trait_names()
+        v = sorted(set(v))
+        with self._lock:
+            self._add(self._names, id(O), (O, v))
+        return v
+
+    def global_names(self, namespace):
+        """
+        Return the sorted names of the namespace and the builtins.
+        """
+        with self._lock:
+            key = (self.generation, len(namespace),
+                   getattr(namespace, 'changes', None))
+            if self._global_names[0] != key:
+                self._global_names = (key, _global_names(namespace))
+            return self._global_names[1]
+
+
+def _global_names(namespace):
+    return sorted(set(list(namespace.keys()) + _builtin_completions))
+
+
+completion_cache = CompletionCache()
+
+
+def _eval_object(before_expr, obj, namespace, preparse):
+    """
+    Evaluate the expression obj (after executing before_expr) in namespace
+    and return (the object or None, the expression that was evaluated).
+    """
+    O = None
+    try:
+        import signal
+
+        def mysig(*args):
+            raise KeyboardInterrupt
+
+        signal.signal(signal.SIGALRM, mysig)
+        signal.alarm(1)
+        import sage.all_cmdline
+        if before_expr.strip():
+            try:
+                exec((before_expr if not preparse else
+                      preparse_code(before_expr)), namespace)
+            except Exception as msg:
+                pass
+                # uncomment for debugging only
+                # traceback.print_exc()
+        # We first try to evaluate the part of the expression before the name
+        try:
+            O = eval(obj if not preparse else preparse_code(obj),
+                     namespace)
+        except (SyntaxError, TypeError, AttributeError):
+            # If that fails, we try on a subexpression.
+            # TODO: This will not be needed when
+            # this code is re-written to parse using an
+            # AST, instead of using this lame hack.
+            obj = guess_last_expression(obj)
+            try:
+                O = eval(obj if not preparse else preparse_code(obj),
+                         namespace)
+            except:
+                pass
+    finally:
+        signal.signal(signal.SIGALRM, signal.SIG_IGN)
+    return O, obj
+
+
+def introspect(code, namespace, preparse=True, evaluate=True):
     """
     INPUT:
 
@@ -377,6 +645,10 @@ def introspect(code, namespace, preparse=True):
 
     - preparse -- a boolean
 
+    - evaluate -- a boolean (default: True); if False, nothing is
+      evaluated and no object of the namespace is touched: only names of
+      the namespace are completed, and None is returned for anything else.
+
     OUTPUT:
 
     An object: {'result':, 'target':, 'expr':, 'status':, 'get_help':, 'get_completions':, 'get_source':}
@@ -402,6 +674,11 @@ def introspect(code, namespace, preparse=True):
     get_source = False  # getting source code of a function
     get_completions = True  # getting completions of an identifier in some namespace
 
+    def global_names():
+        if evaluate:
+            return completion_cache.global_names(namespace)
+        return _global_names(namespace)
+
     try:
         # Strip all strings from the code, replacing them by template
         # symbols; this makes parsing much easier.
@@ -473,9 +750,7 @@ def introspect(code, namespace, preparse=True):
                 try:
                     pattern = expr.replace("*", ".*").replace("?", ".")
                     reg = re.compile(pattern + "$")
-                    v = list(
-                        filter(reg.match,
-                               list(namespace.keys()) + _builtin_completions))
+                    v = list(filter(reg.match, global_names()))
                     # for 2*sq[tab]
                     if len(v) == 0:
                         gle = guess_last_expression(expr)
@@ -483,18 +758,13 @@ def introspect(code, namespace, preparse=True):
                         if j > 0:
                             target = gle
                             v = [
-                                x[j:] for x in (list(namespace.keys()) +
-                                                _builtin_completions)
-                                if x.startswith(gle)
+                                x[j:]
+                                for x in complete_prefix(global_names(), gle)
                             ]
                 except:
                     pass
             else:
-                v = [
-                    x[j:]
-                    for x in (list(namespace.keys()) + _builtin_completions)
-                    if x.startswith(expr)
-                ]
+                v = [x[j:] for x in complete_prefix(global_names(), expr)]
                 # for 2+sqr[tab]
                 if len(v) == 0:
                     gle = guess_last_expression(expr)
@@ -502,10 +772,11 @@ def introspect(code, namespace, preparse=True):
                     if j > 0 and j < len(expr):
                         target = gle
                         v = [
-                            x[j:] for x in (list(namespace.keys()) +
-                                            _builtin_completions)
-                            if x.startswith(gle)
+                            x[j:]
+                            for x in complete_prefix(global_names(), gle)
                         ]
+        elif not evaluate:
+            return None
         else:
 
             # We will try to evaluate
@@ -515,41 +786,14 @@ def introspect(code, namespace, preparse=True):
             # Obviously, this could in fact lock if
             # non-interruptable code is called, which should be rare.
 
-            O = None
-            try:
-                import signal
-
-                def mysig(*args):
-                    raise KeyboardInterrupt
-
-                signal.signal(signal.SIGALRM, mysig)
-                signal.alarm(1)
-                import sage.all_cmdline
-                if before_expr.strip():
-                    try:
-                        exec((before_expr if not preparse else
-                              preparse_code(before_expr)), namespace)
-                    except Exception as msg:
-                        pass
-                        # uncomment for debugging only
-                        # traceback.print_exc()
-                # We first try to evaluate the part of the expression before the name
-                try:
-                    O = eval(obj if not preparse else preparse_code(obj),
-                             namespace)
-                except (SyntaxError, TypeError, AttributeError):
-                    # If that fails, we try on a subexpression.
-                    # TODO: This will not be needed when
-                    # this code is re-written to parse using an
-                    # AST, instead of using this lame hack.
-                    obj = guess_last_expression(obj)
-                    try:
-                        O = eval(obj if not preparse else preparse_code(obj),
-                                 namespace)
-                    except:
-                        pass
-            finally:
-                signal.signal(signal.SIGALRM, signal.SIG_IGN)
+            key = (before_expr, obj, preparse)
+            cached = completion_cache.get_object(key, namespace)
+            if cached is not None:
+                O, obj = cached
+            else:
+                O, obj = _eval_object(before_expr, obj, namespace, preparse)
+                if O is not None:
+                    completion_cache.set_object(key, namespace, O, obj)
 
             def get_file():
                 try:
@@ -562,7 +806,26 @@ def introspect(code, namespace, preparse=True):
                 except Exception as err:
                     return "Unable to read source filename (%s)" % err
 
-            if get_help:
+            # library objects are looked up in the shared documentation index
+            entry = None
+            if get_help or get_source:
+                entry = sage_index.doc_index.lookup(O)
+            source = None
+            if get_source and entry is not None:
+                source = sage_index.doc_index.source(entry)
+
+            if get_help and entry is not None:
+                result = "   File: " + entry['file'] + "\n"
+                if entry['args'] is not None:
+                    result += "   Signature : %s(%s)\n" % (obj, entry['args'])
+                result += "   Docstring :\n%s" % entry['doc'].strip()
+                result = result.lstrip().replace('\n   ', '\n')
+
+            elif get_source and source is not None:
+                result = "   File: " + entry['file'] + "\n"
+                result += "   Source:\n   " + source
+
+            elif get_help:
                 import sage.misc.sageinspect
                 result = get_file()
                 try:
@@ -619,11 +882,7 @@ def introspect(code, namespace, preparse=True):
 
             elif get_completions:
                 if O is not None:
-                    v = dir(O)
-                    if hasattr(O, 'trait_names'):
-                        v += O.trait_names()
-                    if not target.startswith('_'):
-                        v = [x for x in v if x and not x.startswith('_')]
+                    v = completion_cache.names(O)
                     # this case excludes abc = ...;for a in ab[tab]
                     if '*' in expr and '* ' not in expr:
                         try:
@@ -634,8 +893,12 @@ def introspect(code, namespace, preparse=True):
                         except:
                             pass
                     else:
+                        v = complete_prefix(v, target)
+                    if not target.startswith('_'):
+                        v = [x for x in v if x and not x.startswith('_')]
+                    if '*' not in expr or '* ' in expr:
                         j = len(target)
-                        v = [x[j:] for x in v if x.startswith(target)]
+                        v = [x[j:] for x in v]
                 else:
                     v = []
 
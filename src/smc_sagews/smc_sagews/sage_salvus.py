@@ -1644,6 +1644,20 @@ class Time:
 time = Time()
 
 
+def cell_stats(code):
+    """
+    Execute code and then print where its time went, block by block:
+    preparsing, compiling, executing (wall and CPU time), sending output
+    and waiting for the hub to save files, along with the number of
+    output messages and bytes each block sent.
+
+    Put %cell_stats at the top of a cell to profile the rest of the cell.
+    salvus.last_profile() returns the same breakdown for the most recently
+    completed cell.
+    """
+    print(salvus.profile(code))
+
+
 def file(path):
     """
     Block decorator to write to a file.  Use as follows:
@@ -1916,6 +1930,102 @@ def cython(code=None, **kwds):
 cython.__doc__ += sage.misc.cython.cython.__doc__
 
 
+class _OutputPipe(object):
+    """
+    The read end of a pipe from a subprocess, whose (utf8) output is written
+    to the stream out, e.g., sys.stdout of the cell, as soon as it arrives.
+    If keep is true, all of it is also kept in the attribute text.
+
+    If end is given (a compiled regular expression), the output ends with
+    the first match of end, which is kept in the attribute match, instead of
+    at the end of file.
+    """
+    # a match of end is at most this long and starts with this character
+    END_LENGTH = 64
+    END_START = '\x1e'
+
+    def __init__(self, fd, out, keep=False, end=None):
+        import codecs
+        self.fd = fd
+        self.out = out
+        self.end = end
+        self.done = False
+        self.match = None
+        self.text = '' if keep else None
+        self._decoder = codecs.getincrementaldecoder('utf8')('replace')
+        self._pending = ''
+
+    def _emit(self, text):
+        if text:
+            self.out.write(text)
+            if self.text is not None:
+                self.text += text
+
+    def read(self):
+        data = os.read(self.fd, 65536)
+        if not data:
+            self.done = True
+        text = self._pending + self._decoder.decode(data, final=not data)
+        self._pending = ''
+        if self.end is not None:
+            m = self.end.search(text)
+            if m is not None:
+                self._emit(text[:m.start()])
+                self.match = m
+                self.done = True
+                return
+            i = text.rfind(self.END_START)
+            if not self.done and i != -1 and len(text) - i < self.END_LENGTH:
+                # might be the beginning of the end
+                text, self._pending = text[:i], text[i:]
+        self._emit(text)
+        if self.done:
+            self.out.flush()
+
+
+def _pump(pipes, stdin=None, data=six.b(''), close=True):
+    """
+    Write data to the pipe stdin of a subprocess, and close it afterwards
+    if close is true, while passing on the output arriving on the given
+    _OutputPipes, until all of them are done.  Nothing blocks, so a
+    subprocess that writes a lot before reading all of its input is fine.
+    """
+    import selectors
+    selector = selectors.DefaultSelector()
+    try:
+        for pipe in pipes:
+            selector.register(pipe.fd, selectors.EVENT_READ, pipe)
+        data = memoryview(data)
+        if stdin is not None:
+            if len(data):
+                os.set_blocking(stdin.fileno(), False)
+                selector.register(stdin.fileno(), selectors.EVENT_WRITE,
+                                  None)
+            elif close:
+                stdin.close()
+        while not all(pipe.done for pipe in pipes):
+            for key, _ in selector.select():
+                if key.data is not None:
+                    key.data.read()
+                    if key.data.done:
+                        selector.unregister(key.fd)
+                    continue
+                try:
+                    data = data[os.write(key.fd, data[:65536]):]
+                except BlockingIOError:
+                    pass
+                except BrokenPipeError:
+                    # it does not want the rest of its input
+                    data = data[:0]
+                if not len(data):
+                    selector.unregister(key.fd)
+                    os.set_blocking(key.fd, True)
+                    if close:
+                        stdin.close()
+    finally:
+        selector.close()
+
+
 class script:
     r"""
     Block decorator to run an arbitrary shell command with input from a
@@ -1933,9 +2043,11 @@ class script:
         %script(['gp', '-q'])   factor(2^97 - 1)
 
     will launch a gp session, feed 'factor(2^97-1)' into stdin, and
-    display the resulting factorization.
+    display the resulting factorization.  The output of the command is
+    shown while it runs, with stderr as stderr.
 
-    NOTE: the result is stored in the attribute "stdout", so you can do::
+    NOTE: the result is stored in the attribute "stdout" (and the error
+    output in "stderr"), so you can do::
 
         s = script('gp -q')
         %s factor(2^97-1)
@@ -1952,31 +2064,113 @@ class script:
 
     def __call__(self, code=''):
         import subprocess
+        s = subprocess.Popen(self._args,
+                             stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE,
+                             shell=is_string(self._args),
+                             env=self._env)
         try:
-            s = None
-            s = subprocess.Popen(self._args,
-                                 stdin=subprocess.PIPE,
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.STDOUT,
-                                 shell=is_string(self._args),
-                                 env=self._env)
-            s.stdin.write(code)
-            s.stdin.close()
+            out = _OutputPipe(s.stdout.fileno(), sys.stdout, keep=True)
+            err = _OutputPipe(s.stderr.fileno(), sys.stderr, keep=True)
+            _pump([out, err], s.stdin, code.encode('utf8'))
+            self.stdout = out.text
+            self.stderr = err.text
         finally:
-            if s is None:
-                return
             try:
-                self.stdout = s.stdout.read()
-                sys.stdout.write(self.stdout)
-            finally:
-                try:
-                    os.system("pkill -TERM -P %s" % s.pid)
-                except OSError:
-                    pass
-                try:
-                    os.kill(s.pid, 9)
-                except OSError:
-                    pass
+                os.system("pkill -TERM -P %s" % s.pid)
+            except OSError:
+                pass
+            try:
+                os.kill(s.pid, 9)
+            except OSError:
+                pass
+            s.wait()
+            s.stdout.close()
+            s.stderr.close()
+
+
+class BashSession(object):
+    """
+    A bash process that runs the code of one cell after the other, so that
+    the working directory, variables and functions set in a cell are still
+    there in the next one, without starting a process per cell.  Output is
+    shown while a cell runs, stdout and stderr separately.
+
+    The code of a cell runs with stdin from /dev/null.  If it exits bash
+    (e.g., by calling exit) or the cell is interrupted, which kills bash
+    and whatever it runs, the next cell starts a new bash.
+
+    The exit status of the last cell is in the attribute status.
+    """
+    def __init__(self, args=('bash', '--norc')):
+        self._args = list(args)
+        self._bash = None
+        self.status = None
+
+    def __repr__(self):
+        return "Bash session (pid %s)" % (self._bash.pid if self._bash
+                                          is not None else None)
+
+    def _start(self):
+        import subprocess
+        self._bash = subprocess.Popen(self._args,
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE,
+                                      start_new_session=True)
+
+    def kill(self):
+        """
+        Kill bash and everything it runs; the next cell starts a new bash.
+        """
+        if self._bash is None:
+            return
+        bash, self._bash = self._bash, None
+        try:
+            os.killpg(bash.pid, 9)
+        except OSError:
+            pass
+        bash.wait()
+        for f in (bash.stdin, bash.stdout, bash.stderr):
+            f.close()
+
+    def __call__(self, code):
+        import re
+        if self._bash is None:
+            self._start()
+        bash = self._bash
+        marker = uuid().replace('-', '')
+        # The code is read by the read builtin from a here document, so that
+        # whatever it contains, the two end markers are printed after it.
+        # Since $? is the status of eval, printf does not change it for
+        # the next cell.
+        data = ("IFS= read -r -d '' __smc_code <<'%(m)s'\n%(code)s\n%(m)s\n"
+                'eval "$__smc_code" < /dev/null\n'
+                "printf '\\036%(m)s %%s\\036' $?\n"
+                "printf '\\036%(m)s\\036' >&2\n") % {
+                    'm': marker,
+                    'code': code
+                }
+        out = _OutputPipe(bash.stdout.fileno(),
+                          sys.stdout,
+                          end=re.compile('\x1e%s (\\d+)\x1e' % marker))
+        err = _OutputPipe(bash.stderr.fileno(),
+                          sys.stderr,
+                          end=re.compile('\x1e%s\x1e' % marker))
+        try:
+            _pump([out, err], bash.stdin, data.encode('utf8'), close=False)
+        except BaseException:
+            # e.g., KeyboardInterrupt
+            self.kill()
+            raise
+        if out.match is None:
+            self.status = bash.wait()
+            self.kill()
+            sys.stderr.write("bash exited with status %s\n" % self.status)
+            sys.stderr.flush()
+        else:
+            self.status = int(out.match.group(1))
 
 
 def python(code):
@@ -2319,16 +2513,39 @@ def sh(code=None, **kwargs):
         It only returns ok or error depending on exit status of last command in the cell.
         So all cell output captured goes to either stdout or stderr variable, depending
         on exit status of the last command in the %sh cell.
+
+    Instead of the jupyter bash kernel, you can use a plain bash process,
+    which also keeps state between cells and shows output as it arrives,
+    with stdout and stderr separate (but no display)::
+
+        sh.use_jupyter = False
+
+    This is also what is used if the jupyter bash kernel is not installed.
+    The exit status of the last cell is then in sh.bash_session.status.
     """
-    if sh.jupyter_kernel is None:
-        sh.jupyter_kernel = jupyter("bash")
-        sh.jupyter_kernel(
-            'function command_not_found_handle { printf "%s: command not found\n" "$1" >&2; return 127;}'
-        )
-    return sh.jupyter_kernel(code, **kwargs)
+    if sh.use_jupyter and sh.jupyter_kernel is None:
+        try:
+            sh.jupyter_kernel = jupyter("bash")
+        except Exception:
+            sh.use_jupyter = False
+        else:
+            sh.jupyter_kernel(
+                'function command_not_found_handle { printf "%s: command not found\n" "$1" >&2; return 127;}'
+            )
+    if sh.use_jupyter:
+        return sh.jupyter_kernel(code, **kwargs)
+    if kwargs:
+        raise TypeError("the bash session does not support %s" %
+                        ', '.join(sorted(kwargs)))
+    if sh.bash_session is None:
+        sh.bash_session = BashSession()
+    if code is not None:
+        sh.bash_session(code)
 
 
 sh.jupyter_kernel = None
+sh.bash_session = None
+sh.use_jupyter = True
 
 
 # use jupyter kernel for GNU octave instead of sage interpreter interface
@@ -2470,48 +2687,353 @@ def prun(code):
 ##############################################################
 
 
-def _wait_in_thread(pid, callback, filename):
-    from sage.structure.sage_object import load
+# At most this many forked subprocesses (%fork cells and async_ calls) run at
+# the same time by default; 0 means one per cpu.  Can be changed in a
+# session with fork.max_parallel = n.
+FORK_MAX_PARALLEL = int(os.environ.get('COCALC_SAGE_FORK_MAX_PARALLEL', 0))
 
-    def wait():
-        try:
-            os.waitpid(pid, 0)
-            callback(load(filename))
-        except Exception as msg:
-            callback(msg)
 
-    from threading import Thread
-    t = Thread(target=wait, args=tuple([]))
-    t.start()
+def _die_with_parent():
+    """
+    Ask the kernel to kill this (forked) process when its parent exits,
+    which is only possible on Linux.
+    """
+    try:
+        import ctypes
+        # PR_SET_PDEATHSIG is 1
+        ctypes.CDLL(None).prctl(1, 9)
+    except Exception:
+        pass
 
 
-def async_(f, args, kwds, callback):
+def _setup_forked_child(sock):
     """
-    Run f in a forked subprocess with given args and kwds, then call the
-    callback function when f terminates.
+    Called in a subprocess that the session just forked: make it die with
+    the session and send its output to the session over the socket sock
+    instead of to the hub.  Returns the new connection.
     """
-    from sage.misc.all import tmp_filename
-    filename = tmp_filename() + '.sobj'
-    sys.stdout.flush()
-    sys.stderr.flush()
-    pid = os.fork()
-    if pid:
-        # The parent master process
+    parent = os.getppid()
+    _die_with_parent()
+    if os.getppid() != parent:
+        # the session died before we asked to die with it
+        os._exit(1)
+    fork_pool._forked()
+    conn = type(salvus._conn)(sock)
+    salvus._conn = conn
+    salvus.message_queue = type(salvus.message_queue)(conn)
+    # Output queued in the session until the hub saved its blobs is sent
+    # by the session; the acks would never reach us.
+    salvus._pending_outputs.clear()
+    return conn
+
+
+def _reset_sage_after_fork():
+    """
+    Tell Sage that its pid has changed.
+    """
+    import sage.misc.misc
+
+    # since python 3.12, there is no imp
+    try:
+        import imp
+    except:
+        import importlib as imp
+    imp.reload(sage.misc.misc)
+
+    # The pexpect interfaces (and objects defined in them) are
+    # not valid.
+    sage.interfaces.quit.invalidate_all()
+
+
+class _ForkJob(object):
+    def __init__(self, pid, conn, target, message_queue, callback, tag):
+        self.pid = pid
+        self.conn = conn  # our end of the socket pair to the child
+        self.target = target  # connection to the hub
+        self.message_queue = message_queue
+        self.callback = callback
+        self.tag = tag
+        self.blobs = []  # uuids of blobs whose save_blob reply we route
+        self.result = None
+        self.killed = False
+
+    def pass_on(self, typ, mesg):
+        """
+        Pass a message from the subprocess on to the hub.  The hub's reply
+        to a blob is routed back to the subprocess.
+        """
+        if typ == 'blob':
+            uuid = mesg[:36].decode('ascii')
+            self.blobs.append(uuid)
+            self.message_queue.blob_routes.add(uuid, self.conn.send_json)
+            self.target.send_blob(memoryview(mesg)[36:])
+        else:
+            self.target.send_json(mesg)
+
+    def close(self):
+        self.conn.close()
+        for uuid in self.blobs:
+            self.message_queue.blob_routes.remove(uuid, self.conn.send_json)
+
+
+class ForkPool(object):
+    """
+    Runs functions in forked subprocesses for async_, at most max_parallel
+    of them at the same time.
+
+    The subprocess is forked right away, so it sees the state of the
+    session at the time of the call, but only starts running the function
+    once fewer than max_parallel others are running; until then it waits
+    in the queue.  Each subprocess talks to the session over a socket pair
+    using the same framing as the hub connection: the output messages and
+    blobs it sends are passed on to the hub as they arrive, the save_blob
+    replies of the hub are passed back to it, and its last message is the
+    pickled result of the function.  All of this is done by one thread,
+    which also reaps the subprocesses and calls the callbacks.
+
+    The subprocesses are killed when the session exits.
+    """
+    def __init__(self, max_parallel=None):
+        self.max_parallel = max_parallel or FORK_MAX_PARALLEL
+        self._reset()
+
+    def _reset(self):
+        from collections import deque
+        import threading
+        self._lock = threading.Lock()
+        self._jobs = {}  # pid --> _ForkJob
+        self._running = set()  # pids of the jobs that were told to start
+        self._queue = deque()  # jobs waiting for one of the running ones
+        self._new = deque()  # jobs the thread has not started watching
+        self._pid = None  # the process the thread runs in
+        self._thread = None
+        self._wakeup = None
+
+    def _forked(self):
+        """
+        Forget the subprocesses of the parent in a forked subprocess.
+        """
+        if self._pid is None:
+            return
+        for job in self._jobs.values():
+            job.conn.close()
+        for fd in self._wakeup:
+            os.close(fd)
+        self._reset()
+
+    def __repr__(self):
+        return "Pool of %s forked subprocesses (%s running, %s queued)" % (
+            len(self._jobs), len(self._running), len(self._queue))
+
+    def _limit(self):
+        if self.max_parallel > 0:
+            return self.max_parallel
+        import multiprocessing
+        return multiprocessing.cpu_count()
+
+    def children(self):
+        """
+        Return a dictionary {pid:tag} of the subprocesses that did not
+        finish yet.
+        """
+        with self._lock:
+            return dict((pid, job.tag) for pid, job in self._jobs.items())
+
+    def queued(self):
+        """
+        Return the pids of the subprocesses that wait for their turn.
+        """
+        with self._lock:
+            return [job.pid for job in self._queue]
+
+    def submit(self, f, args, kwds, callback, tag=None):
+        """
+        Run f(*args, **kwds) in a forked subprocess and return its pid.
+        When f returns, callback is called (in the pool's thread) with its
+        result, or with an exception if f raised one, its result could not
+        be pickled or the subprocess died.  The callback is not called for
+        subprocesses that were killed with kill().
+        """
+        import socket
+        self._start()
+        ours, theirs = socket.socketpair()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if not pid:
+            ours.close()
+            self._child(theirs, f, args, kwds)
+        theirs.close()
+        job = _ForkJob(pid, type(salvus._conn)(ours), salvus._conn,
+                       salvus.message_queue, callback, tag)
+        with self._lock:
+            self._jobs[pid] = job
+            if len(self._running) < self._limit():
+                self._go(job)
+            else:
+                self._queue.append(job)
+            self._new.append(job)
+        os.write(self._wakeup[1], six.b('x'))
+        return pid
+
+    def kill(self, pid):
+        """
+        Kill the subprocess with given pid, whether it is running or queued.
+        """
+        with self._lock:
+            if pid not in self._jobs:
+                raise ValueError("Unknown pid = (%s)" % pid)
+            self._jobs[pid].killed = True
+        os.kill(pid, 9)
+
+    def kill_all(self):
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            pids = list(self._jobs)
+        for pid in pids:
+            try:
+                self.kill(pid)
+            except (ValueError, OSError):
+                pass
+
+    def _go(self, job):
+        # called with the lock held
+        self._running.add(job.pid)
+        try:
+            job.conn.send_json({'event': 'fork_start'})
+        except (IOError, OSError):
+            # it died already; the thread notices
+            pass
+
+    def _start(self):
+        if self._pid == os.getpid():
+            return
+        import atexit, signal, threading
+        self._wakeup = os.pipe()
+        signals = signal.valid_signals() if hasattr(
+            signal, 'valid_signals') else range(1, signal.NSIG)
+        # the new thread inherits the signal mask of this one, so signals
+        # are delivered to the main thread, where Sage handles interrupts
+        mask = signal.pthread_sigmask(signal.SIG_BLOCK, signals)
         try:
-            _wait_in_thread(pid, callback, filename)
-            return pid
+            self._thread = threading.Thread(target=self._run,
+                                            name='fork pool')
+            self._thread.daemon = True
+            self._thread.start()
         finally:
-            if os.path.exists(filename):
-                os.unlink(filename)
-    else:
-        # The child process
+            signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+        if self._pid is None:
+            atexit.register(self.kill_all)
+        self._pid = os.getpid()
+
+    def _child(self, sock, f, args, kwds):
+        """
+        The forked subprocess: wait for our turn, run f and send the result.
+        """
         try:
-            result = f(*args, **kwds)
-        except Exception as msg:
-            result = str(msg)
-        from sage.structure.sage_object import save
-        save(result, filename)
-        os._exit(0)
+            conn = _setup_forked_child(sock)
+            salvus.message_queue.take(event='fork_start')
+            try:
+                from sage.structure.sage_object import dumps
+                import base64
+                result = {
+                    'result':
+                    base64.b64encode(dumps(f(*args, **kwds))).decode('ascii')
+                }
+            except Exception as msg:
+                result = {'error': str(msg)}
+            sys.stdout.flush()
+            sys.stderr.flush()
+            salvus._send_pending_outputs(block=True)
+            result['event'] = 'fork_result'
+            conn.send_json(result)
+        finally:
+            os._exit(0)
+
+    def _run(self):
+        import selectors
+        selector = selectors.DefaultSelector()
+        selector.register(self._wakeup[0], selectors.EVENT_READ)
+        while True:
+            for key, _ in selector.select():
+                if key.fileobj == self._wakeup[0]:
+                    os.read(self._wakeup[0], 4096)
+                    with self._lock:
+                        new, self._new = list(self._new), type(self._new)()
+                    for job in new:
+                        selector.register(job.conn, selectors.EVENT_READ,
+                                          job)
+                else:
+                    job = key.data
+                    if not self._receive(job):
+                        selector.unregister(job.conn)
+                        self._finish(job)
+
+    def _receive(self, job):
+        """
+        Handle the next message of the subprocess of job, and return False
+        once it exited.
+        """
+        try:
+            typ, mesg = job.conn.recv()
+        except Exception:
+            return False
+        try:
+            if typ == 'json' and mesg.get('event') == 'fork_result':
+                job.result = mesg
+            else:
+                job.pass_on(typ, mesg)
+        except Exception as err:
+            sys.__stderr__.write("fork pool: unable to pass on output of %s -- %s\n" %
+                                 (job.pid, err))
+        return True
+
+    def _finish(self, job):
+        job.close()
+        try:
+            os.waitpid(job.pid, 0)
+        except OSError:
+            pass
+        with self._lock:
+            del self._jobs[job.pid]
+            self._running.discard(job.pid)
+            if job in self._queue:
+                self._queue.remove(job)
+            while self._queue and len(self._running) < self._limit():
+                self._go(self._queue.popleft())
+        if job.killed:
+            return
+        mesg = job.result
+        if mesg is None:
+            result = RuntimeError("subprocess %s exited without a result" %
+                                  job.pid)
+        elif 'error' in mesg:
+            result = RuntimeError(mesg['error'])
+        else:
+            try:
+                from sage.structure.sage_object import loads
+                import base64
+                result = loads(base64.b64decode(mesg['result']))
+            except Exception as err:
+                result = err
+        try:
+            job.callback(result)
+        except Exception as err:
+            sys.__stderr__.write("fork pool: callback for %s failed -- %s\n" %
+                                 (job.pid, err))
+
+
+fork_pool = ForkPool()
+
+
+def async_(f, args, kwds, callback, tag=None):
+    """
+    Run f in a forked subprocess with given args and kwds, then call the
+    callback function with its result when f terminates.  Returns the pid
+    of the subprocess; see ForkPool.submit for the details.
+    """
+    return fork_pool.submit(f, args, kwds, callback, tag=tag)
 
 
 class Fork(object):
@@ -2530,24 +3052,31 @@ class Fork(object):
     subprocess are set in the parent when the forked subprocess
     terminates.  However, the forked subprocess has no other side
     effects, except what it might do to file handles and the
-    filesystem.
+    filesystem.  Its output appears in the cell while it runs.
 
-    To see currently running forked subprocesses, type
+    At most fork.max_parallel subprocesses run at the same time (by
+    default one per cpu); the code of further %fork cells starts once
+    one of them finished.
+
+    To see currently running or queued forked subprocesses, type
     fork.children(), which returns a dictionary {pid:execute_uuid}.
     To kill a given subprocess and stop the cell waiting for input,
     type fork.kill(pid).  This is currently the only way to stop code
-    running in %fork cells.
-
-    TODO/WARNING: The subprocesses spawned by fork are not killed
-    if the parent process is killed first!
+    running in %fork cells.  The subprocesses are killed when the
+    session ends.
 
     NOTE: All pexpect interfaces are reset in the child process.
     """
-    def __init__(self):
-        self._children = {}
+    @property
+    def max_parallel(self):
+        return fork_pool._limit()
+
+    @max_parallel.setter
+    def max_parallel(self, n):
+        fork_pool.max_parallel = int(n)
 
     def children(self):
-        return dict(self._children)
+        return fork_pool.children()
 
     def __call__(self, s):
 
@@ -2558,6 +3087,7 @@ class Fork(object):
         salvus._done = False
 
         id = salvus._id
+        conn = salvus._conn
 
         changed_vars = set([])
 
@@ -2565,21 +3095,7 @@ class Fork(object):
             changed_vars.add(var)
 
         def f():
-            # Run some commands to tell Sage that its
-            # pid has changed.
-            import sage.misc.misc
-
-            # since python 3.12, there is no imp
-            try:
-                import imp
-            except:
-                import importlib as imp
-            imp.reload(sage.misc.misc)
-
-            # The pexpect interfaces (and objects defined in them) are
-            # not valid.
-            sage.interfaces.quit.invalidate_all()
-
+            _reset_sage_after_fork()
             salvus.namespace.on('change', None, change)
             salvus.execute(s)
             result = {}
@@ -2594,38 +3110,302 @@ class Fork(object):
         from sage.structure.sage_object import loads
 
         def g(s):
+            # runs in the thread of the fork pool, so errors are sent to
+            # the cell directly instead of printing them
             if isinstance(s, Exception):
-                sys.stderr.write(str(s))
-                sys.stderr.flush()
+                conn.send_json({'event': 'output', 'id': id, 'stderr': str(s)})
             else:
                 for var, val in s.items():
                     try:
                         salvus.namespace[var] = loads(val)
                     except:
-                        print(("unable to unpickle %s" % var))
-            salvus._conn.send_json({'event': 'output', 'id': id, 'done': True})
-            if pid in self._children:
-                del self._children[pid]
-
-        pid = async_(f, tuple([]), {}, g)
-        print(("Forked subprocess %s" % pid))
-        self._children[pid] = id
+                        conn.send_json({
+                            'event': 'output',
+                            'id': id,
+                            'stderr': "unable to unpickle %s\n" % var
+                        })
+            conn.send_json({'event': 'output', 'id': id, 'done': True})
+
+        pid = async_(f, tuple([]), {}, g, tag=id)
+        if pid in fork_pool.queued():
+            print(("Forked subprocess %s (waiting for one of %s to finish)" %
+                   (pid, self.max_parallel)))
+        else:
+            print(("Forked subprocess %s" % pid))
 
     def kill(self, pid):
-        if pid in self._children:
-            salvus._conn.send_json({
-                'event': 'output',
-                'id': self._children[pid],
-                'done': True
-            })
-            os.kill(pid, 9)
-            del self._children[pid]
-        else:
-            raise ValueError("Unknown pid = (%s)" % pid)
+        id = fork_pool.children().get(pid)
+        fork_pool.kill(pid)
+        salvus._conn.send_json({'event': 'output', 'id': id, 'done': True})
 
 
 fork = Fork()
 
+##############################################################
+# parallel_map and the %parallel cell decorator.
+##############################################################
+
+# parallel_map prints how far it got at most this often (in seconds).
+PARALLEL_PROGRESS_INTERVAL = 5
+
+
+def _parallel_worker(sock, f, items):
+    """
+    A worker of _parallel_results: ask for a chunk of indices, send the
+    result of f for each of its items, and repeat until told to stop.
+    """
+    try:
+        conn = _setup_forked_child(sock)
+        _reset_sage_after_fork()
+        from sage.structure.sage_object import dumps
+        import base64, traceback
+        while True:
+            conn.send_json({'event': 'parallel_ready'})
+            typ, mesg = salvus.message_queue.next_mesg()
+            if mesg.get('event') != 'parallel_chunk':
+                break
+            for i in range(mesg['start'], mesg['stop']):
+                try:
+                    result = {
+                        'result':
+                        base64.b64encode(dumps(f(items[i]))).decode('ascii')
+                    }
+                except Exception:
+                    result = {'error': traceback.format_exc()}
+                # the output of an item comes before its result
+                sys.stdout.flush()
+                sys.stderr.flush()
+                salvus._send_pending_outputs(block=True)
+                result.update(event='parallel_result', index=i)
+                conn.send_json(result)
+    finally:
+        os._exit(0)
+
+
+def _parallel_results(f, items, ncpus=None, chunksize=None):
+    """
+    Generator of the pairs (i, f(items[i])), in the order in which they are
+    computed by ncpus forked workers.
+
+    The workers are forked from the session, so they share the items and
+    the loaded Sage library with it; only the indices of the items are
+    sent to them, in chunks of chunksize.  The output of f is passed on to
+    the cell as it appears.  The workers are killed when the generator is
+    closed, e.g., because the cell was interrupted or f raised an exception
+    (which is raised as a RuntimeError here).
+    """
+    import base64, selectors, socket
+    from sage.structure.sage_object import loads
+    n = len(items)
+    if not n:
+        return
+    ncpus = min(ncpus or fork_pool._limit(), n)
+    if not chunksize:
+        # a few chunks per worker, so that the work is spread evenly
+        chunksize = max(1, n // (4 * ncpus))
+    selector = selectors.DefaultSelector()
+    workers = []
+    start = 0
+    try:
+        for k in range(ncpus):
+            ours, theirs = socket.socketpair()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if not pid:
+                ours.close()
+                for w in workers:
+                    w.conn.close()
+                _parallel_worker(theirs, f, items)
+            theirs.close()
+            w = _ForkJob(pid, type(salvus._conn)(ours), salvus._conn,
+                         salvus.message_queue, None, None)
+            workers.append(w)
+            selector.register(w.conn, selectors.EVENT_READ, w)
+        while selector.get_map():
+            for key, _ in selector.select():
+                w = key.data
+                try:
+                    typ, mesg = w.conn.recv()
+                except Exception:
+                    selector.unregister(w.conn)
+                    w.close()
+                    os.waitpid(w.pid, 0)
+                    w.pid = None
+                    if not w.killed:
+                        raise RuntimeError("parallel worker died")
+                    continue
+                event = mesg.get('event') if typ == 'json' else None
+                if event == 'parallel_ready':
+                    if start < n:
+                        stop = min(start + chunksize, n)
+                        w.conn.send_json({
+                            'event': 'parallel_chunk',
+                            'start': start,
+                            'stop': stop
+                        })
+                        start = stop
+                    else:
+                        # it exits now
+                        w.killed = True
+                        w.conn.send_json({'event': 'parallel_stop'})
+                elif event == 'parallel_result':
+                    if 'error' in mesg:
+                        raise RuntimeError(
+                            "error computing item %s:\n%s" %
+                            (mesg['index'], mesg['error']))
+                    yield mesg['index'], loads(
+                        base64.b64decode(mesg['result']))
+                else:
+                    w.pass_on(typ, mesg)
+    finally:
+        for w in workers:
+            if w.pid is not None:
+                w.close()
+                try:
+                    os.kill(w.pid, 9)
+                    os.waitpid(w.pid, 0)
+                except OSError:
+                    pass
+        selector.close()
+
+
+def parallel_map(f, items, ncpus=None, chunksize=None, callback=None,
+                 progress=True):
+    """
+    Return the list [f(x) for x in items], computed in parallel by forked
+    copies of this session.
+
+    INPUT:
+
+    - ``f`` -- a function of one argument, whose results can be pickled
+
+    - ``items`` -- the arguments; an iterable
+
+    - ``ncpus`` -- number of workers (default: fork.max_parallel, which
+      is the number of cpus unless set otherwise)
+
+    - ``chunksize`` -- number of items a worker gets at once (default:
+      so that each worker gets about 4 chunks)
+
+    - ``callback`` -- if given, callback(x, f(x)) is called for each item
+      x as soon as its result arrives
+
+    - ``progress`` -- if True, print how many items are done every
+      PARALLEL_PROGRESS_INTERVAL seconds
+
+    The workers are forked from this session, so f and the items need not
+    be pickled and the Sage library is shared with them; anything f prints
+    appears in the cell while it runs.  Interrupting the cell kills all
+    workers.  If f raises an exception for some item, the workers are
+    killed and a RuntimeError with its traceback is raised.
+
+    EXAMPLES::
+
+        v = parallel_map(lambda n: factor(2^n - 1), range(150, 200))
+
+        parallel_map(is_prime, range(10^6, 10^6 + 10^4), chunksize=1000)
+    """
+    import time
+    from contextlib import closing
+    items = list(items)
+    results = [None] * len(items)
+    done = 0
+    last = time.time()
+    # close the generator (which kills the workers) right away if the loop
+    # ends early, e.g., because callback raised an exception, rather than
+    # whenever the generator happens to be collected
+    with closing(_parallel_results(f, items, ncpus, chunksize)) as pairs:
+        for i, result in pairs:
+            results[i] = result
+            done += 1
+            if callback is not None:
+                callback(items[i], result)
+            if progress and time.time() - last >= PARALLEL_PROGRESS_INTERVAL:
+                print("parallel_map: %s of %s done" % (done, len(items)))
+                last = time.time()
+    return results
+
+
+class Parallel(object):
+    """
+    The %parallel block decorator runs the iterations of the for loop in
+    the cell in parallel, by forked copies of this session (see
+    parallel_map), for example::
+
+        %parallel
+        for n in range(150, 200):
+            print(n, factor(2^n - 1))
+
+    The cell must contain exactly one for loop at the top level; code before
+    it is run first, as usual, and code after it once all iterations are
+    done.  The output of each iteration appears as soon as it is done, so
+    iterations may finish out of order.  As with %fork, variables set in
+    the loop are not set in the session.
+
+    Used in any other way, parallel is the @parallel decorator of Sage;
+    type "sage.all.parallel?" for its help.
+    """
+    def __call__(self, *args, **kwds):
+        s = args[0] if len(args) == 1 and not kwds else None
+        if not is_string(s) or s.strip() in ('fork', 'multiprocessing',
+                                             'reference'):
+            return sage.all.parallel(*args, **kwds)
+        self.run_loop(s)
+
+    def run_loop(self, code):
+        import ast
+        try:
+            from .sage_parsing import preparse_code
+        except:
+            from sage_parsing import preparse_code
+        tree = ast.parse(preparse_code(code))
+        loops = [
+            i for i, node in enumerate(tree.body)
+            if isinstance(node, ast.For)
+        ]
+        if len(loops) != 1 or tree.body[loops[0]].orelse:
+            raise ValueError(
+                "%parallel needs a cell with exactly one for loop at the top level (without else)"
+            )
+        i = loops[0]
+        loop = tree.body[i]
+        namespace = salvus.namespace
+
+        def run(body):
+            module = ast.Module(body=body, type_ignores=[])
+            exec(compile(ast.fix_missing_locations(module), '<%parallel>',
+                         'exec'), namespace)
+
+        run(tree.body[:i])
+        items = list(
+            eval(
+                compile(ast.Expression(body=loop.iter), '<%parallel>',
+                        'eval'), namespace))
+        # Each iteration is a loop over just its item, so that break and
+        # continue still work (though break only ends that iteration).
+        one = ast.copy_location(
+            ast.For(target=loop.target,
+                    iter=ast.List(elts=[
+                        ast.Name(id='_parallel_item_', ctx=ast.Load())
+                    ],
+                                  ctx=ast.Load()),
+                    body=loop.body,
+                    orelse=[]), loop)
+        one = compile(
+            ast.fix_missing_locations(ast.Module(body=[one], type_ignores=[])),
+            '<%parallel>', 'exec')
+
+        def iteration(item):
+            namespace['_parallel_item_'] = item
+            exec(one, namespace)
+
+        parallel_map(iteration, items, progress=False)
+        run(tree.body[i + 1:])
+
+
+parallel = Parallel()
+
 ####################################################
 # Display of 2d/3d graphics objects
 ####################################################
@@ -3319,7 +4099,8 @@ def _dynamic(var, control=None):
     def g(y):
         f.x = y
 
-    salvus.namespace.on('change', var, g)
+    # a loop assigning to var only updates the control every now and then
+    salvus.namespace.on('change', var, g, batch=True)
 
     if var in salvus.namespace:
         x = salvus.namespace[var]
@@ -4207,7 +4988,7 @@ def modes():
             mode_cmds.add('%' + k)
     mode_cmds.update([
         '%cython', '%time', '%auto', '%hide', '%hideall', '%fork', '%runfile',
-        '%default_mode', '%typeset_mode'
+        '%default_mode', '%typeset_mode', '%cell_stats'
     ])
     v = list(sorted(mode_cmds))
     return v
@@ -4419,24 +5200,21 @@ def which(pgm):
 
 try:
     from .sage_server import MAX_CODE_SIZE
+    from . import sage_index
 except:
     from sage_server import MAX_CODE_SIZE
+    import sage_index
 
 
-def search_src(str, max_chars=MAX_CODE_SIZE):
-    r"""
-    Get file names resulting from git grep of smc repo
-
-    INPUT:
-
-    - ``str`` -- string, expression to search for; will be quoted
-    - ``max_chars`` -- integer, max characters to display from selected file
-
-    OUTPUT:
-
-    Interact selector of matching filenames. Choosing one causes its
-    contents to be shown in salvus.code() output.
-    """
+def _sage_src_dir():
+    # /projects/sage/sage-x.y/src/sage
+    try:
+        import sage.env
+        sdir = os.path.join(sage.env.SAGE_SRC, 'sage')
+        if os.path.isdir(sdir):
+            return sdir
+    except (ImportError, AttributeError, TypeError):
+        pass
     sage_cmd = which("sage")
     if os.path.islink(sage_cmd):
         sage_cmd = os.readlink(sage_cmd)
@@ -4448,10 +5226,63 @@ def search_src(str, max_chars=MAX_CODE_SIZE):
     sdir = os.path.dirname(os.path.dirname(sdir))
 
     # /projects/sage/sage-x.y/src
-    sdir = glob.glob(sdir + "/src/sage")[0]
+    return glob.glob(sdir + "/src/sage")[0]
+
+
+def _sage_doc_dir():
+    # the built html documentation, if it is installed
+    try:
+        import sage.env
+        ddir = os.path.join(sage.env.SAGE_DOC, 'html')
+        if os.path.isdir(ddir):
+            return ddir
+    except (ImportError, AttributeError, TypeError):
+        pass
+    return None
+
+
+def _search_index(kind, root, query):
+    """
+    Return the search index of the given kind for root; if it does not
+    exist yet, start building it in the background and return None.
+    Also return None if the query is shorter than a trigram, since the
+    index would have to look at every file then.
+    """
+    if len(query.encode('utf-8')) < 3:
+        return None
+    index = sage_index.search_index(kind, root)
+    if index is None:
+        sage_index.build_search_index_in_background(kind, root)
+    return index
+
+
+def search_src(str, max_chars=MAX_CODE_SIZE):
+    r"""
+    Search the Sage library source code for a string, ignoring case.
 
-    cmd = 'cd %s;timeout 5 git grep -il "%s"' % (sdir, str)
-    srch = os.popen(cmd).read().splitlines()
+    The files are found using an index of the Sage sources, which is
+    built once per Sage version and shared by all worksheets; the files
+    with the most matches come first.  Until the index has been built
+    (which is started by the first search and takes a few minutes), and
+    for strings shorter than three characters, this uses ``git grep``.
+
+    INPUT:
+
+    - ``str`` -- string, expression to search for
+    - ``max_chars`` -- integer, max characters to display from selected file
+
+    OUTPUT:
+
+    Interact selector of matching filenames. Choosing one causes its
+    contents to be shown in salvus.code() output.
+    """
+    sdir = _sage_src_dir()
+    index = _search_index('src', sdir, str)
+    if index is not None:
+        srch = [name for _, name in index.search(str)]
+    else:
+        cmd = 'cd %s;timeout 5 git grep -il "%s"' % (sdir, str)
+        srch = os.popen(cmd).read().splitlines()
     header = "files matched"
     nftext = header + ": %s" % len(srch)
 
@@ -4464,22 +5295,59 @@ def search_src(str, max_chars=MAX_CODE_SIZE):
 
 
 # search_doc
-def search_doc(str):
+def search_doc(str, max_results=20):
     r"""
-    Create link to Google search of sage docs.
+    Search the Sage documentation for a string, ignoring case.
+
+    If the html documentation is installed, the pages with the most
+    matches are listed with their title, an excerpt and a link to the
+    same page on doc.sagemath.org.  Like search_src, this uses an index
+    that is built once per Sage version; until it exists, for strings
+    shorter than three characters, or if the documentation is not
+    installed, a link to a Google search of the Sage documentation is
+    shown instead.
 
     INPUT:
 
-    - ``str`` -- string, expression to search for; will be quoted
+    - ``str`` -- string, expression to search for
+    - ``max_results`` -- integer, the number of pages to list
 
     OUTPUT:
 
-    HTML hyperlink to google search
+    HTML list of matching pages, or a hyperlink to a Google search
     """
-    txt = 'Use this link to search: ' + \
-    '<a href="https://www.google.com/search?q=site%3Adoc.sagemath.org+' + \
-    str + '&oq=site%3Adoc.sagemath.org">'+str+'</a>'
-    salvus.html(txt)
+    ddir = _sage_doc_dir()
+    index = _search_index('doc', ddir,
+                          str) if ddir is not None else None
+    if index is None:
+        txt = 'Use this link to search: ' + \
+        '<a href="https://www.google.com/search?q=site%3Adoc.sagemath.org+' + \
+        str + '&oq=site%3Adoc.sagemath.org">'+str+'</a>'
+        salvus.html(txt)
+        return
+    try:
+        from html import escape, unescape
+    except ImportError:  # Python 2
+        from cgi import escape
+        unescape = six.moves.html_parser.HTMLParser().unescape
+    results = index.search(str)
+    items = []
+    for _, name in results[:max_results]:
+        with open(os.path.join(ddir, name), 'rb') as f:
+            page = f.read(sage_index.MAX_INDEXED_FILE_SIZE).decode(
+                'utf-8', 'replace')
+        m = re.search(r'<title>(.*?)</title>', page, re.S | re.I)
+        title = m.group(1).strip() if m else name
+        text = ' '.join(re.sub(r'<[^>]*>', ' ', page).split())
+        text = unescape(text)
+        i = text.lower().find(str.lower())
+        excerpt = text[max(0, i - 80):i + len(str) + 80] if i != -1 else ''
+        items.append(
+            '<li><a href="https://doc.sagemath.org/html/%s" target="_blank">%s</a>'
+            '<br><small>%s</small></li>' %
+            (name, title, escape(excerpt)))
+    salvus.html('<b>%s pages of the documentation match "%s"</b><ol>%s</ol>' %
+                (len(results), escape(str), ''.join(items)))
 
 
 import sage.misc.session
@@ -57,27 +57,151 @@ def unicode8(s):
 
 LOGFILE = os.path.realpath(__file__)[:-3] + ".log"
 PID = os.getpid()
-from datetime import datetime
 
+# Log levels.  Messages below LOG_LEVEL are dropped before they are formatted;
+# per-message tracing is logged at DEBUG, so it is off by default.
+LOG_DEBUG, LOG_INFO, LOG_WARNING, LOG_ERROR = 10, 20, 30, 40
+LOG_LEVELS = {
+    'DEBUG': LOG_DEBUG,
+    'INFO': LOG_INFO,
+    'WARNING': LOG_WARNING,
+    'ERROR': LOG_ERROR
+}
+LOG_LEVEL = LOG_LEVELS.get(
+    os.environ.get('COCALC_SAGE_SERVER_LOG_LEVEL', 'INFO').upper(), LOG_INFO)
+# Log messages are buffered in memory and written out once this many are
+# pending, once the oldest is LOG_FLUSH_INTERVAL seconds old, and whenever the
+# process is about to block waiting for a message.
+LOG_BUFFER_SIZE = 256
+LOG_FLUSH_INTERVAL = 1.0
+# When the log file grows beyond this many bytes it is renamed to LOGFILE + '.1'
+# (replacing the previous one) and a fresh file is started.
+LOG_MAX_BYTES = 32 * 1024 * 1024
+
+
+class Logger(object):
+    """
+    Buffered writer for the sage_server log file.
 
-def log(*args):
-    try:
-        debug_log = open(LOGFILE, 'a')
-        from sys import version_info
-        if version_info >= (3, 12):
-            from datetime import UTC
-            d = datetime.now(UTC)
-        else:
-            d = datetime.utcnow()
-        d_txt = d.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+    The file is kept open in append mode, so the forking server, its
+    children and the warm pool can all share it.  After a fork the child
+    discards whatever it inherited in the buffer -- the parent writes those
+    lines itself -- and the file is reopened whenever LOGFILE is changed or
+    the file was rotated by another process.
+
+    Lines may be written by the reader thread of a session while the main
+    thread logs too, so the buffer is only changed by appending to and
+    popping from the deque, which are atomic.
+    """
+    def __init__(self):
+        from collections import deque
+        self._entries = deque()  # (time, level, args)
+        self._oldest = None  # time of the oldest buffered entry
+        self._pid = os.getpid()
+        self._path = None
+        self._fd = None
+
+    def write(self, level, args):
+        if level < LOG_LEVEL:
+            return
+        pid = os.getpid()
+        if pid != self._pid:
+            # forked -- the buffered lines belong to the parent
+            self._pid = pid
+            self._entries.clear()
+            self._oldest = None
+        t = time.time()
+        self._entries.append((t, level, args))
+        if self._oldest is None:
+            self._oldest = t
+        if (level >= LOG_WARNING or len(self._entries) >= LOG_BUFFER_SIZE
+                or t - self._oldest >= LOG_FLUSH_INTERVAL):
+            self.flush()
+
+    def _format(self, entry):
+        t, level, args = entry
+        d_txt = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(t))
         args_str = ' '.join([unicode8(x) for x in args])
-        mesg = "%s (%s): %s\n" % (PID, d_txt, args_str)
-        debug_log.write(mesg)
-        debug_log.flush()
-    except Exception as err:
-        print(("an error writing a log message (ignoring) -- %s" % err, args))
+        return "%s (%s.%03d): %s\n" % (self._pid, d_txt, int(t * 1000) % 1000,
+                                       args_str)
+
+    def _open(self):
+        if self._fd is not None:
+            if self._path == LOGFILE:
+                try:
+                    if os.stat(LOGFILE).st_ino == os.fstat(self._fd).st_ino:
+                        return self._fd
+                except OSError:
+                    pass
+            os.close(self._fd)
+            self._fd = None
+        self._path = LOGFILE
+        self._fd = os.open(LOGFILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                           0o644)
+        return self._fd
+
+    def _rotate(self):
+        try:
+            os.rename(self._path, self._path + '.1')
+        except OSError:
+            pass
+        os.close(self._fd)
+        self._fd = None
+
+    def flush(self):
+        if not self._entries:
+            return
+        self._oldest = None
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self._entries.clear()
+            return
+        entries = []
+        try:
+            while True:
+                entries.append(self._entries.popleft())
+        except IndexError:
+            pass
+        if not entries:
+            return
+        try:
+            data = ''.join([self._format(e) for e in entries])
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8', 'replace')
+            fd = self._open()
+            while data:
+                data = data[os.write(fd, data):]
+            if os.fstat(fd).st_size > LOG_MAX_BYTES:
+                self._rotate()
+        except Exception as err:
+            print(("an error writing a log message (ignoring) -- %s" % err,
+                   entries))
+
+    def close(self):
+        self.flush()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+logger = Logger()
+
+
+def log(*args):
+    logger.write(LOG_INFO, args)
+
+
+def log_debug(*args):
+    logger.write(LOG_DEBUG, args)
+
+
+def log_warning(*args):
+    logger.write(LOG_WARNING, args)
 
 
+import atexit
+atexit.register(logger.flush)
+
 # used for clearing pylab figure
 pylab = None
 
@@ -91,18 +215,109 @@ MAX_STDOUT_SIZE = MAX_STDERR_SIZE = MAX_CODE_SIZE = MAX_HTML_SIZE = MAX_MD_SIZE
 
 MAX_OUTPUT = 150000
 
+# Output that comes after a file whose blob the hub has not saved yet is queued,
+# so that many files can be saved in parallel.  Once more than this many output
+# messages are queued, the cell waits for the hub.
+MAX_PENDING_OUTPUTS = 64
+
 # Standard imports.
 import json, resource, shutil, signal, socket, struct, \
-       tempfile, time, traceback, pwd, re
+       tempfile, time, traceback, types, pwd, re
 
 # for "3x^2 + 4xy - 5(1+x) - 3 abc4ok", this pattern matches "3x", "5(" and "4xy" but not "abc4ok"
 # to understand it, see https://regex101.com/ or https://www.debuggex.com/
 RE_POSSIBLE_IMPLICIT_MUL = re.compile(r'(?:(?<=[^a-zA-Z])|^)(\d+[a-zA-Z\(]+)')
 
+# If true, importing the Sage library (via sage_salvus below) and
+# init_library() are timed per module, and the IMPORT_PROFILE_TOP slowest
+# imports are logged once the server is ready.  Set
+# COCALC_SAGE_SERVER_IMPORT_PROFILE=1 (or use --import-profile) to turn this on.
+IMPORT_PROFILE = (os.environ.get('COCALC_SAGE_SERVER_IMPORT_PROFILE') == '1'
+                  or __name__ == '__main__' and '--import-profile' in sys.argv)
+IMPORT_PROFILE_TOP = 25
+
+
+class ImportProfiler(object):
+    """
+    Records how long each module takes to import, by wrapping the builtin
+    __import__ between start() and stop().
+
+    For every module that is actually loaded (i.e., not already in
+    sys.modules) times[name] is [cumulative, self] seconds, where the self
+    time excludes the imports of other modules done while loading it.
+    """
+    def __init__(self):
+        self.times = {}
+        self.total = 0
+        self._stack = []  # time spent in nested imports, per active import
+        self._import = None
+        self._started = None
+
+    def start(self):
+        if self._import is not None:
+            return
+        self._import = six.moves.builtins.__import__
+        self._started = time.time()
+        six.moves.builtins.__import__ = self._profiled_import
+
+    def stop(self):
+        if self._import is None:
+            return
+        six.moves.builtins.__import__ = self._import
+        self._import = None
+        self.total += time.time() - self._started
+
+    def _profiled_import(self,
+                         name,
+                         globals=None,
+                         locals=None,
+                         fromlist=(),
+                         level=0):
+        module = name
+        if level > 0:
+            # a relative import -- resolve it the way importlib does
+            package = (globals or {}).get('__package__') or ''
+            base = package.rsplit('.', level - 1)[0]
+            module = '%s.%s' % (base, name) if name else base
+        if module in sys.modules:
+            return self._import(name, globals, locals, fromlist, level)
+        self._stack.append(0)
+        t = time.time()
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.time() - t
+            nested = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += elapsed
+            v = self.times.setdefault(module, [0, 0])
+            v[0] += elapsed
+            v[1] += elapsed - nested
+
+    def report(self, n=None):
+        """
+        Table of the n (default: all) modules with the largest cumulative
+        import time.
+        """
+        v = sorted(six.iteritems(self.times), key=lambda x: -x[1][0])
+        if n is not None:
+            v = v[:n]
+        lines = ['%10s %10s  %s' % ('cumulative', 'self', 'module')]
+        for name, (cumulative, self_time) in v:
+            lines.append('%10.3f %10.3f  %s' % (cumulative, self_time, name))
+        lines.append('%d modules imported in %.3f seconds' %
+                     (len(self.times), self.total))
+        return '\n'.join(lines)
+
+
+import_profile = ImportProfiler()
+if IMPORT_PROFILE:
+    import_profile.start()
+
 try:
-    from . import sage_parsing, sage_salvus
+    from . import sage_parsing, sage_salvus, sage_index
 except:
-    import sage_parsing, sage_salvus
+    import sage_parsing, sage_salvus, sage_index
 
 uuid = sage_salvus.uuid
 
@@ -167,7 +382,28 @@ import hashlib
 def uuidsha1(data):
     sha1sum = hashlib.sha1()
     sha1sum.update(data)
-    s = sha1sum.hexdigest()
+    return _sha1_to_uuid(sha1sum.hexdigest())
+
+
+def uuidsha1_file(f, size, chunk_size):
+    """
+    Same as uuidsha1(f.read(size)), but reading the file object f in chunks,
+    so memory usage does not depend on the size of the file.
+    """
+    sha1sum = hashlib.sha1()
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    remaining = size
+    while remaining > 0:
+        n = f.readinto(view[:min(chunk_size, remaining)])
+        if not n:
+            break
+        sha1sum.update(view[:n])
+        remaining -= n
+    return _sha1_to_uuid(sha1sum.hexdigest())
+
+
+def _sha1_to_uuid(s):
     t = 'xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx'
     r = list(t)
     j = 0
@@ -182,97 +418,326 @@ def uuidsha1(data):
     return ''.join(r)
 
 
+# Files are hashed and sent as blobs in chunks of this many bytes.
+BLOB_CHUNK_SIZE = 1 << 20
+
+# msgpack is optional; without it, sessions always use JSON.
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Encodings of control messages, in order of preference.  A client may list
+# the encodings it understands in start_session (as 'encodings'); the session
+# then uses the first of these that the client supports, which is announced
+# as 'encoding' in session_description.  Clients that do not ask get JSON.
+ENCODINGS = (['msgpack'] if msgpack is not None else []) + ['json']
+
+
+def choose_encoding(encodings):
+    if encodings:
+        for encoding in ENCODINGS:
+            if encoding in encodings:
+                return encoding
+    return 'json'
+
+
+# json.dumps builds a new encoder for every call that passes options.
+_json_encoder = json.JSONEncoder(separators=(',', ':'))
+
+
 # A tcp connection with support for sending various types of messages, especially JSON.
+#
+# Each message is a frame consisting of a 4 byte big endian length header
+# followed by the payload, whose first byte is the message type ('j' for JSON,
+# 'm' for msgpack, 'b' for a blob, which starts with the 36 character uuidsha1
+# of its content).  Messages are sent as JSON unless the session negotiated
+# msgpack and set ``encoding``; either kind is accepted when receiving.
 class ConnectionJSON(object):
 
+    # Frames up to this size are received into a buffer that is reused for
+    # every message; larger frames get a buffer of their own, which is freed
+    # once the message has been handled.
+    RECV_BUFFER_SIZE = 1 << 20
+
     def __init__(self, conn):
         # avoid common mistake -- conn is supposed to be from socket.socket...
         assert not isinstance(conn, ConnectionJSON)
         self._conn = conn
+        self._buf = bytearray(4096)
+        self._header = bytearray(4)
+        self.encoding = 'json'
+        self._lock = None
+        self._lock_pid = None
+        # frames sent while send_file is in the middle of a blob frame
+        self._deferred = None
 
     def close(self):
         self._conn.close()
 
-    def _send(self, s):
-        if six.PY3 and type(s) == str:
-            s = s.encode('utf8')
-        length_header = struct.pack(">L", len(s))
-        # py3: TypeError: can't concat str to bytes
-        self._conn.send(length_header + s)
+    def fileno(self):
+        return self._conn.fileno()
+
+    def _sendall(self, parts):
+        """
+        Send the list of bytes-like objects parts, without concatenating
+        them, using scatter/gather I/O where available.
+        """
+        if not hasattr(self._conn, 'sendmsg'):
+            self._conn.sendall(six.b('').join(parts))
+            return
+        parts = [memoryview(x) for x in parts if len(x)]
+        while parts:
+            n = self._conn.sendmsg(parts)
+            # drop the parts that were completely sent, and the sent part of the next one
+            while parts and n >= len(parts[0]):
+                n -= len(parts[0])
+                parts.pop(0)
+            if n:
+                parts[0] = parts[0][n:]
+
+    def _send_lock(self):
+        """
+        Lock that is held while a frame is being sent, since a session's
+        reader thread sends replies while the main thread sends output.  A
+        lock inherited through fork() is replaced, as the thread holding it
+        does not exist in the child.
+        """
+        pid = os.getpid()
+        if self._lock_pid != pid:
+            import threading
+            self._lock = threading.RLock()
+            self._lock_pid = pid
+        return self._lock
+
+    def _send(self, *parts):
+        parts = [
+            x.encode('utf8') if six.PY3 and type(x) == str else x
+            for x in parts
+        ]
+        length_header = struct.pack(">L", sum(len(x) for x in parts))
+        with self._send_lock():
+            if self._deferred is not None:
+                # only the thread that is sending a file gets here, e.g., when
+                # its progress callback prints; send this once the file is sent
+                self._deferred.append([length_header] +
+                                      [bytes(x) for x in parts])
+                return
+            self._sendall([length_header] + parts)
 
     def send_json(self, m):
-        m = json.dumps(m)
+        if self.encoding == 'msgpack':
+            # NULL characters are only checked for in the JSON encoding;
+            # clients that negotiate msgpack have to reject them themselves.
+            m = msgpack.packb(m, use_bin_type=True)
+            if LOG_LEVEL <= LOG_DEBUG:
+                log_debug("sending msgpack message of %s bytes" % len(m))
+            self._send(six.b('m'), m)
+            return len(m)
+        m = _json_encoder.encode(m)
         if '\\u0000' in m:
             raise RuntimeError("NULL bytes not allowed")
-        log("sending message '", truncate_text(m, 256), "'")
-        self._send('j' + m)
+        if LOG_LEVEL <= LOG_DEBUG:
+            log_debug("sending message '", truncate_text(m, 256), "'")
+        self._send('j', m)
         return len(m)
 
-    def send_blob(self, blob):
+    def send_blob(self, blob, known=None):
+        """
+        Send the blob and return its uuid.  If known (a KnownBlobs
+        instance) is given and the hub already has the blob, nothing is sent.
+        """
         if six.PY3 and type(blob) == str:
             # unicode objects must be encoded before hashing
             blob = blob.encode('utf8')
 
         s = uuidsha1(blob)
-        if six.PY3 and type(blob) == bytes:
-            # we convert all to bytes first, to avoid unnecessary conversions
-            self._send(('b' + s).encode('utf8') + blob)
-        else:
-            # old sage py2 code
-            self._send('b' + s + blob)
+        if known is not None and s in known:
+            log_debug("not sending blob %s -- hub already has it" % s)
+            return s
+        # the blob itself is passed on as is, so large blobs are not copied
+        self._send('b' + s, blob)
         return s
 
-    def send_file(self, filename):
-        log("sending file '%s'" % filename)
-        f = open(filename, 'rb')
-        data = f.read()
-        f.close()
-        return self.send_blob(data)
-
-    def _recv(self, n):
-        #print("_recv(%s)"%n)
-        # see http://stackoverflow.com/questions/3016369/catching-blocking-sigint-during-system-call
-        for i in range(20):
-            try:
-                #print "blocking recv (i = %s), pid=%s"%(i, os.getpid())
-                r = self._conn.recv(n)
-                #log("n=%s; received: '%s' of len %s"%(n,r, len(r)))
-                return r
-            except OSError as e:
-                #print("socket.error, msg=%s"%msg)
-                if e.errno != 4:
-                    raise
-        raise EOFError
+    def send_file(self, filename, progress=None, known=None):
+        """
+        Send the contents of the file as a blob and return its uuid.
+        See upload_file.
+        """
+        return self.upload_file(filename, progress=progress, known=known)[0]
 
-    def recv(self):
-        n = self._recv(4)
-        if len(n) < 4:
-            raise EOFError
-        n = struct.unpack('>L', n)[0]  # big endian 32 bits
-        s = self._recv(n)
-        while len(s) < n:
-            t = self._recv(n - len(s))
-            if len(t) == 0:
+    def upload_file(self, filename, progress=None, known=None):
+        """
+        Send the contents of the file as a blob and return (uuid, mesg),
+        where mesg is the save_blob message the hub sent for the same
+        content earlier if nothing was sent, and None otherwise.
+
+        The file is hashed and then streamed to the socket in chunks of
+        BLOB_CHUNK_SIZE bytes (using sendfile where available), so memory
+        usage does not grow with the size of the file.  If progress is
+        given, progress(bytes_sent, total_bytes) is called after each chunk;
+        any message it sends on this connection is held back and sent right
+        after the file, so that it does not end up inside the blob.
+        If known (a KnownBlobs instance) is given and the hub already has
+        the content, nothing is sent.
+        """
+        log_debug("sending file '%s'" % filename)
+        with open(filename, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            s = uuidsha1_file(f, size, BLOB_CHUNK_SIZE)
+            mesg = known.get(s) if known is not None else None
+            if mesg is not None:
+                log_debug("not sending file %s -- hub already has it" % s)
+                return s, mesg
+            head = ('b' + s).encode('utf8')
+            f.seek(0)
+            sent = 0
+            error = None
+            with self._send_lock():
+                self._sendall([struct.pack(">L", len(head) + size), head])
+                self._deferred = []
+                try:
+                    while sent < size:
+                        n = min(BLOB_CHUNK_SIZE, size - sent)
+                        if hasattr(self._conn, 'sendfile'):
+                            n = self._conn.sendfile(f, sent, n)
+                        else:
+                            data = f.read(n)
+                            self._conn.sendall(data)
+                            n = len(data)
+                        if not n:
+                            # The file shrank while we were sending it.  Pad the
+                            # frame so that the connection stays usable, then complain.
+                            self._conn.sendall(six.b('\0') * (size - sent))
+                            raise RuntimeError(
+                                "file '%s' changed while sending it" %
+                                filename)
+                        sent += n
+                        if progress is not None:
+                            try:
+                                progress(sent, size)
+                            except BaseException:
+                                # e.g., an interrupt; finish the frame first
+                                error = sys.exc_info()
+                                progress = None
+                finally:
+                    deferred, self._deferred = self._deferred, None
+                    for parts in deferred:
+                        self._sendall(parts)
+        if error is not None:
+            six.reraise(*error)
+        return s, None
+
+    def _recv_into(self, buf, n):
+        """
+        Fill the first n bytes of the memoryview buf from the connection.
+        """
+        received = 0
+        while received < n:
+            # see http://stackoverflow.com/questions/3016369/catching-blocking-sigint-during-system-call
+            for i in range(20):
+                try:
+                    r = self._conn.recv_into(buf[received:n], n - received)
+                    break
+                except OSError as e:
+                    if e.errno != 4:
+                        raise
+            else:
                 raise EOFError
-            s += t
-
-        if six.PY3:
-            # bystream to string, in particular s[0] will be e.g. 'j' and not 106
-            #log("ConnectionJSON::recv s=%s... (type %s)" % (s[:5], type(s)))
-            # is s always of type bytes?
-            if type(s) == bytes:
-                s = s.decode('utf8')
+            if r == 0:
+                raise EOFError
+            received += r
 
-        if s[0] == 'j':
+    def recv(self):
+        logger.flush()  # about to block waiting for the next message
+        self._recv_into(memoryview(self._header), 4)
+        n = struct.unpack('>L', bytes(self._header))[0]  # big endian 32 bits
+        if n == 0:
+            raise ValueError("empty message")
+        if n <= len(self._buf):
+            buf = self._buf
+        elif n <= self.RECV_BUFFER_SIZE:
+            buf = self._buf = bytearray(max(n, 2 * len(self._buf)))
+        else:
+            buf = bytearray(n)
+        view = memoryview(buf)
+        self._recv_into(view, n)
+
+        typ = view[:1].tobytes()
+        if typ == six.b('j'):
+            # decode straight out of the receive buffer
+            s = str(view[1:n], 'utf8') if six.PY3 else view[1:n].tobytes()
             try:
-                return 'json', json.loads(s[1:])
+                return 'json', json.loads(s)
             except Exception as msg:
-                log("Unable to parse JSON '%s'" % s[1:])
+                log("Unable to parse JSON '%s'" % s)
                 raise
 
-        elif s[0] == 'b':
-            return 'blob', s[1:]
-        raise ValueError("unknown message type '%s'" % s[0])
+        elif typ == six.b('m') and msgpack is not None:
+            return 'json', msgpack.unpackb(view[1:n], raw=False)
+
+        elif typ == six.b('b'):
+            # blobs are returned as bytes -- they need not be valid utf8
+            return 'blob', view[1:n].tobytes()
+        raise ValueError("unknown message type '%s'" % typ)
+
+
+class KnownBlobs(object):
+    """
+    LRU cache of the uuids of blobs that the hub acknowledged saving, so
+    that sending identical content again (e.g., when re-running a plotting
+    cell) can be skipped.
+
+    A blob is only trusted for a fraction ttl_fraction of the ttl given in
+    the save_blob message; a ttl of 0 means the blob is stored permanently.
+    """
+
+    def __init__(self, max_size=1024, ttl_fraction=0.5):
+        from collections import OrderedDict
+        self.max_size = max_size
+        self.ttl_fraction = ttl_fraction
+        self._blobs = OrderedDict()  # uuid --> (expire time or None, mesg)
+
+    def __len__(self):
+        return len(self._blobs)
+
+    def add(self, mesg):
+        """
+        Record the save_blob message mesg from the hub.
+        """
+        if 'error' in mesg or not mesg.get('sha1'):
+            return
+        ttl = mesg.get('ttl', 0) or 0
+        expire = time.time() + self.ttl_fraction * ttl if ttl else None
+        uuid = mesg['sha1']
+        self._blobs.pop(uuid, None)
+        self._blobs[uuid] = (expire, mesg)
+        while len(self._blobs) > self.max_size:
+            self._blobs.popitem(last=False)
+
+    def get(self, uuid):
+        """
+        Return the save_blob message for the blob with given uuid, or None
+        if it is not known (anymore).
+        """
+        x = self._blobs.pop(uuid, None)
+        if x is None:
+            return None
+        expire, mesg = x
+        if expire is not None and time.time() >= expire:
+            return None
+        self._blobs[uuid] = x
+        return mesg
+
+    def __contains__(self, uuid):
+        return self.get(uuid) is not None
+
+    def clear(self):
+        self._blobs.clear()
+
+
+# blobs this session already sent to the hub
+known_blobs = KnownBlobs()
 
 
 def truncate_text(s, max_size):
@@ -318,15 +783,33 @@ class Message(object):
                 m[key] = val
         return m
 
-    def start_session(self):
-        return self._new('start_session')
+    def start_session(self, encodings=None):
+        m = self._new('start_session')
+        if encodings:
+            m['encodings'] = encodings
+        return m
 
-    def session_description(self, pid):
-        return self._new('session_description', {'pid': pid})
+    def session_description(self, pid, encoding=None):
+        m = self._new('session_description', {'pid': pid})
+        if encoding is not None:
+            m['encoding'] = encoding
+        return m
 
     def send_signal(self, pid, signal=signal.SIGINT):
         return self._new('send_signal', locals())
 
+    def server_status(self, **status):
+        return self._new('server_status', status)
+
+    def lease_kernel(self, kernel_name, pid, cwd=None):
+        return self._new('lease_kernel', locals())
+
+    def kernel_lease(self, connection_info=None, error=None):
+        m = self._new('kernel_lease', {'connection_info': connection_info})
+        if error is not None:
+            m['error'] = error
+        return m
+
     def terminate_session(self, done=True):
         return self._new('terminate_session', locals())
 
@@ -431,14 +914,65 @@ message = Message()
 whoami = os.environ['USER']
 
 
+def server_request(port, mesg, hostname='localhost', timeout=None):
+    """
+    Send mesg as the first message of a new connection to the sage server
+    listening on port, and return its reply.
+    """
+    conn = socket.create_connection((hostname, int(port)), timeout)
+    try:
+        conn.sendall(six.b(load_secret_token()))
+        if conn.recv(1) != six.b('y'):
+            raise RuntimeError("the sage server refused the secret token")
+        conn = ConnectionJSON(conn)
+        conn.send_json(mesg)
+        return conn.recv()[1]
+    finally:
+        conn.close()
+
+
+def server_status(port, hostname='localhost'):
+    """
+    Return the server_status message of the sage server listening on port:
+    the number of running and queued sessions, their resource usage, and
+    that of recently finished sessions.
+    """
+    return server_request(port, message.server_status(), hostname)
+
+
+def lease_jupyter_kernel(kernel_name):
+    """
+    Called in a session: ask the server that forked it for one of its spare
+    Jupyter kernels called kernel_name, running in the current directory
+    (see JupyterKernelPool).  Returns the connection info of the kernel,
+    which belongs to the session until it ends, or None if the server has
+    no such kernel ready.
+    """
+    if server_address is None or JUPYTER_POOL_SIZE <= 0:
+        return None
+    try:
+        mesg = server_request(server_address[1],
+                              message.lease_kernel(kernel_name, os.getpid(),
+                                                   os.getcwd()),
+                              hostname=server_address[0],
+                              timeout=10)
+    except Exception as err:
+        log("unable to lease a %s kernel -- %s" % (kernel_name, err))
+        return None
+    if mesg.get('error'):
+        log("no %s kernel leased -- %s" % (kernel_name, mesg['error']))
+    return mesg.get('connection_info')
+
+
 def client1(port, hostname):
     conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     conn.connect((hostname, int(port)))
     conn = ConnectionJSON(conn)
 
-    conn.send_json(message.start_session())
+    conn.send_json(message.start_session(encodings=ENCODINGS))
     typ, mesg = conn.recv()
     pid = mesg['pid']
+    conn.encoding = mesg.get('encoding', 'json')
     print(("PID = %s" % pid))
 
     id = 0
@@ -476,18 +1010,115 @@ def client1(port, hostname):
     print("\nExiting Sage client.")
 
 
-class BufferedOutputStream(object):
-
-    def __init__(self, f, flush_size=4096, flush_interval=.1):
-        self._f = f
-        self._buf = ''
+class OutputChannel(object):
+    """
+    Coalesces the stdout and stderr text of a cell into as few output
+    messages as possible.
+
+    Consecutive writes to the same stream are joined and sent as a single
+    message once ``flush_size`` characters are pending or the flush interval
+    has passed; switching between stdout and stderr sends what is pending
+    first, so the order is kept.  The interval doubles for every
+    ``messages_per_step`` messages the cell has sent, so that a loop printing
+    progress does not quickly run into MAX_OUTPUT_MESSAGES, and it also
+    doubles while the connection to the hub is not writable, i.e., the hub
+    is not keeping up.  It never exceeds ``max_flush_interval``, so output
+    still appears promptly.
+
+    Text longer than MAX_STDOUT_SIZE (or MAX_STDERR_SIZE), e.g., from a
+    single large write, is sent in several messages instead of being
+    truncated.
+    """
+    def __init__(self,
+                 salvus,
+                 flush_size=16384,
+                 flush_interval=.1,
+                 max_flush_interval=.4,
+                 messages_per_step=32):
+        from . import sage_server
+        # the module users customize MAX_STDOUT_SIZE etc. in (see smc?)
+        self._limits = sage_server
+        self._salvus = salvus
         self._flush_size = flush_size
         self._flush_interval = flush_interval
+        self._max_flush_interval = max_flush_interval
+        self._messages_per_step = messages_per_step
+        self._backoff = 1
+        self._kind = None
+        self._parts = []
+        self._size = 0
         self.reset()
 
     def reset(self):
         self._last_flush_time = time.time()
 
+    def pending(self):
+        return self._size
+
+    def write(self, kind, output):
+        if kind != self._kind:
+            self.flush()
+            self._kind = kind
+        self._parts.append(output)
+        self._size += len(output)
+        if self._size >= min(self._flush_size, self._max_size()):
+            self.flush()
+            return
+        t = time.time()
+        if t - self._last_flush_time >= self._interval():
+            if self._writable():
+                self._backoff = 1
+                self.flush()
+            else:
+                # the hub has not read what we sent last; keep collecting
+                self._backoff = min(2 * self._backoff, 64)
+                self._last_flush_time = t
+
+    def _max_size(self):
+        return min(self._limits.MAX_STDOUT_SIZE, self._limits.MAX_STDERR_SIZE)
+
+    def _interval(self):
+        steps = self._salvus._num_output_messages // self._messages_per_step
+        return min(self._flush_interval * self._backoff * 2**min(steps, 16),
+                   self._max_flush_interval)
+
+    def _writable(self):
+        import select
+        try:
+            return bool(select.select([], [self._salvus._conn], [], 0)[1])
+        except (ValueError, select.error):
+            return True
+
+    def flush(self, done=False):
+        if not self._size and not done:
+            # no point in sending an empty message
+            return
+        output = ''.join(self._parts)
+        kind = self._kind or 'stdout'
+        self._parts = []
+        self._size = 0
+        self._last_flush_time = time.time()
+        n = max(1, self._max_size())
+        chunks = [output[i:i + n] for i in range(0, len(output), n)] or ['']
+        for chunk in chunks[:-1]:
+            self._salvus._send_output(id=self._salvus._id, **{kind: chunk})
+        self._salvus._send_output(id=self._salvus._id,
+                                  done=done,
+                                  **{kind: chunks[-1]})
+
+
+class BufferedOutputStream(object):
+    """
+    File-like object replacing sys.stdout or sys.stderr while a cell runs;
+    the text written to it goes to the given OutputChannel.
+    """
+    def __init__(self, channel, kind):
+        self._channel = channel
+        self._kind = kind
+
+    def reset(self):
+        self._channel.reset()
+
     def fileno(self):
         return 0
 
@@ -497,69 +1128,132 @@ class BufferedOutputStream(object):
         # is destined to be *rendered* in the browser.  This is only a partial
         # solution to a more general problem, but it is safe.
         try:
-            self._buf += output.replace('\x00', '')
+            output = output.replace('\x00', '')
+            if six.PY2 and isinstance(output, str):
+                output = output.decode('utf-8')
         except UnicodeDecodeError:
-            self._buf += output.decode('utf-8').replace('\x00', '')
-        #self.flush()
-        t = time.time()
-        if ((len(self._buf) >= self._flush_size)
-                or (t - self._last_flush_time >= self._flush_interval)):
-            self.flush()
-            self._last_flush_time = t
+            output = output.decode('utf-8', 'replace')
+        self._channel.write(self._kind, output)
 
     def flush(self, done=False):
-        if not self._buf and not done:
-            # no point in sending an empty message
-            return
-        try:
-            self._f(self._buf, done=done)
-        except UnicodeDecodeError:
-            if six.PY2:  # str doesn't have errors option in python2!
-                self._f(unicode(self._buf, errors='replace'), done=done)
-            else:
-                self._f(str(self._buf, errors='replace'), done=done)
-        self._buf = ''
+        self._channel.flush(done=done)
 
     def isatty(self):
         return False
 
 
-# This will *have* to be re-done using Cython for speed.
-class Namespace(dict):
+# Changes of variables that listeners registered with batch=True are
+# delivered at most this often (in seconds) while a block runs, and at the
+# end of every block.
+NAMESPACE_BATCH_INTERVAL = 0.1
+
 
+class Namespace(dict):
+    """
+    The global namespace of the worksheet, which can notify listeners
+    registered with on() when variables are changed or deleted.
+
+    While there are no listeners, item assignment only counts the names that
+    are added or deleted in changes (which TAB completion uses to tell when
+    its sorted list of global names is stale), so storing globals in user
+    code costs little more than with a plain dict.  on() turns the instance
+    into an ObservedNamespace, and it turns back once the last listener is
+    removed.
+    """
     def __init__(self, x):
+        self.changes = 0
         self._on_change = {}
         self._on_del = {}
+        self._on_change_batched = {}
+        self._pending = {}  # variable --> latest value, for batched listeners
+        self._last_delivery = 0
         dict.__init__(self, x)
 
-    def on(self, event, x, f):
+    def _listeners(self, event, batch=False):
         if event == 'change':
-            if x not in self._on_change:
-                self._on_change[x] = []
-            self._on_change[x].append(f)
+            return self._on_change_batched if batch else self._on_change
         elif event == 'del':
-            if x not in self._on_del:
-                self._on_del[x] = []
-            self._on_del[x].append(f)
+            return self._on_del
+        raise ValueError("unknown event '%s'" % event)
+
+    def __setitem__(self, x, y):
+        if x not in self:
+            self.changes += 1
+        dict.__setitem__(self, x, y)
+
+    def __delitem__(self, x):
+        self.changes += 1
+        dict.__delitem__(self, x)
+
+    def _update_class(self):
+        if self._on_change or self._on_del or self._on_change_batched:
+            self.__class__ = ObservedNamespace
+        else:
+            self.__class__ = Namespace
+
+    def on(self, event, x, f, batch=False):
+        """
+        Call f(y) whenever the variable x is set to y (event='change') or
+        f() when it is deleted (event='del').  If x is None, f is called
+        with the name of the variable as first argument for all variables.
+
+        If batch is True (only for event='change' and a given x), f is only
+        called with the latest value, at most every NAMESPACE_BATCH_INTERVAL
+        seconds and at the end of each block of the cell.
+        """
+        d = self._listeners(event, batch and x is not None)
+        if x not in d:
+            d[x] = []
+        d[x].append(f)
+        self._update_class()
 
     def remove(self, event, x, f):
-        if event == 'change' and x in self._on_change:
-            v = self._on_change[x]
-            i = v.find(f)
-            if i != -1:
-                del v[i]
-            if len(v) == 0:
-                del self._on_change[x]
-        elif event == 'del' and x in self._on_del:
-            v = self._on_del[x]
-            i = v.find(f)
-            if i != -1:
-                del v[i]
-            if len(v) == 0:
-                del self._on_del[x]
+        for d in ([self._on_change, self._on_change_batched]
+                  if event == 'change' else [self._listeners(event)]):
+            v = d.get(x)
+            if v is not None and f in v:
+                v.remove(f)
+                if len(v) == 0:
+                    del d[x]
+                    self._pending.pop(x, None)
+        self._update_class()
+
+    def flush_changes(self):
+        """
+        Deliver pending changes to the listeners registered with batch=True.
+        """
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        self._last_delivery = time.time()
+        try:
+            for x, y in pending.items():
+                for f in self._on_change_batched.get(x, []):
+                    f(y)
+        except Exception as mesg:
+            print(mesg)
+
+    def set(self, x, y, do_not_trigger=None):
+        Namespace.__setitem__(self, x, y)
+        self._pending.pop(x, None)
+        if do_not_trigger is None:
+            do_not_trigger = []
+        for d in [self._on_change, self._on_change_batched]:
+            if x in d:
+                for f in d[x]:
+                    if f not in do_not_trigger:
+                        f(y)
+        if None in self._on_change:
+            for f in self._on_change[None]:
+                f(x, y)
+
 
+class ObservedNamespace(Namespace):
+    """
+    A Namespace with listeners; see Namespace.on.
+    """
     def __setitem__(self, x, y):
-        dict.__setitem__(self, x, y)
+        Namespace.__setitem__(self, x, y)
         try:
             if x in self._on_change:
                 for f in self._on_change[x]:
@@ -567,6 +1261,11 @@ class Namespace(dict):
             if None in self._on_change:
                 for f in self._on_change[None]:
                     f(x, y)
+            if x in self._on_change_batched:
+                self._pending[x] = y
+                if time.time(
+                ) - self._last_delivery >= NAMESPACE_BATCH_INTERVAL:
+                    self.flush_changes()
         except Exception as mesg:
             print(mesg)
 
@@ -580,19 +1279,8 @@ class Namespace(dict):
                     f(x)
         except Exception as mesg:
             print(mesg)
-        dict.__delitem__(self, x)
-
-    def set(self, x, y, do_not_trigger=None):
-        dict.__setitem__(self, x, y)
-        if x in self._on_change:
-            if do_not_trigger is None:
-                do_not_trigger = []
-            for f in self._on_change[x]:
-                if f not in do_not_trigger:
-                    f(y)
-        if None in self._on_change:
-            for f in self._on_change[None]:
-                f(x, y)
+        self._pending.pop(x, None)
+        Namespace.__delitem__(self, x)
 
 
 class TemporaryURL:
@@ -641,6 +1329,7 @@ class Salvus(object):
     _postfix = ''
     _default_mode = 'sage'
     _py_features = {}
+    _last_profile = None
 
     def _flush_stdio(self):
         """
@@ -658,6 +1347,11 @@ class Salvus(object):
         self._num_output_messages = 0
         self._total_output_length = 0
         self._output_warning_sent = False
+        # output messages that have to wait until the hub saved a blob, and all
+        # output after them (to keep the order); entries are (uuid or None, mesg)
+        from collections import deque
+        self._pending_outputs = deque()
+        self._profile = CellProfile(id)
         self._id = id
         self._done = True  # done=self._done when last execute message is sent; e.g., set self._done = False to not close cell on code term.
         self.data = data
@@ -676,6 +1370,9 @@ class Salvus(object):
         sage.all.salvus = self
 
     def _send_output(self, *args, **kwds):
+        # blob -- if given, the uuid of a blob the hub has to save before this
+        # message may be sent
+        blob = kwds.pop('blob', None)
         if self._output_warning_sent:
             raise KeyboardInterrupt
         mesg = message.output(*args, **kwds)
@@ -691,7 +1388,59 @@ class Salvus(object):
                 message.output(stderr=err, id=self._id, once=False, done=True))
             raise KeyboardInterrupt
 
+        if blob is not None or self._pending_outputs:
+            self._pending_outputs.append((blob, mesg))
+            self._send_pending_outputs(
+                block=len(self._pending_outputs) > sage_server.
+                MAX_PENDING_OUTPUTS)
+        else:
+            self._send_mesg(mesg)
+
+    def _send_pending_outputs(self, block=False, force=False):
+        """
+        Send the queued output messages whose blobs the hub has saved, in
+        order.  If block is True, wait until all of them have been sent.
+        If force is True, send all of them right away, without waiting for
+        the hub, e.g., since the cell was interrupted while waiting.
+        """
+        q = self._pending_outputs
+        if not q:
+            return
+        mq = self.message_queue
+        if not block:
+            mq.poll()
+        while q:
+            uuid, mesg = q[0]
+            if uuid is not None:
+                ack = mq.blob_saved(uuid)
+                if ack is None and not force:
+                    if not block:
+                        return
+                    ack = self._wait_for_blob(uuid)
+                elif ack is None:
+                    mq.forget_blob(uuid)
+                if ack is not None and 'error' in ack:
+                    mesg = message.output(id=self._id,
+                                          stderr="error saving blob -- %s" %
+                                          ack['error'],
+                                          done=mesg.get('done', False))
+                elif ack is not None:
+                    known_blobs.add(ack)
+            q.popleft()
+            self._send_mesg(mesg)
+
+    def _wait_for_blob(self, uuid):
+        t = time.time()
+        try:
+            return self.message_queue.wait_for_blob(uuid)
+        finally:
+            self._profile.blob_wait += time.time() - t
+
+    def _send_mesg(self, mesg):
+        from . import sage_server
+        t = time.time()
         n = self._conn.send_json(mesg)
+        self._profile.send_time += time.time() - t
         self._total_output_length += n
 
         if self._total_output_length > sage_server.MAX_OUTPUT:
@@ -904,7 +1653,7 @@ class Salvus(object):
         # We do this since obj can easily be quite large/complicated, and managing it as part of the
         # document is too slow and doesn't scale.
         blob = json.dumps(scene, separators=(',', ':'))
-        uuid = self._conn.send_blob(blob)
+        uuid = self._conn.send_blob(blob, known=known_blobs)
 
         # flush output (so any text appears before 3d graphics, in case they are interleaved)
         self._flush_stdio()
@@ -933,7 +1682,8 @@ class Salvus(object):
              once=False,
              events=None,
              raw=False,
-             text=None):
+             text=None,
+             progress=None):
         """
         Display or provide a link to the given file.  Raises a RuntimeError if this
         is not possible, e.g, if the file is too large.
@@ -975,6 +1725,16 @@ class Salvus(object):
         same Sha1 hash.
 
         The file does NOT have to be in the HOME directory.
+
+        The file is streamed to the server in chunks, so arbitrarily large files
+        can be sent without reading them into memory.  If progress is given, it is
+        called as progress(bytes_sent, total_bytes) while the file is sent, e.g.::
+
+            sent = []
+            salvus.file('movie.webm', progress=lambda n, m: sent.append(n))
+
+        Output that progress produces (e.g., by printing) only appears once
+        the whole file has been sent.
         """
         filename = unicode8(filename)
         if raw:
@@ -1011,22 +1771,22 @@ class Salvus(object):
             else:
                 return TemporaryURL(url=url, ttl=0)
 
-        file_uuid = self._conn.send_file(filename)
-
-        mesg = None
-        while mesg is None:
-            self.message_queue.recv()
-            for i, (typ, m) in enumerate(self.message_queue.queue):
-                if typ == 'json' and m.get('event') == 'save_blob' and m.get(
-                        'sha1') == file_uuid:
-                    mesg = m
-                    del self.message_queue[i]
-                    break
-
-        if 'error' in mesg:
-            raise RuntimeError("error saving blob -- %s" % mesg['error'])
+        # if the hub already has this content, there is no reply to wait for
+        file_uuid, mesg = self._conn.upload_file(filename,
+                                                 progress=progress,
+                                                 known=known_blobs)
+        if mesg is None:
+            self.message_queue.expect_blob(file_uuid)
+        if mesg is None and not show:
+            # the caller needs the ttl of the blob
+            mesg = self._wait_for_blob(file_uuid)
+            if 'error' in mesg:
+                raise RuntimeError("error saving blob -- %s" % mesg['error'])
+            known_blobs.add(mesg)
 
         self._flush_stdio()
+        # If we still do not know that the hub saved the blob, the output message
+        # is queued and sent once it did, so that many files are saved in parallel.
         self._send_output(id=self._id,
                           once=once,
                           file={
@@ -1036,7 +1796,8 @@ class Salvus(object):
                               'text': text
                           },
                           events=events,
-                          done=done)
+                          done=done,
+                          blob=None if mesg is not None else file_uuid)
         if not show:
             info = self.project_info()
             url = "%s/blobs/%s?uuid=%s" % (info['base_url'], filename,
@@ -1152,6 +1913,47 @@ class Salvus(object):
             Salvus._postfix = postfix
 
     def execute(self, code, namespace=None, preparse=True, locals=None):
+        profile = self._profile
+        profile.depth += 1
+        try:
+            # only the blocks of the outermost call are recorded; nested
+            # calls are part of the time of the block that made them
+            self._execute(code, namespace, preparse, locals,
+                          profile if profile.depth == 1 else no_profile)
+        finally:
+            profile.depth -= 1
+
+    def profile(self, code, namespace=None, preparse=True):
+        """
+        Execute code and return a CellProfile with the timing breakdown
+        of its blocks.  This is what %cell_stats shows.
+        """
+        outer = self._profile
+        self._profile = CellProfile(self._id)
+        try:
+            self.execute(code, namespace=namespace, preparse=preparse)
+        finally:
+            profile, self._profile = self._profile, outer
+            profile.finish()
+            outer.send_time += profile.send_time
+            outer.blob_wait += profile.blob_wait
+        return profile
+
+    def last_profile(self):
+        """
+        Return the CellProfile of the most recently completed cell, i.e.,
+        where the time of each of its blocks went: preparsing, compiling,
+        executing (wall and CPU time), sending output and waiting for the
+        hub to save blobs, and how many output messages and bytes each
+        block sent.  Returns None if no cell has completed yet.
+
+        EXAMPLE:
+
+            print(salvus.last_profile())
+        """
+        return Salvus._last_profile
+
+    def _execute(self, code, namespace, preparse, locals, profile):
 
         ascii_warn = False
         code_error = False
@@ -1174,7 +1976,7 @@ class Salvus(object):
                                0)
 
         #code   = sage_parsing.strip_leading_prompts(code)  # broken -- wrong on "def foo(x):\n   print(x)"
-        blocks = sage_parsing.divide_into_blocks(code)
+        blocks = compiled_cells.blocks(code)
 
         try:
             import sage.repl
@@ -1188,14 +1990,17 @@ class Salvus(object):
             pass  # expected behavior usually, since sage.repl.interpreter usually not imported (only used by command line...)
 
         import sage.misc.session
-        for start, stop, block in blocks:
+        for cblock in blocks:
+            start, stop = cblock.start, cblock.stop
             # if import sage.repl.interpreter fails, sag_repl_interpreter is unreferenced
             try:
                 do_pp = getattr(sage_repl_interpreter, '_do_preparse', True)
             except:
                 do_pp = True
-            if preparse and do_pp:
-                block = sage_parsing.preparse_code(block)
+            pp = bool(preparse and do_pp)
+            block_profile = profile.start_block(self, cblock)
+            with block_profile.timing('preparse'):
+                block = cblock.source(pp)
             sys.stdout.reset()
             sys.stderr.reset()
             try:
@@ -1240,22 +2045,22 @@ if 'SAGE_STARTUP_FILE' in os.environ and os.path.isfile(os.environ['SAGE_STARTUP
         raise
 """
                             exec(compile(b2a, '', 'exec'), namespace, locals)
-                    features = sage_parsing.get_future_features(
-                        block, 'single')
+                    features = cblock.features(pp)
                     if features:
                         compile_flags = reduce(
                             operator.or_, (feature.compiler_flag
                                            for feature in features.values()),
                             compile_flags)
-                    exec(
-                        compile(block + '\n',
-                                '',
-                                'single',
-                                flags=compile_flags), namespace, locals)
+                    with block_profile.timing('compile'):
+                        code_obj = cblock.code(pp, compile_flags)
+                    with block_profile.timing('exec_wall', 'exec_cpu'):
+                        exec(code_obj, namespace, locals)
                     if features:
                         Salvus._py_features.update(features)
                 sys.stdout.flush()
                 sys.stderr.flush()
+                # send file output whose blobs got saved meanwhile
+                self._send_pending_outputs()
             except:
                 if ascii_warn:
                     sys.stderr.write(
@@ -1277,8 +2082,8 @@ if 'SAGE_STARTUP_FILE' in os.environ and os.path.isfile(os.environ['SAGE_STARTUP
 
                 exc_type, _, _ = sys.exc_info()
                 if exc_type in [SyntaxError, TypeError]:
-                    from .sage_parsing import strip_string_literals
-                    code0, _, _ = strip_string_literals(code)
+                    # the cell was already scanned when it was divided into blocks
+                    code0 = sage_parsing.scan(code).code
                     implicit_mul = RE_POSSIBLE_IMPLICIT_MUL.findall(code0)
                     if len(implicit_mul) > 0:
                         implicit_mul_list = ', '.join(
@@ -1297,6 +2102,10 @@ if 'SAGE_STARTUP_FILE' in os.environ and os.path.isfile(os.environ['SAGE_STARTUP
                 traceback.print_exc()
                 sys.stderr.flush()
                 break
+            finally:
+                # e.g., update the controls of dynamic() variables
+                self.namespace.flush_changes()
+                block_profile.end()
 
     def execute_with_code_decorators(self,
                                      code_decorators,
@@ -1554,8 +2363,12 @@ if 'SAGE_STARTUP_FILE' in os.environ and os.path.isfile(os.environ['SAGE_STARTUP
         if placeholder:
             m['placeholder'] = unicode8(placeholder)
         self._send_output(raw_input=m, id=self._id)
+        # the user has to see the prompt before we can wait for the answer
+        self._send_pending_outputs(block=True)
         typ, mesg = self.message_queue.next_mesg()
-        log("handling raw input message ", truncate_text(unicode8(mesg), 400))
+        if LOG_LEVEL <= LOG_DEBUG:
+            log_debug("handling raw input message ",
+                      truncate_text(unicode8(mesg), 400))
         if typ == 'json' and mesg['event'] == 'sage_raw_input':
             # everything worked out perfectly
             self.delete_last_output()
@@ -1748,21 +2561,272 @@ else:
     Salvus.delete_last_output.__doc__ = sage_salvus.delete_last_output.__doc__
 
 
-def execute(conn, id, code, data, cell_id, preparse, message_queue):
-
-    salvus = Salvus(conn=conn,
-                    id=id,
-                    data=data,
-                    message_queue=message_queue,
-                    cell_id=cell_id)
+class CompiledBlock(object):
+    """
+    A block of a cell as returned by sage_parsing.divide_into_blocks, which
+    remembers its preparsed source, future features and code objects.
+    """
+
+    def __init__(self, start, stop, block):
+        self.start = start
+        self.stop = stop
+        self.block = block
+        self._source = {}  # preparser key --> source
+        self._features = {}  # preparser key --> future features
+        self._code = {}  # (preparser key, compile flags) --> code object
+
+    def _key(self, preparse):
+        # the preparsed source also depends on the preparser settings
+        return (True, sage_parsing.preparser_state()) if preparse else False
+
+    def source(self, preparse):
+        key = self._key(preparse)
+        if key not in self._source:
+            self._source[key] = sage_parsing.preparse_code(
+                self.block) if preparse else self.block
+        return self._source[key]
+
+    def features(self, preparse):
+        key = self._key(preparse)
+        if key not in self._features:
+            self._features[key] = sage_parsing.get_future_features(
+                self.source(preparse), 'single')
+        return self._features[key]
+
+    def code(self, preparse, flags):
+        key = (self._key(preparse), flags)
+        if key not in self._code:
+            self._code[key] = compile(self.source(preparse) + '\n',
+                                      '',
+                                      'single',
+                                      flags=flags)
+        return self._code[key]
+
+
+class CompiledCellCache(object):
+    """
+    LRU cache of the blocks of recently executed cells, so that executing
+    the same code again (interacts, re-running a cell, %auto cells)
+    skips dividing it into blocks, preparsing and compiling.
+
+    Preparsed source and code objects are stored per block, keyed by
+    whether the block was preparsed (and the preparser settings, e.g.,
+    implicit_multiplication()) and by the compiler flags of the enabled
+    __future__ features, since all of these can change between runs.
+    """
+
+    def __init__(self, max_size=128):
+        from collections import OrderedDict
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._cells = OrderedDict()  # code --> list of CompiledBlock
+
+    def __len__(self):
+        return len(self._cells)
+
+    def blocks(self, code):
+        """
+        Return the list of CompiledBlock's of the code.
+        """
+        blocks = self._cells.pop(code, None)
+        if blocks is None:
+            self.misses += 1
+            blocks = [
+                CompiledBlock(start, stop, block)
+                for start, stop, block in sage_parsing.divide_into_blocks(code)
+            ]
+        else:
+            self.hits += 1
+        self._cells[code] = blocks
+        while len(self._cells) > self.max_size:
+            self._cells.popitem(last=False)
+        return blocks
+
+    def stats(self):
+        return {'size': len(self), 'hits': self.hits, 'misses': self.misses}
+
+    def clear(self):
+        self._cells.clear()
+
+
+compiled_cells = CompiledCellCache()
+
+# If true, the profile of every executed cell is logged as a line
+# "cell profile {...json...}", so latency can be aggregated from the logs.
+LOG_CELL_PROFILES = bool(os.environ.get('COCALC_SAGE_SERVER_LOG_PROFILES'))
+
+
+def _cpu_time():
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    return r.ru_utime + r.ru_stime
+
+
+class CellProfile(object):
+    """
+    Timing breakdown of an executed cell, block by block.
+
+    For each block this records the seconds spent preparsing, compiling
+    and executing it (wall and CPU time), sending its output and waiting
+    for the hub to save blobs, and the number of output messages and
+    bytes it sent.  Blocks that come from compiled_cells take no time to
+    preparse and compile.  Output that is still queued when a block ends
+    is charged to the block that sends it.
+    """
+    FIELDS = ('preparse', 'compile', 'exec_wall', 'exec_cpu', 'send',
+              'blob_wait', 'messages', 'bytes')
+
+    def __init__(self, id=None):
+        self.id = id
+        self.blocks = []
+        self.depth = 0
+        self.send_time = 0
+        self.blob_wait = 0
+        self.start = time.time()
+        self.wall = None
+
+    def start_block(self, salvus, cblock):
+        b = BlockProfile(self, salvus, cblock)
+        self.blocks.append(b)
+        return b
+
+    def finish(self):
+        self.wall = time.time() - self.start
+
+    def totals(self):
+        return dict((k, sum(b.get(k, 0) for b in self.blocks))
+                    for k in self.FIELDS)
+
+    def summary(self):
+        """
+        Return a JSON-able dict with the totals of the cell.
+        """
+        d = self.totals()
+        d['id'] = self.id
+        d['blocks'] = len(self.blocks)
+        d['wall'] = self.wall
+        return d
+
+    def __str__(self):
+        head = ('lines', 'preparse', 'compile', 'exec', 'cpu', 'send',
+                'blob wait', 'msgs', 'bytes')
+        rows = []
+        for b in self.blocks + [dict(self.totals(), lines=None)]:
+            lines = 'total' if b['lines'] is None else '%s-%s' % tuple(
+                b['lines'])
+            rows.append([lines] + [
+                '%.1fms' % (1000 * b.get(k, 0)) for k in self.FIELDS[:6]
+            ] + [str(b.get('messages', 0)), str(b.get('bytes', 0))])
+        widths = [
+            max(len(r[i]) for r in rows + [head]) for i in range(len(head))
+        ]
+        fmt = '  '.join('%%%ds' % w for w in widths)
+        s = '\n'.join([fmt % head] + [fmt % tuple(r) for r in rows])
+        if self.wall is not None:
+            s += '\nwall time %.1fms' % (1000 * self.wall)
+        return s
+
+    __repr__ = __str__
+
+
+class BlockProfile(dict):
+    """
+    The timing of one block of a CellProfile, i.e., a dict with the FIELDS
+    of CellProfile and the lines of the block.  Salvus.execute times the
+    parts of executing the block with
+
+        with block_profile.timing('compile'):
+            ...
+
+    and calls end() once the block is done.
+    """
+    def __init__(self, cell, salvus, cblock):
+        dict.__init__(self,
+                      lines=[cblock.start + 1, cblock.stop + 1],
+                      preparse=0,
+                      compile=0,
+                      exec_wall=0,
+                      exec_cpu=0)
+        self._cell = cell
+        self._salvus = salvus
+        self._mark = (time.time(), salvus._num_output_messages,
+                      salvus._total_output_length, cell.send_time,
+                      cell.blob_wait)
+        self._timing = None
+
+    def timing(self, key, cpu_key=None):
+        """
+        Context manager that records the wall time of its body as key, and
+        the CPU time as cpu_key, if given.
+        """
+        self._timing = (key, cpu_key)
+        return self
+
+    def __enter__(self):
+        key, cpu_key = self._timing
+        self._timing = (key, cpu_key, time.time(),
+                        _cpu_time() if cpu_key else None)
+        return self
+
+    def __exit__(self, *args):
+        key, cpu_key, t, cpu = self._timing
+        self[key] = time.time() - t
+        if cpu_key:
+            self[cpu_key] = _cpu_time() - cpu
+        return False
+
+    def end(self):
+        t, messages, nbytes, send_time, blob_wait = self._mark
+        salvus, cell = self._salvus, self._cell
+        self['wall'] = time.time() - t
+        self['messages'] = salvus._num_output_messages - messages
+        self['bytes'] = salvus._total_output_length - nbytes
+        self['send'] = cell.send_time - send_time
+        self['blob_wait'] = cell.blob_wait - blob_wait
+
+
+class NoProfile(object):
+    """
+    Stands in for a CellProfile and its blocks where nothing is recorded,
+    i.e., in calls of salvus.execute made while a cell is executed.
+    """
+    def start_block(self, salvus, cblock):
+        return self
+
+    def timing(self, key, cpu_key=None):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def end(self):
+        pass
+
+
+no_profile = NoProfile()
+
+
+def execute(conn, id, code, data, cell_id, preparse, message_queue):
+
+    salvus = Salvus(conn=conn,
+                    id=id,
+                    data=data,
+                    message_queue=message_queue,
+                    cell_id=cell_id)
 
     #salvus.start_executing()  # with our new mainly client-side execution this isn't needed; not doing this makes evaluation roundtrip around 100ms instead of 200ms too, which is a major win.
 
+    # the code may change any object that tab completion has cached
+    sage_parsing.completion_cache.invalidate()
     try:
         # initialize the salvus output streams
         streams = (sys.stdout, sys.stderr)
-        sys.stdout = BufferedOutputStream(salvus.stdout)
-        sys.stderr = BufferedOutputStream(salvus.stderr)
+        output = OutputChannel(salvus)
+        sys.stdout = BufferedOutputStream(output, 'stdout')
+        sys.stderr = BufferedOutputStream(output, 'stderr')
         try:
             # initialize more salvus functionality
             sage_salvus.set_salvus(salvus)
@@ -1780,14 +2844,21 @@ def execute(conn, id, code, data, cell_id, preparse, message_queue):
         salvus.execute(code, namespace=namespace, preparse=preparse)
 
     finally:
+        # Output waiting for the hub to save its blobs goes out before the
+        # done message, and an interrupt while waiting must not lose either.
+        try:
+            salvus._send_pending_outputs(block=True)
+        except KeyboardInterrupt:
+            salvus._send_pending_outputs(force=True)
         # there must be exactly one done message, unless salvus._done is False.
-        if sys.stderr._buf:
-            if sys.stdout._buf:
-                sys.stdout.flush()
-            sys.stderr.flush(done=salvus._done)
-        else:
-            sys.stdout.flush(done=salvus._done)
+        output.flush(done=salvus._done)
         (sys.stdout, sys.stderr) = streams
+        sage_parsing.completion_cache.invalidate()
+        profile = salvus._profile
+        profile.finish()
+        Salvus._last_profile = profile
+        if LOG_CELL_PROFILES:
+            log("cell profile %s" % json.dumps(profile.summary()))
 
 
 # execute.count goes from 0 to 2
@@ -1819,41 +2890,457 @@ def drop_privileges(id, home, transient, username):
     sage.misc.misc.DOT_SAGE = home + '/.sage/'
 
 
-class MessageQueue(list):
+class MessageQueue(object):
+    """
+    Messages from the hub that have been received but not handled yet, in
+    the order in which they arrived.
+
+    Besides taking the oldest message (next_mesg), the oldest message with a
+    given event and/or id can be taken out in constant time (take), since
+    messages are indexed by event and id.  Replies to blobs we sent
+    (save_blob messages) are not enqueued, but kept aside by uuid for
+    blob_saved and wait_for_blob, unless a function to pass them to is
+    registered in blob_routes (by uuid), as is done for the blobs of
+    forked subprocesses.  There is one reply per blob sent, so if the same
+    blob was sent twice, its uuid has two replies.  Replies nobody waits
+    for (see expect_blob) are forgotten once there are too many.
+
+    If reader is set to a running SessionReader, messages are taken from it
+    instead of being received from the connection directly.
+    """
+
+    # at most this many save_blob replies nobody waits for are remembered
+    MAX_BLOB_REPLIES = 1024
 
     def __init__(self, conn):
-        self.queue = []
+        from collections import OrderedDict
         self.conn = conn
+        self._count = 0
+        self._messages = OrderedDict()  # sequence number --> (typ, mesg)
+        # indexes: event or id --> deque of sequence numbers (oldest first);
+        # entries of messages that were taken out otherwise are skipped lazily.
+        self._by_event = {}
+        self._by_id = {}
+        self._blob_replies = OrderedDict()  # uuid --> list of save_blob messages
+        self._expected = {}  # uuid --> number of replies that will be taken
+        self.blob_routes = BlobRoutes()
+        self.reader = None
 
     def __repr__(self):
         return "Sage Server Message Queue"
 
-    def __getitem__(self, i):
-        return self.queue[i]
+    def __len__(self):
+        return len(self._messages)
+
+    def __iter__(self):
+        return iter(list(self._messages.values()))
+
+    def _keys(self, typ, m):
+        if typ != 'json' or not isinstance(m, dict):
+            return None, None
+        return m.get('event'), m.get('id')
+
+    def _index(self, index, key, n):
+        from collections import deque
+        if key is not None:
+            if key not in index:
+                index[key] = deque()
+            index[key].append(n)
+
+    def _oldest(self, index, key):
+        """
+        Sequence number of the oldest queued message under key in index.
+        """
+        v = index.get(key)
+        if v is None:
+            return None
+        while v and v[0] not in self._messages:
+            v.popleft()
+        if not v:
+            del index[key]
+            return None
+        return v[0]
+
+    def _remove(self, n):
+        mesg = self._messages.pop(n)
+        event, id = self._keys(*mesg)
+        # the message is the oldest one of its event and id, unless it was taken
+        # out of the middle, in which case its entries are skipped later
+        self._oldest(self._by_event, event)
+        self._oldest(self._by_id, id)
+        return mesg
 
-    def __delitem__(self, i):
-        del self.queue[i]
+    def _append(self, mesg):
+        n = self._count
+        self._count += 1
+        self._messages[n] = mesg
+        event, id = self._keys(*mesg)
+        self._index(self._by_event, event, n)
+        self._index(self._by_id, id, n)
 
     def next_mesg(self):
         """
         Remove oldest message from the queue and return it.
         If the queue is empty, wait for a message to arrive
-        and return it (does not place it in the queue).
+        and return it.
+        """
+        while not self._messages:
+            self.recv()
+        return self._remove(next(iter(self._messages)))
+
+    def _next(self, block=True):
         """
-        if self.queue:
-            return self.queue.pop()
+        Return the next message that arrived, or None if block is False and
+        there is none yet.
+        """
+        reader = self.reader
+        if reader is not None and reader.active():
+            return reader.get(block)
+        if not block:
+            import select
+            if not select.select([self.conn], [], [], 0)[0]:
+                return None
+        return self.conn.recv()
+
+    def _enqueue(self, mesg):
+        typ, m = mesg
+        if typ == 'json' and m.get('event') == 'save_blob':
+            if route_blob_reply(self.blob_routes, m):
+                return
+            self._blob_replies.setdefault(m.get('sha1'), []).append(m)
+            known_blobs.add(m)
+            if len(self._blob_replies) > self.MAX_BLOB_REPLIES:
+                # forget the oldest replies nobody waits for
+                for uuid in list(self._blob_replies):
+                    if uuid not in self._expected:
+                        del self._blob_replies[uuid]
+                        if len(self._blob_replies) <= self.MAX_BLOB_REPLIES:
+                            break
         else:
-            return self.conn.recv()
+            self._append(mesg)
 
     def recv(self):
         """
         Wait until one message is received and enqueue it.
         Also returns the mesg.
         """
-        mesg = self.conn.recv()
-        self.queue.insert(0, mesg)
+        mesg = self._next()
+        self._enqueue(mesg)
         return mesg
 
+    def poll(self):
+        """
+        Receive all messages that have already arrived, without waiting.
+        """
+        while True:
+            mesg = self._next(block=False)
+            if mesg is None:
+                return
+            self._enqueue(mesg)
+
+    def _find(self, event, id):
+        if event is not None and id is not None:
+            # the smaller index is usually the id one
+            for n in list(self._by_id.get(id, ())):
+                if n in self._messages and self._keys(
+                        *self._messages[n])[0] == event:
+                    return n
+            return None
+        if event is not None:
+            return self._oldest(self._by_event, event)
+        if id is not None:
+            return self._oldest(self._by_id, id)
+        return next(iter(self._messages), None)
+
+    def take(self, event=None, id=None, block=True):
+        """
+        Remove and return the oldest message with the given event and/or id.
+        If there is no such message, wait for one to arrive if block is True,
+        and otherwise return None.
+        """
+        while True:
+            n = self._find(event, id)
+            if n is not None:
+                return self._remove(n)
+            if not block:
+                return None
+            self.recv()
+
+    def wait(self, predicate):
+        """
+        Remove and return the oldest message (typ, mesg) for which
+        predicate(typ, mesg) is true, waiting for one to arrive if necessary.
+        """
+        for n, mesg in list(self._messages.items()):
+            if predicate(*mesg):
+                return self._remove(n)
+        while True:
+            mesg = self.recv()
+            if mesg[0] == 'json' and mesg[1].get('event') == 'save_blob':
+                continue
+            if predicate(*mesg):
+                return self._remove(next(reversed(self._messages)))
+
+    def pending(self, event=None, id=None):
+        """
+        Return whether a message with the given event and/or id has arrived
+        and was not handled yet, without waiting.
+        """
+        self.poll()
+        return self._find(event, id) is not None
+
+    def expect_blob(self, uuid):
+        """
+        Note that the save_blob reply to a blob with given uuid that was
+        just sent will be taken by blob_saved or wait_for_blob, so that it
+        is kept until then.
+        """
+        self._expected[uuid] = self._expected.get(uuid, 0) + 1
+
+    def forget_blob(self, uuid):
+        """
+        Undo expect_blob, e.g., since the output waiting for the reply was
+        sent without it.
+        """
+        n = self._expected.pop(uuid, 0) - 1
+        if n > 0:
+            self._expected[uuid] = n
+
+    def blob_saved(self, uuid):
+        """
+        Return and forget a save_blob reply for the blob with given uuid,
+        or None if none has arrived yet.
+        """
+        replies = self._blob_replies.get(uuid)
+        if not replies:
+            return None
+        mesg = replies.pop(0)
+        if not replies:
+            del self._blob_replies[uuid]
+        self.forget_blob(uuid)
+        return mesg
+
+    def wait_for_blob(self, uuid):
+        """
+        Wait for a save_blob reply for the blob with given uuid.
+        """
+        while uuid not in self._blob_replies:
+            self.recv()
+        return self.blob_saved(uuid)
+
+
+# If true, every session receives its messages in a thread of its own, which
+# answers introspection while a cell is running and acts on signals right
+# away.  Set COCALC_SAGE_SERVER_SESSION_READER=0 to turn this off.
+SESSION_READER = os.environ.get('COCALC_SAGE_SERVER_SESSION_READER',
+                                '1') != '0'
+
+
+def _session_signal(mesg):
+    """
+    Act on a send_signal message received by a session: the signal is sent
+    to the given pid, or to the session itself if the pid is 0 or missing.
+    """
+    pid = mesg.get('pid') or os.getpid()
+    log("sending signal %s to %s" % (mesg.get('signal'), pid))
+    try:
+        os.kill(pid, mesg['signal'])
+    except Exception as err:
+        log("unable to send signal -- %s" % err)
+
+
+class BlobRoutes(object):
+    """
+    The functions to call with the save_blob replies of blobs, by uuid.
+
+    Several forked subprocesses may send blobs with the same content, so a
+    uuid has one function per blob sent, and each reply goes to the one
+    registered first.  Used by several threads.
+    """
+    def __init__(self):
+        import threading
+        self._lock = threading.Lock()
+        self._routes = {}  # uuid --> list of functions
+
+    def __len__(self):
+        return len(self._routes)
+
+    def add(self, uuid, f):
+        with self._lock:
+            self._routes.setdefault(uuid, []).append(f)
+
+    def remove(self, uuid, f):
+        """
+        Forget one route of the reply for uuid to f, if there is one.
+        """
+        with self._lock:
+            v = self._routes.get(uuid)
+            if v and f in v:
+                v.remove(f)
+                if not v:
+                    del self._routes[uuid]
+
+    def pop(self, uuid):
+        """
+        Remove and return the first function registered for uuid, or None.
+        """
+        with self._lock:
+            v = self._routes.get(uuid)
+            if not v:
+                return None
+            f = v.pop(0)
+            if not v:
+                del self._routes[uuid]
+            return f
+
+
+def route_blob_reply(routes, mesg):
+    """
+    Pass the save_blob message mesg to the function registered for its
+    blob in routes (see BlobRoutes), if any, and return whether there was one.
+    """
+    f = routes.pop(mesg.get('sha1'))
+    if f is None:
+        return False
+    known_blobs.add(mesg)
+    try:
+        f(mesg)
+    except Exception as err:
+        log("unable to pass on save_blob reply -- %s" % err)
+    return True
+
+
+class SessionReader(object):
+    """
+    Thread that receives all messages of a session, so that some of them
+    are handled while the main thread is busy executing a cell.
+
+    - send_signal messages are acted on immediately (see _session_signal),
+      so a cell can be interrupted over the session's own connection.
+    - introspect messages that arrive while busy is true are answered if
+      they only complete a name of the namespace, from a snapshot of its
+      names; no object of the namespace is touched while the cell uses it.
+      Any other introspection, and introspection in jupyter modes, waits
+      for the cell.
+    - save_blob replies for blobs in blob_routes are passed on right away
+      (see route_blob_reply), so forked subprocesses do not wait for a cell.
+    - All other messages are handed to the main thread by get() in the
+      order in which they arrived, so executions stay serialized.
+
+    All signals are blocked in the thread, so they are delivered to the
+    main thread, where Sage's interrupt handling expects them.
+    """
+    def __init__(self, conn, blob_routes=None):
+        from collections import deque
+        import threading
+        self.conn = conn
+        self.blob_routes = BlobRoutes() if blob_routes is None else blob_routes
+        self.busy = False
+        self._messages = deque()
+        self._error = None
+        self._cond = threading.Condition()
+        self._pid = None
+        self._thread = None
+
+    def start(self):
+        import threading
+        signals = signal.valid_signals() if hasattr(
+            signal, 'valid_signals') else range(1, signal.NSIG)
+        # the new thread inherits the signal mask of this one
+        mask = signal.pthread_sigmask(signal.SIG_BLOCK, signals)
+        try:
+            self._thread = threading.Thread(target=self._run,
+                                            name='session reader')
+            self._thread.daemon = True
+            self._thread.start()
+        finally:
+            signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+        self._pid = os.getpid()
+
+    def active(self):
+        """
+        Whether the thread runs in this process; it does not survive fork().
+        """
+        return self._thread is not None and self._pid == os.getpid()
+
+    def get(self, block=True):
+        """
+        Return the next message for the main thread.  If there is none,
+        wait for one if block is True and otherwise return None.  An error
+        receiving from the connection is raised here.
+        """
+        with self._cond:
+            while not self._messages and self._error is None:
+                if not block:
+                    return None
+                logger.flush()  # about to block waiting for the next message
+                self._cond.wait()
+            if self._messages:
+                return self._messages.popleft()
+            raise self._error
+
+    def _run(self):
+        try:
+            while True:
+                mesg = self.conn.recv()
+                if not self._handle(*mesg):
+                    with self._cond:
+                        self._messages.append(mesg)
+                        self._cond.notify()
+        except Exception as err:
+            with self._cond:
+                self._error = err
+                self._cond.notify()
+
+    def _handle(self, typ, mesg):
+        """
+        Handle the message right away if this thread takes care of it, and
+        return whether it did.
+        """
+        if typ != 'json':
+            return False
+        event = mesg.get('event')
+        if event == 'send_signal':
+            _session_signal(mesg)
+            return True
+        if event == 'save_blob':
+            return route_blob_reply(self.blob_routes, mesg)
+        if (event == 'introspect' and self.busy
+                and Salvus._default_mode == 'sage'
+                and not mesg.get('top', '').startswith('%')):
+            try:
+                return introspect(conn=self.conn,
+                                  id=mesg['id'],
+                                  line=mesg['line'],
+                                  preparse=mesg.get('preparse', True),
+                                  evaluate=False)
+            except Exception as err:
+                log("introspection while busy failed -- %s" % err)
+                return True
+        return False
+
+
+_session_prepared = False
+
+
+def prepare_session():
+    """
+    Per-process session setup that does not depend on the connection.
+
+    This is called by warm pool children right after they are forked, so
+    that it is off the critical path when a connection is handed to them,
+    and by session() for children that were forked on demand.
+    """
+    global _session_prepared
+    if _session_prepared:
+        return
+    # seed the random number generator(s)
+    import sage.all
+    sage.all.set_random_seed()
+    import random
+    random.seed(sage.all.initial_seed())
+    _session_prepared = True
+
 
 def session(conn):
     """
@@ -1869,11 +3356,11 @@ def session(conn):
 
     pid = os.getpid()
 
-    # seed the random number generator(s)
-    import sage.all
-    sage.all.set_random_seed()
-    import random
-    random.seed(sage.all.initial_seed())
+    prepare_session()
+
+    if SESSION_READER and hasattr(signal, 'pthread_sigmask'):
+        mq.reader = SessionReader(conn, mq.blob_routes)
+        mq.reader.start()
 
     cnt = 0
     while True:
@@ -1881,11 +3368,16 @@ def session(conn):
             typ, mesg = mq.next_mesg()
 
             #print('INFO:child%s: received message "%s"'%(pid, mesg))
-            log("handling message ", truncate_text(unicode8(mesg), 400))
+            if LOG_LEVEL <= LOG_DEBUG:
+                log_debug("handling message ",
+                          truncate_text(unicode8(mesg), 400))
             event = mesg['event']
             if event == 'terminate_session':
                 return
             elif event == 'execute_code':
+                reader = mq.reader
+                if reader is not None:
+                    reader.busy = True
                 try:
                     execute(conn=conn,
                             id=mesg['id'],
@@ -1895,8 +3387,14 @@ def session(conn):
                             preparse=mesg.get('preparse', True),
                             message_queue=mq)
                 except Exception as err:
-                    log("ERROR -- exception raised '%s' when executing '%s'" %
+                    log_warning(
+                        "ERROR -- exception raised '%s' when executing '%s'" %
                         (err, mesg['code']))
+                finally:
+                    if reader is not None:
+                        reader.busy = False
+            elif event == 'send_signal':
+                _session_signal(mesg)
             elif event == 'introspect':
                 try:
                     # check for introspect from jupyter cell
@@ -1908,17 +3406,24 @@ def session(conn):
                             prefix = top[1:]
                     try:
                         # see if prefix is the name of a jupyter kernel function
-                        kc = eval(prefix + "(get_kernel_client=True)",
-                                  namespace, locals())
+                        completer = eval(
+                            prefix + "(get_kernel_completer=True)", namespace,
+                            locals())
                         kn = eval(prefix + "(get_kernel_name=True)", namespace,
                                   locals())
                         log("jupyter introspect prefix %s kernel %s" %
                             (prefix, kn))  # e.g. "p2", "python2"
-                        jupyter_introspect(conn=conn,
-                                           id=mesg['id'],
-                                           line=mesg['line'],
-                                           preparse=mesg.get('preparse', True),
-                                           kc=kc)
+                        if mq.pending('introspect'):
+                            # a newer request (e.g., for the next keystroke) is
+                            # waiting, so nobody will look at this answer
+                            continue
+                        jupyter_introspect(
+                            conn=conn,
+                            id=mesg['id'],
+                            line=mesg['line'],
+                            preparse=mesg.get('preparse', True),
+                            completer=completer,
+                            superseded=lambda: mq.pending('introspect'))
                     except:
                         import traceback
                         exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -1946,72 +3451,55 @@ def session(conn):
                 pass
 
 
-def jupyter_introspect(conn, id, line, preparse, kc):
-    import jupyter_client
-    from queue import Empty
-
-    try:
-        salvus = Salvus(conn=conn, id=id)
-        msg_id = kc.complete(line)
-        shell = kc.shell_channel
-        iopub = kc.iopub_channel
-
-        # handle iopub responses
-        while True:
-            try:
-                msg = iopub.get_msg(timeout=1)
-                msg_type = msg['msg_type']
-                content = msg['content']
-
-            except Empty:
-                # shouldn't happen
-                log("jupyter iopub channel empty")
-                break
-
-            if msg['parent_header'].get('msg_id') != msg_id:
-                continue
-
-            log("jupyter iopub recv %s %s" % (msg_type, str(content)))
-
-            if msg_type == 'status' and content['execution_state'] == 'idle':
-                break
-
-        # handle shell responses
-        while True:
-            try:
-                msg = shell.get_msg(timeout=10)
-                msg_type = msg['msg_type']
-                content = msg['content']
-
-            except:
-                # shouldn't happen
-                log("jupyter shell channel empty")
-                break
+# Tab completion in Jupyter modes gives up after this many seconds, or as soon
+# as a newer introspect message arrives.
+JUPYTER_COMPLETE_TIMEOUT = float(
+    os.environ.get('COCALC_SAGE_SERVER_JUPYTER_COMPLETE_TIMEOUT', 2))
 
-            if msg['parent_header'].get('msg_id') != msg_id:
-                continue
 
-            log("jupyter shell recv %s %s" % (msg_type, str(content)))
-
-            if msg_type == 'complete_reply' and content['status'] == 'ok':
-                # jupyter kernel returns matches like "xyz.append" and smc wants just "append"
-                matches = content['matches']
-                offset = content['cursor_end'] - content['cursor_start']
-                completions = [s[offset:] for s in matches]
-                mesg = message.introspect_completions(id=id,
-                                                      completions=completions,
-                                                      target=line[-offset:])
-                conn.send_json(mesg)
-                break
+def jupyter_introspect(conn, id, line, preparse, completer, superseded=None):
+    """
+    Send the completions of line by the Jupyter kernel of completer (a
+    sage_jupyter.JupyterCompleter).  Nothing is sent if the kernel does not
+    answer within JUPYTER_COMPLETE_TIMEOUT seconds or superseded() becomes
+    true, since the client only shows the completions of its last request.
+    """
+    try:
+        result = completer.complete(line,
+                                    timeout=JUPYTER_COMPLETE_TIMEOUT,
+                                    superseded=superseded)
+        if result is None:
+            log("jupyter completion of '%s' given up" % line)
+            return
+        completions, target = result
+        conn.send_json(
+            message.introspect_completions(id=id,
+                                           completions=completions,
+                                           target=target))
     except:
         log("jupyter completion exception: %s" % sys.exc_info()[0])
 
 
-def introspect(conn, id, line, preparse):
-    salvus = Salvus(
-        conn=conn, id=id
-    )  # so salvus.[tab] works -- note that Salvus(...) modifies namespace.
-    z = sage_parsing.introspect(line, namespace=namespace, preparse=preparse)
+def introspect(conn, id, line, preparse, evaluate=True):
+    """
+    Send the completions, docstring or source code for line.  If evaluate
+    is False (while a cell is running), the namespace is left alone and
+    only names in a snapshot of it are completed; anything else is not
+    answered, and False is returned.
+    """
+    if evaluate:
+        salvus = Salvus(
+            conn=conn, id=id
+        )  # so salvus.[tab] works -- note that Salvus(...) modifies namespace.
+        ns = namespace
+    else:
+        ns = dict.fromkeys(namespace)
+    z = sage_parsing.introspect(line,
+                                namespace=ns,
+                                preparse=preparse,
+                                evaluate=evaluate)
+    if z is None:
+        return False
     if z['get_completions']:
         mesg = message.introspect_completions(id=id,
                                               completions=z['result'],
@@ -2025,6 +3513,7 @@ def introspect(conn, id, line, preparse):
                                               source_code=z['result'],
                                               target=z['expr'])
     conn.send_json(mesg)
+    return True
 
 
 def handle_session_term(signum, frame):
@@ -2043,19 +3532,32 @@ if 'COCALC_SECRET_TOKEN' in os.environ:
 else:
     secret_token_path = os.path.join(os.environ['SMC'], 'secret_token')
 
+NO_SECRET_TOKEN = "Unable to accept connection, since Sage server doesn't yet know the secret token; unable to read from '%s'"
 
-def unlock_conn(conn):
+
+def load_secret_token():
+    """
+    Return the secret token, or None if it cannot be read yet.
+    """
     global secret_token
     if secret_token is None:
         try:
             secret_token = open(secret_token_path).read().strip()
         except:
-            conn.send(six.b('n'))
-            conn.send(
-                six.
-                b("Unable to accept connection, since Sage server doesn't yet know the secret token; unable to read from '%s'"
-                  % secret_token_path))
-            conn.close()
+            pass
+    return secret_token
+
+
+def refuse_conn(conn, reason):
+    conn.send(six.b('n'))
+    conn.send(six.b(reason))
+    conn.close()
+
+
+def unlock_conn(conn):
+    if load_secret_token() is None:
+        refuse_conn(conn, NO_SECRET_TOKEN % secret_token_path)
+        return False
 
     n = len(secret_token)
     token = six.b('')
@@ -2065,43 +3567,53 @@ def unlock_conn(conn):
             break  # definitely not right -- don't try anymore
     if token != six.b(secret_token):
         log("token='%s'; secret_token='%s'" % (token, secret_token))
-        conn.send(six.b('n'))  # no -- invalid login
-        conn.send(six.b("Invalid secret token."))
-        conn.close()
+        refuse_conn(conn, "Invalid secret token.")  # no -- invalid login
         return False
     else:
         conn.send(six.b('y'))  # yes -- valid login
         return True
 
 
-def serve_connection(conn):
+def serve_signal(mesg):
+    """
+    Act on a send_signal message that arrived on a connection of its own.
+    """
+    if mesg['pid'] == 0:
+        log("invalid signal mesg (pid=0)")
+    else:
+        log("Sending a signal")
+        os.kill(mesg['pid'], mesg['signal'])
+
+
+def serve_connection(conn, mesg=None):
+    """
+    Serve the connection conn.  If mesg is given, serve() already checked
+    the secret token and received mesg, the first message of the client.
+    """
     global PID
     PID = os.getpid()
-    # First the client *must* send the secret shared token. If they
-    # don't, we return (and the connection will have been destroyed by
-    # unlock_conn).
-    log("Serving a connection")
-    log("Waiting for client to unlock the connection...")
-    # TODO -- put in a timeout (?)
-    if not unlock_conn(conn):
-        log("Client failed to unlock connection. Dumping them.")
-        return
-    log("Connection unlocked.")
+    if mesg is None:
+        # First the client *must* send the secret shared token. If they
+        # don't, we return (and the connection will have been destroyed by
+        # unlock_conn).
+        log("Serving a connection")
+        log("Waiting for client to unlock the connection...")
+        if not unlock_conn(conn):
+            log("Client failed to unlock connection. Dumping them.")
+            return
+        log("Connection unlocked.")
 
     try:
         conn = ConnectionJSON(conn)
-        typ, mesg = conn.recv()
+        if mesg is None:
+            typ, mesg = conn.recv()
         log("Received message %s" % mesg)
     except Exception as err:
         log("Error receiving message: %s (connection terminated)" % str(err))
         raise
 
     if mesg['event'] == 'send_signal':
-        if mesg['pid'] == 0:
-            log("invalid signal mesg (pid=0)")
-        else:
-            log("Sending a signal")
-            os.kill(mesg['pid'], mesg['signal'])
+        serve_signal(mesg)
         return
     if mesg['event'] != 'start_session':
         log("Received an unknown message event = %s; terminating session." %
@@ -2109,192 +3621,1102 @@ def serve_connection(conn):
         return
 
     log("Starting a session")
-    desc = message.session_description(os.getpid())
+    encodings = mesg.get('encodings')
+    encoding = choose_encoding(encodings)
+    # only tell clients that asked, so old clients see the same reply as before
+    desc = message.session_description(
+        os.getpid(), encoding=encoding if encodings else None)
     log("child sending session description back: %s" % desc)
     conn.send_json(desc)
+    conn.encoding = encoding
     session(conn=conn)
 
 
-def serve(port, host, extra_imports=False):
-    #log.info('opening connection on port %s', port)
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+# Number of already forked and initialized idle children that serve()
+# keeps around, so that a new session does not have to pay for fork()
+# and session setup.  Idle children older than WARM_POOL_MAX_AGE seconds
+# are retired and replaced.  Set WARM_POOL_SIZE to 0 to disable the pool.
+WARM_POOL_SIZE = int(os.environ.get('COCALC_SAGE_SERVER_POOL_SIZE', 1))
+WARM_POOL_MAX_AGE = float(
+    os.environ.get('COCALC_SAGE_SERVER_POOL_MAX_AGE', 3600))
 
-    # check for children that have finished every few seconds, so
-    # we don't end up with zombies.
-    s.settimeout(5)
 
-    s.bind((host, port))
-    log('Sage server %s:%s' % (host, port))
+def _send_fd(sock, fd):
+    sock.sendmsg([six.b('c')], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                                 struct.pack('i', fd))])
 
-    # Enabling the following signal completely breaks subprocess pexpect in many cases, which is
-    # obviously totally unacceptable.
-    #signal.signal(signal.SIGCHLD, handle_session_term)
 
-    def init_library():
-        tm = time.time()
-        log("pre-importing the sage library...")
+def _recv_fd(sock):
+    """
+    Wait for a file descriptor to arrive on the unix socket sock.
+    Returns None if the other end was closed.
+    """
+    size = struct.calcsize('i')
+    mesg, ancdata, flags, addr = sock.recvmsg(1, socket.CMSG_LEN(size))
+    for level, typ, data in ancdata:
+        if level == socket.SOL_SOCKET and typ == socket.SCM_RIGHTS:
+            return struct.unpack('i', data[:size])[0]
+    return None
 
-        # FOR testing purposes.
-        ##log("fake 40 second pause to slow things down for testing....")
-        ##time.sleep(40)
-        ##log("done with pause")
 
-        # Actually import sage now.  This must happen after the interact
-        # import because of library interacts.
-        log("import sage...")
-        import sage.all
-        log("imported sage.")
+class WarmSessionPool(object):
+    """
+    Pool of pre-forked children of the sage server, each waiting on a
+    unix socket for the connection it should serve.
+
+    INPUT:
 
-        # Monkey patching interact using the new and improved Salvus
-        # implementation of interact.
-        sage.all.interact = sage_salvus.interact
+    - ``size`` -- number of idle children to keep around
+    - ``max_age`` -- idle children older than this many seconds are retired
+    - ``listener`` -- the listening socket, which children close
+    """
 
-        # Monkey patch the html command.
+    def __init__(self, size, max_age, listener):
+        self.size = size
+        self.max_age = max_age
+        self._listener = listener
+        self._idle = []  # list of (pid, unix socket, time forked)
+        self._retired = []  # pids of children that still have to be reaped
+
+    def __len__(self):
+        return len(self._idle)
+
+    def pids(self):
+        return [pid for pid, _, _ in self._idle]
+
+    def spawn(self):
+        parent_sock, child_sock = socket.socketpair(socket.AF_UNIX,
+                                                    socket.SOCK_STREAM)
+        pid = fork_child()
+        if pid:
+            child_sock.close()
+            self._idle.append((pid, parent_sock, time.time()))
+            return pid
+        # child
         try:
-            # need the following for sage_server to start with sage-8.0
-            # or `import sage.interacts.library` will fail (not really important below, as we don't do that).
-            import sage.repl.user_globals
-            sage.repl.user_globals.set_globals(globals())
-            log("initialized user_globals")
-        except RuntimeError:
-            # may happen with sage version < 8.0
-            log("user_globals.set_globals failed, continuing", sys.exc_info())
-
-        sage.all.html = sage.misc.html.html = sage_salvus.html
-
-        # CRITICAL: look, we are just going to not do this, and have sage.interacts.library
-        # be broken.  It's **really slow** to do this, and I don't think sage.interacts.library
-        # ever ended up going anywhere!  People use wiki.sagemath.org/interact instead...
-        #import sage.interacts.library
-        #sage.interacts.library.html = sage_salvus.html
-
-        # Set a useful figsize default; the matplotlib one is not notebook friendly.
-        import sage.plot.graphics
-        sage.plot.graphics.Graphics.SHOW_OPTIONS['figsize'] = [8, 4]
-
-        # Monkey patch latex.eval, so that %latex works in worksheets
-        sage.misc.latex.latex.eval = sage_salvus.latex0
-
-        # Plot, integrate, etc., -- so startup time of worksheets is minimal.
-        cmds = [
-            'from sage.all import *', 'from sage.calculus.predefined import x',
-            'import pylab'
-        ]
-        if extra_imports:
-            cmds.extend([
-                'import scipy', 'import sympy',
-                "plot(sin).save('%s/a.png'%os.environ['SMC'], figsize=2)",
-                'integrate(sin(x**2),x)'
-            ])
-        tm0 = time.time()
-        for cmd in cmds:
-            log(cmd)
-            exec(cmd, namespace)
-
-        global pylab
-        pylab = namespace['pylab']  # used for clearing
-
-        log('imported sage library and other components in %s seconds' %
-            (time.time() - tm))
-
-        for k, v in sage_salvus.interact_functions.items():
-            namespace[k] = v
-            # See above -- not doing this, since it is REALLY SLOW to import.
-            # This does mean that some old code that tries to use interact might break (?).
-            #namespace[k] = sagenb.notebook.interact.__dict__[k] = v
-
-        namespace['_salvus_parsing'] = sage_parsing
-
-        for name in [
-                'anaconda', 'asy', 'attach', 'auto', 'capture', 'cell',
-                'clear', 'coffeescript', 'cython', 'default_mode',
-                'delete_last_output', 'dynamic', 'exercise', 'fork', 'fortran',
-                'go', 'help', 'hide', 'hideall', 'input', 'java', 'javascript',
-                'julia', 'jupyter', 'license', 'load', 'md', 'mediawiki',
-                'modes', 'octave', 'pandoc', 'perl', 'plot3d_using_matplotlib',
-                'prun', 'python_future_feature', 'py3print_mode', 'python',
-                'python3', 'r', 'raw_input', 'reset', 'restore', 'ruby',
-                'runfile', 'sage_eval', 'scala', 'scala211', 'script',
-                'search_doc', 'search_src', 'sh', 'show', 'show_identifiers',
-                'singular_kernel', 'time', 'timeit', 'typeset_mode', 'var',
-                'wiki'
-        ]:
-            namespace[name] = getattr(sage_salvus, name)
+            parent_sock.close()
+            for _, sock, _ in self._idle:
+                sock.close()
+            self._listener.close()
+            self._serve_warm(child_sock)
+        finally:
+            logger.flush()
+            os._exit(0)
+
+    def _serve_warm(self, sock):
+        global PID
+        PID = os.getpid()
+        prepare_session()
+        try:
+            fd = _recv_fd(sock)
+            # followed by the first message of the client, if serve() read it
+            data = six.b('')
+            while fd is not None:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+        except Exception as err:
+            log("warm child failed to receive connection -- %s" % err)
+            fd = None
+        sock.close()
+        if fd is None:
+            # retired, or the server went away
+            return
+        conn = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+        os.close(fd)
+        log("warm child process, will now serve this new connection")
+        try:
+            serve_connection(conn,
+                             json.loads(data.decode('utf8')) if data else None)
+        except SystemExit:
+            pass
+
+    def fill(self):
+        while len(self._idle) < self.size:
+            pid = self.spawn()
+            log("forked off warm child with pid %s" % pid)
+
+    def handoff(self, conn, mesg=None):
+        """
+        Pass conn on to an idle child and return its pid, or return None
+        if no idle child is available.  The first message mesg of the
+        client, if it was read already, is passed on along with conn.
+        """
+        while self._idle:
+            pid, sock, _ = self._idle.pop(0)
+            try:
+                _send_fd(sock, conn.fileno())
+                if mesg is not None:
+                    sock.sendall(_json_encoder.encode(mesg).encode('utf8'))
+                return pid
+            except Exception as err:
+                log("unable to hand connection to warm child %s -- %s" %
+                    (pid, err))
+                self._kill(pid)
+                self._retired.append(pid)
+            finally:
+                sock.close()
+        return None
+
+    def _kill(self, pid):
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def discard(self, pid):
+        """
+        Forget about the idle child pid (e.g., because it terminated).
+        """
+        for i, (pid0, sock, _) in enumerate(self._idle):
+            if pid0 == pid:
+                sock.close()
+                del self._idle[i]
+                return True
+        return False
+
+    def retire_old(self):
+        """
+        Retire idle children that are older than max_age.  They exit as
+        soon as their end of the unix socket is closed.
+        """
+        t = time.time()
+        for pid, sock, forked in list(self._idle):
+            if t - forked > self.max_age:
+                log("retiring warm child %s" % pid)
+                self.discard(pid)
+                self._retired.append(pid)
+
+    def next_retirement(self):
+        """
+        Seconds until the next idle child has to be retired, or None.
+        """
+        if not self._idle:
+            return None
+        oldest = min(forked for _, _, forked in self._idle)
+        return max(0, oldest + self.max_age - time.time())
 
-        namespace['sage_server'] = sys.modules[
-            __name__]  # http://stackoverflow.com/questions/1676835/python-how-do-i-get-a-reference-to-a-module-inside-the-module-itself
+    def exited(self, pid):
+        """
+        Forget about the child pid, which terminated and was reaped.
+        Returns whether it was an idle or retired child of the pool.
+        """
+        if pid in self._retired:
+            self._retired.remove(pid)
+            return True
+        if self.discard(pid):
+            log("warm child %s terminated while idle" % pid)
+            return True
+        return False
 
-        # alias pretty_print_default to typeset_mode, since sagenb has/uses that.
-        namespace['pretty_print_default'] = namespace['typeset_mode']
-        # and monkey patch it
-        sage.misc.latex.pretty_print_default = namespace[
-            'pretty_print_default']
+    def close(self):
+        for pid in self.pids():
+            self.discard(pid)
 
-        sage_salvus.default_namespace = dict(namespace)
-        log("setup namespace with extra functions")
 
-        # Sage's pretty_print and view are both ancient and a mess
-        sage.all.pretty_print = sage.misc.latex.pretty_print = namespace[
-            'pretty_print'] = namespace['view'] = namespace['show']
+# At most this many sessions run at the same time; further start_session
+# requests wait in a queue of at most MAX_QUEUED_SESSIONS connections (beyond
+# that they are refused) until a session ends.  0 means no limit.
+MAX_SESSIONS = int(os.environ.get('COCALC_SAGE_SERVER_MAX_SESSIONS', 0))
+MAX_QUEUED_SESSIONS = 64
+# Connections that did not send the secret token and their first message
+# within this many seconds are closed.
+HANDSHAKE_TIMEOUT = 60
+# The resource usage of this many finished sessions is kept for server_status.
+FINISHED_SESSIONS_KEPT = 32
 
-        # this way client code can tell it is running as a Sage Worksheet.
-        namespace['__SAGEWS__'] = True
+# Client connections the server process holds; they are closed in every
+# child it forks, so that a connection is closed as soon as the process
+# serving it exits.
+server_sockets = set()
 
-    log("Initialize sage library.")
-    init_library()
+# The ChildWatcher of serve(), if it is running.
+child_watcher = None
 
-    t = time.time()
-    s.listen(128)
-    i = 0
+# (host, port) sessions connect to for requests to the server process that
+# forked them, such as lease_kernel; set by serve().
+server_address = None
 
-    children = {}
-    log("Starting server listening for connections")
-    try:
+
+def fork_child():
+    """
+    Fork a child of the server process.  Returns the pid of the child in
+    the parent, where it is watched by child_watcher, and 0 in the child,
+    where the server's connections and child watching are closed.
+    """
+    global child_watcher
+    logger.flush()
+    pid = os.fork()
+    if pid:
+        if child_watcher is not None:
+            child_watcher.watch(pid)
+        return pid
+    for sock in server_sockets:
+        sock.close()
+    server_sockets.clear()
+    if child_watcher is not None:
+        child_watcher.forked()
+        child_watcher = None
+    return 0
+
+
+class ChildWatcher(object):
+    """
+    Makes the selector of serve() ready whenever a child process exits,
+    and reaps exited children, including their resource usage.
+
+    Each child gets a pidfd where the platform supports them (Linux 5.3,
+    Python 3.9); otherwise a SIGCHLD handler wakes up the selector through
+    a pipe (see signal.set_wakeup_fd).  The handler is reset in forked
+    children, since a SIGCHLD handler breaks pexpect in sessions.
+    """
+    def __init__(self, selector):
+        import selectors
+        self._selector = selector
+        self._pidfds = {}  # pid --> pidfd
+        self._pipe = None
+        if hasattr(os, 'pidfd_open'):
+            try:
+                os.close(os.pidfd_open(os.getpid()))
+                return
+            except OSError:
+                pass  # the kernel is too old
+        self._pipe = os.pipe()
+        for fd in self._pipe:
+            os.set_blocking(fd, False)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.set_wakeup_fd(self._pipe[1])
+        selector.register(self._pipe[0], selectors.EVENT_READ, self)
+
+    def watch(self, pid):
+        if self._pipe is not None:
+            return
+        import selectors
+        try:
+            fd = os.pidfd_open(pid)
+        except OSError as err:
+            log("unable to watch child %s -- %s" % (pid, err))
+            return
+        self._pidfds[pid] = fd
+        self._selector.register(fd, selectors.EVENT_READ, self)
+
+    def reap(self):
+        """
+        Return a list of (pid, exit status, resource usage) of all children
+        that exited since the last call.
+        """
+        if self._pipe is not None:
+            try:
+                while os.read(self._pipe[0], 4096):
+                    pass
+            except OSError:
+                pass
+        v = []
         while True:
-            i += 1
-            #print i, time.time()-t, 'cps: ', int(i/(time.time()-t))
-            # do not use log.info(...) in the server loop; threads = race conditions that hang server every so often!!
             try:
-                if children:
-                    for pid in list(children.keys()):
-                        if os.waitpid(pid, os.WNOHANG) != (0, 0):
-                            log("subprocess %s terminated, closing connection"
-                                % pid)
-                            conn.close()
-                            del children[pid]
+                pid, status, rusage = os.wait4(-1, os.WNOHANG)
+            except OSError:  # no children
+                break
+            if not pid:
+                break
+            v.append((pid, status, rusage))
+            fd = self._pidfds.pop(pid, None)
+            if fd is not None:
+                self._selector.unregister(fd)
+                os.close(fd)
+        return v
+
+    def _close_fds(self):
+        for fd in self._pidfds.values():
+            os.close(fd)
+        self._pidfds.clear()
+        if self._pipe is not None:
+            for fd in self._pipe:
+                os.close(fd)
+
+    def forked(self):
+        """
+        Undo the watching in a child that was just forked.
+        """
+        if self._pipe is not None:
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        self._close_fds()
+        self._selector.close()
 
-                try:
-                    conn, addr = s.accept()
-                    log("Accepted a connection from", addr)
-                except:
-                    # this will happen periodically since we did s.settimeout above, so
-                    # that we wait for children above periodically.
-                    continue
-            except socket.error:
+    def close(self):
+        if self._pipe is not None:
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            self._selector.unregister(self._pipe[0])
+        for fd in self._pidfds.values():
+            self._selector.unregister(fd)
+        self._close_fds()
+
+
+class Handshake(object):
+    """
+    A new connection, from which serve() reads the secret token and the
+    first message of the client without blocking, before deciding what to
+    do with the connection.  Nothing beyond the first message is read.
+    """
+    def __init__(self, conn, addr):
+        conn.setblocking(False)
+        self.conn = conn
+        self.addr = addr
+        self.started = time.time()
+        self.mesg = None
+        self._token = six.b(secret_token)
+        self._unlocked = False
+        self._data = six.b('')
+
+    def _missing(self):
+        if not self._unlocked:
+            return len(self._token) - len(self._data)
+        if len(self._data) < 4:
+            return 4 - len(self._data)
+        return 4 + struct.unpack('>L', self._data[:4])[0] - len(self._data)
+
+    def read(self):
+        """
+        Read what has arrived and return True once the first message is
+        available as self.mesg.  Raises an exception if the connection has
+        to be dropped.
+        """
+        missing = self._missing()
+        if missing > 65536:
+            raise ValueError("first message too large")
+        try:
+            data = self.conn.recv(missing)
+        except (BlockingIOError, InterruptedError):
+            return False
+        if not data:
+            raise EOFError("connection closed")
+        self._data += data
+        if not self._unlocked:
+            if self._data != self._token[:len(self._data)]:
+                refuse_conn(self.conn, "Invalid secret token.")
+                raise ValueError("invalid secret token")
+            if len(self._data) < len(self._token):
+                return False
+            self._unlocked = True
+            self._data = six.b('')
+            self.conn.send(six.b('y'))  # yes -- valid login
+            return False
+        if len(self._data) < 4 or self._missing():
+            return False
+        if self._data[4:5] != six.b('j'):
+            raise ValueError("the first message must be JSON")
+        mesg = json.loads(self._data[5:].decode('utf8'))
+        if not isinstance(mesg, dict):
+            raise ValueError("the first message must be a JSON object")
+        self.mesg = mesg
+        return True
+
+
+def process_usage(pid):
+    """
+    CPU time (in seconds) and resident memory (in bytes) of the running
+    process pid, read from /proc; None if that is not available.
+    """
+    try:
+        with open('/proc/%s/stat' % pid) as f:
+            # the fields after the command name, starting with field 3
+            fields = f.read().rsplit(')', 1)[1].split()
+        ticks = float(os.sysconf('SC_CLK_TCK'))
+        return {
+            'cpu': (int(fields[11]) + int(fields[12])) / ticks,
+            'rss': int(fields[21]) * resource.getpagesize()
+        }
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+
+class SessionTable(object):
+    """
+    The sessions that serve() runs, the connections that wait for a session
+    because max_sessions are running already, and the resource usage of
+    recently finished sessions.
+    """
+    def __init__(self, max_sessions=0, max_queued=MAX_QUEUED_SESSIONS):
+        from collections import deque
+        self.max_sessions = max_sessions
+        self.max_queued = max_queued
+        self.running = {}  # pid --> {'pid':, 'addr':, 'started':}
+        self.queued = deque()  # (conn, addr, mesg, time queued)
+        self.finished = deque(maxlen=FINISHED_SESSIONS_KEPT)
+        self.count = 0  # sessions started since the server started
+
+    def full(self):
+        return bool(self.max_sessions) and len(
+            self.running) >= self.max_sessions
+
+    def add(self, pid, addr):
+        self.count += 1
+        self.running[pid] = {
+            'pid': pid,
+            'addr': '%s:%s' % tuple(addr[:2]) if addr else None,
+            'started': time.time()
+        }
+
+    def exited(self, pid, status, rusage):
+        """
+        Record that the child pid exited and return whether it was a session.
+        """
+        info = self.running.pop(pid, None)
+        if info is None:
+            return False
+        info['ended'] = time.time()
+        info['status'] = status
+        info['cpu'] = rusage.ru_utime + rusage.ru_stime
+        info['maxrss'] = rusage.ru_maxrss * 1024  # kilobytes on Linux
+        self.finished.append(info)
+        log("session %s ended after %.1f seconds (status %s, cpu %.2f seconds, max rss %.1f MB)"
+            % (pid, info['ended'] - info['started'], status, info['cpu'],
+               info['maxrss'] / 1e6))
+        return True
+
+    def status(self):
+        running = []
+        for info in self.running.values():
+            info = dict(info)
+            info['usage'] = process_usage(info['pid'])
+            running.append(info)
+        return {
+            'max_sessions': self.max_sessions,
+            'sessions': len(self.running),
+            'queued': len(self.queued),
+            'count': self.count,
+            'running': running,
+            'finished': list(self.finished)
+        }
+
+
+# Jupyter kernels that serve() starts before sessions need them, so that the
+# first %r, %octave, jupyter('python3') etc. of a session does not have to
+# wait for a kernel to start.  If JUPYTER_POOL_SIZE is positive, that many
+# spare kernels are kept for every name in JUPYTER_POOL_KERNELS (comma
+# separated) and for every other kernel a session asked for, but at most
+# JUPYTER_POOL_MAX_SPARES in all.  Every kernel takes memory, so this is
+# off by default.
+JUPYTER_POOL_KERNELS = [
+    name.strip()
+    for name in os.environ.get('COCALC_SAGE_SERVER_JUPYTER_POOL', '').split(',')
+    if name.strip()
+]
+JUPYTER_POOL_SIZE = int(
+    os.environ.get('COCALC_SAGE_SERVER_JUPYTER_POOL_SIZE', 0))
+JUPYTER_POOL_MAX_SPARES = int(
+    os.environ.get('COCALC_SAGE_SERVER_JUPYTER_POOL_MAX_SPARES', 4))
+
+
+def _kernel_pid(km):
+    """
+    Pid of the kernel process of the jupyter_client KernelManager km.
+    """
+    # jupyter_client >= 7 has provisioners, older versions a Popen object
+    process = getattr(getattr(km, 'provisioner', None), 'process',
+                      None) or getattr(km, 'kernel', None)
+    return getattr(process, 'pid', None)
+
+
+class JupyterKernelPool(object):
+    """
+    Jupyter kernels that serve() starts in advance and leases to its
+    sessions (see lease_jupyter_kernel).
+
+    Since a kernel keeps the working directory it was started in, and
+    worksheets run in their own directory, spare kernels are kept per
+    kernel name and directory: size of them for each name in kernel_names
+    (in the directory of the server), and for each name and directory a
+    session asked for since.  There are at most max_spares spare kernels
+    in all; those asked for most recently come first, and the others are
+    forgotten.  A leased kernel belongs to its session; it
+    is killed when the session ends, since nobody else could use it in the
+    state the session left it in.  Spare kernels are replaced as soon as
+    they are leased or die.
+    """
+    def __init__(self, size=0, kernel_names=(), max_spares=4):
+        self.size = size
+        self.max_spares = max_spares
+        cwd = os.getcwd()
+        # (kernel name, directory) spares are kept for, most recent last
+        self._kinds = [(name, cwd) for name in kernel_names]
+        self._spares = {}  # (name, directory) --> list of (kernel manager, pid)
+        self._leased = {}  # session pid --> list of (kernel manager, pid)
+        self._killed = set()  # pids of kernels that still have to be reaped
+
+    def __len__(self):
+        return sum(len(v) for v in self._spares.values())
+
+    def status(self):
+        status = {}
+        for (name, cwd), v in self._spares.items():
+            status[name] = status.get(name, 0) + len(v)
+        return status
+
+    def fill(self):
+        if self.size <= 0:
+            return
+        total = 0
+        for kind in reversed(self._kinds[:]):  # most recently asked for first
+            spares = self._spares.setdefault(kind, [])
+            if total >= self.max_spares:
+                self._forget(kind)
                 continue
-            child_pid = os.fork()
-            if child_pid:  # parent
-                log("forked off child with pid %s to handle this connection" %
-                    child_pid)
-                children[child_pid] = conn
+            while len(spares) < min(self.size, self.max_spares - total):
+                kernel = self._start(kind)
+                if kernel is None:
+                    break
+                spares.append(kernel)
+            total += len(spares)
+
+    def _forget(self, kind):
+        # no more spares of this kind
+        self._kinds.remove(kind)
+        for km, pid in self._spares.pop(kind, []):
+            self._kill(km, pid)
+
+    def _start(self, kind):
+        name, cwd = kind
+        try:
+            import jupyter_client
+            km = jupyter_client.KernelManager(kernel_name=name)
+            km.start_kernel(cwd=cwd)
+        except Exception as err:
+            # e.g., there is no such kernel; do not try again
+            log_warning("unable to start a %s kernel in %s -- %s" %
+                        (name, cwd, err))
+            self._forget(kind)
+            return None
+        pid = _kernel_pid(km)
+        if pid is not None and child_watcher is not None:
+            child_watcher.watch(pid)
+        log("started spare %s kernel in %s with pid %s" % (name, cwd, pid))
+        return km, pid
+
+    def lease(self, name, session_pid, cwd=None):
+        """
+        Lease a spare kernel called name, running in the directory cwd (by
+        default that of the server), to the session session_pid and return
+        its connection info, or None if there is none.  Either way, spares
+        of that kernel in that directory are kept from now on.
+        """
+        if self.size <= 0:
+            return None
+        kind = (name, cwd or os.getcwd())
+        if kind in self._kinds:
+            self._kinds.remove(kind)
+        self._kinds.append(kind)
+        spares = self._spares.get(kind)
+        if not spares:
+            return None
+        km, pid = spares.pop(0)
+        self._leased.setdefault(session_pid, []).append((km, pid))
+        log("leased %s kernel %s to session %s" % (name, pid, session_pid))
+        info = km.get_connection_info()
+        if isinstance(info.get('key'), bytes):
+            info['key'] = info['key'].decode('ascii')
+        return info
+
+    def release(self, session_pid):
+        """
+        Kill the kernels leased to the session session_pid, which ended.
+        """
+        for km, pid in self._leased.pop(session_pid, []):
+            self._kill(km, pid)
+
+    def exited(self, pid):
+        """
+        Forget about the kernel pid, which terminated and was reaped.
+        Returns whether it was a kernel of the pool.
+        """
+        if pid in self._killed:
+            self._killed.remove(pid)
+            return True
+        for kernels in list(self._spares.values()) + list(
+                self._leased.values()):
+            for i, (km, pid0) in enumerate(kernels):
+                if pid0 == pid:
+                    log("kernel %s terminated" % pid)
+                    del kernels[i]
+                    self._cleanup(km)
+                    return True
+        return False
+
+    def _kill(self, km, pid):
+        if pid is not None:
+            try:
+                # kernels run in a session of their own, along with
+                # processes they start, like octave for the octave kernel
+                if os.getpgid(pid) == pid:
+                    os.killpg(pid, signal.SIGKILL)
+                else:
+                    os.kill(pid, signal.SIGKILL)
+                self._killed.add(pid)
+            except OSError:
+                pass
+        self._cleanup(km)
+
+    def _cleanup(self, km):
+        # removes the connection file and closes the sockets of km
+        try:
+            if hasattr(km, 'cleanup_resources'):
+                km.cleanup_resources()
             else:
+                km.cleanup()
+        except Exception as err:
+            log("unable to clean up kernel -- %s" % err)
+
+    def close(self):
+        for kernels in list(self._spares.values()) + list(
+                self._leased.values()):
+            for km, pid in kernels:
+                self._kill(km, pid)
+        self._spares.clear()
+        self._leased.clear()
+
+
+# If true, serve() adds all objects of the Sage library to the documentation
+# index used by obj? and obj?? in a separate, niced process, unless that was
+# done for this Sage version already.  Otherwise objects are only added to
+# the index when they are looked up for the first time.  The same process
+# builds the search indexes of search_src and search_doc, which are
+# otherwise built on their first use.
+DOC_INDEX_PREBUILD = bool(
+    os.environ.get('COCALC_SAGE_SERVER_DOC_INDEX_PREBUILD'))
+
+
+def build_doc_index():
+    """
+    Fork off a process that builds the documentation index from the
+    namespace and return its pid.
+    """
+    pid = fork_child()
+    if pid:
+        log("building the documentation index in process %s" % pid)
+        return pid
+    try:
+        os.nice(10)
+        if not sage_index.doc_index.is_built():
+            sage_index.doc_index.build(namespace)
+            log("built the documentation index")
+        # the indexes used by search_src and search_doc
+        roots = {
+            'src': sage_salvus._sage_src_dir(),
+            'doc': sage_salvus._sage_doc_dir()
+        }
+        for kind, root in roots.items():
+            if root is not None and sage_index.search_index(kind,
+                                                            root) is None:
+                sage_index.build_search_index(kind, root)
+                log("built the %s search index" % kind)
+    except Exception as err:
+        log("building the documentation index failed -- %s" % err)
+    finally:
+        logger.flush()
+        os._exit(0)
+
+
+# Modules that init_library(extra_imports=True) binds in the worksheet
+# namespace without importing them; they are imported the first time they
+# are used (see LazyModule).
+LAZY_MODULES = ['scipy', 'sympy']
+
+
+class LazyModule(types.ModuleType):
+    """
+    Placeholder for a module in the worksheet namespace, which imports the
+    module the first time one of its attributes is used and then replaces
+    itself in the namespace by the module.
+    """
+    def __init__(self, name, namespace, as_=None):
+        types.ModuleType.__init__(self, as_ or name)
+        self.__dict__['_lazy'] = (name, namespace, as_ or name)
+
+    def _load(self):
+        name, namespace, as_ = self.__dict__['_lazy']
+        import importlib
+        module = importlib.import_module(name)
+        if namespace.get(as_) is self:
+            namespace[as_] = module
+        return module
+
+    def __getattr__(self, attr):
+        if attr == '_lazy':
+            raise AttributeError(attr)
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        return "<module '%s' (not imported yet)>" % self.__dict__['_lazy'][0]
+
+
+def init_library(extra_imports=False):
+    tm = time.time()
+    log("pre-importing the sage library...")
+
+    # FOR testing purposes.
+    ##log("fake 40 second pause to slow things down for testing....")
+    ##time.sleep(40)
+    ##log("done with pause")
+
+    # Actually import sage now.  This must happen after the interact
+    # import because of library interacts.
+    log("import sage...")
+    import sage.all
+    log("imported sage.")
+
+    # Monkey patching interact using the new and improved Salvus
+    # implementation of interact.
+    sage.all.interact = sage_salvus.interact
+
+    # Monkey patch the html command.
+    try:
+        # need the following for sage_server to start with sage-8.0
+        # or `import sage.interacts.library` will fail (not really important below, as we don't do that).
+        import sage.repl.user_globals
+        sage.repl.user_globals.set_globals(globals())
+        log("initialized user_globals")
+    except RuntimeError:
+        # may happen with sage version < 8.0
+        log("user_globals.set_globals failed, continuing", sys.exc_info())
+
+    sage.all.html = sage.misc.html.html = sage_salvus.html
+
+    # CRITICAL: look, we are just going to not do this, and have sage.interacts.library
+    # be broken.  It's **really slow** to do this, and I don't think sage.interacts.library
+    # ever ended up going anywhere!  People use wiki.sagemath.org/interact instead...
+    #import sage.interacts.library
+    #sage.interacts.library.html = sage_salvus.html
+
+    # Set a useful figsize default; the matplotlib one is not notebook friendly.
+    import sage.plot.graphics
+    sage.plot.graphics.Graphics.SHOW_OPTIONS['figsize'] = [8, 4]
+
+    # Monkey patch latex.eval, so that %latex works in worksheets
+    sage.misc.latex.latex.eval = sage_salvus.latex0
+
+    # Plot, integrate, etc., -- so startup time of worksheets is minimal.
+    cmds = [
+        'from sage.all import *', 'from sage.calculus.predefined import x',
+        'import pylab'
+    ]
+    if extra_imports:
+        cmds.extend([
+            "plot(sin).save('%s/a.png'%os.environ['SMC'], figsize=2)",
+            'integrate(sin(x**2),x)'
+        ])
+    for cmd in cmds:
+        tm0 = time.time()
+        exec(cmd, namespace)
+        log('%s (%.3f seconds)' % (cmd, time.time() - tm0))
+
+    if extra_imports:
+        for name in LAZY_MODULES:
+            if name not in namespace:
+                namespace[name] = LazyModule(name, namespace)
+
+    global pylab
+    pylab = namespace['pylab']  # used for clearing
+
+    log('imported sage library and other components in %s seconds' %
+        (time.time() - tm))
+
+    for k, v in sage_salvus.interact_functions.items():
+        namespace[k] = v
+        # See above -- not doing this, since it is REALLY SLOW to import.
+        # This does mean that some old code that tries to use interact might break (?).
+        #namespace[k] = sagenb.notebook.interact.__dict__[k] = v
+
+    namespace['_salvus_parsing'] = sage_parsing
+
+    for name in [
+            'anaconda', 'asy', 'attach', 'auto', 'capture', 'cell',
+            'cell_stats', 'clear', 'coffeescript', 'cython', 'default_mode',
+            'delete_last_output', 'dynamic', 'exercise', 'fork', 'fortran',
+            'go', 'help', 'hide', 'hideall', 'input', 'java', 'javascript',
+            'julia', 'jupyter', 'license', 'load', 'md', 'mediawiki',
+            'modes', 'octave', 'pandoc', 'parallel', 'parallel_map', 'perl',
+            'plot3d_using_matplotlib', 'prun', 'python_future_feature',
+            'py3print_mode', 'python', 'python3', 'r', 'raw_input', 'reset',
+            'restore', 'ruby', 'runfile', 'sage_eval', 'scala', 'scala211',
+            'script', 'search_doc', 'search_src', 'sh', 'show',
+            'show_identifiers', 'singular_kernel', 'time', 'timeit',
+            'typeset_mode', 'var', 'wiki'
+    ]:
+        namespace[name] = getattr(sage_salvus, name)
+
+    namespace['sage_server'] = sys.modules[
+        __name__]  # http://stackoverflow.com/questions/1676835/python-how-do-i-get-a-reference-to-a-module-inside-the-module-itself
+
+    # alias pretty_print_default to typeset_mode, since sagenb has/uses that.
+    namespace['pretty_print_default'] = namespace['typeset_mode']
+    # and monkey patch it
+    sage.misc.latex.pretty_print_default = namespace[
+        'pretty_print_default']
+
+    sage_salvus.default_namespace = dict(namespace)
+    log("setup namespace with extra functions")
+
+    # Sage's pretty_print and view are both ancient and a mess
+    sage.all.pretty_print = sage.misc.latex.pretty_print = namespace[
+        'pretty_print'] = namespace['view'] = namespace['show']
+
+    # this way client code can tell it is running as a Sage Worksheet.
+    namespace['__SAGEWS__'] = True
+
+    import_profile.stop()
+    if import_profile.times:
+        log("slowest imports:\n%s" % import_profile.report(IMPORT_PROFILE_TOP))
+
+
+def serve(port,
+          host,
+          extra_imports=False,
+          pool_size=None,
+          pool_max_age=None,
+          max_sessions=None):
+    global child_watcher, server_address
+    import selectors
+    #log.info('opening connection on port %s', port)
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    s.bind((host, port))
+    log('Sage server %s:%s' % (host, port))
+    server_address = (host if host not in ('', '0.0.0.0') else '127.0.0.1',
+                      s.getsockname()[1])
+
+    log("Initialize sage library.")
+    init_library(extra_imports)
+
+    # Children are reaped as soon as they exit.  Enabling a SIGCHLD handler in
+    # sessions completely breaks subprocess pexpect in many cases, which is
+    # obviously totally unacceptable -- see ChildWatcher and fork_child.
+    server_pid = os.getpid()
+    selector = selectors.DefaultSelector()
+    child_watcher = ChildWatcher(selector)
+
+    # helper processes that have to be reaped
+    helpers = []
+    if DOC_INDEX_PREBUILD:
+        helpers.append(build_doc_index())
+
+    s.listen(128)
+    s.setblocking(False)
+    selector.register(s, selectors.EVENT_READ, None)
+
+    pool = WarmSessionPool(
+        size=WARM_POOL_SIZE if pool_size is None else pool_size,
+        max_age=WARM_POOL_MAX_AGE if pool_max_age is None else pool_max_age,
+        listener=s)
+    pool.fill()
+
+    sessions = SessionTable(
+        MAX_SESSIONS if max_sessions is None else max_sessions)
+    kernels = JupyterKernelPool(JUPYTER_POOL_SIZE, JUPYTER_POOL_KERNELS,
+                                JUPYTER_POOL_MAX_SPARES)
+    kernels.fill()
+    handshakes = {}  # connection --> Handshake
+
+    def close(conn):
+        server_sockets.discard(conn)
+        conn.close()
+
+    def drop(hs):
+        selector.unregister(hs.conn)
+        del handshakes[hs.conn]
+        close(hs.conn)
+
+    def accept():
+        while True:
+            try:
+                conn, addr = s.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except socket.error as err:
+                # e.g., out of file descriptors -- do not spin on it
+                log_warning("unable to accept connection -- %s" % err)
+                time.sleep(0.1)
+                return
+            log("Accepted a connection from", addr)
+            if load_secret_token() is None:
+                refuse_conn(conn, NO_SECRET_TOKEN % secret_token_path)
+                continue
+            server_sockets.add(conn)
+            hs = handshakes[conn] = Handshake(conn, addr)
+            selector.register(conn, selectors.EVENT_READ, hs)
+
+    def start_session(conn, addr, mesg):
+        server_sockets.discard(conn)
+        conn.setblocking(True)
+        child_pid = pool.handoff(conn, mesg)
+        if child_pid is not None:
+            log("handed connection to warm child with pid %s" % child_pid)
+            pool.fill()
+        else:
+            child_pid = fork_child()
+            if not child_pid:
                 # child
                 global PID
                 PID = os.getpid()
+                s.close()
                 log("child process, will now serve this new connection")
-                serve_connection(conn)
+                serve_connection(conn, mesg)
+                sys.exit(0)
+            log("forked off child with pid %s to handle this connection" %
+                child_pid)
+        # the child has a connection of its own
+        conn.close()
+        sessions.add(child_pid, addr)
+
+    def safely(conn, addr, f, *args):
+        """
+        Call f(*args) to serve the connection conn.  If that fails, log the
+        error and close conn, but keep serving everybody else.
+        """
+        try:
+            f(*args)
+        except Exception as err:
+            if os.getpid() != server_pid:
+                raise  # a session forked off by f
+            log_warning("error serving connection from %s -- %s" %
+                        (addr, err))
+            traceback.print_exc(file=open(LOGFILE, 'a'))
+            close(conn)
+
+    def handle(hs):
+        try:
+            if not hs.read():
+                return
+        except Exception as err:
+            log("dropping connection from %s -- %s" % (hs.addr, err))
+            drop(hs)
+            return
+        selector.unregister(hs.conn)
+        del handshakes[hs.conn]
+        safely(hs.conn, hs.addr, dispatch, hs)
+
+    def dispatch(hs):
+        event = hs.mesg.get('event')
+        if event == 'start_session':
+            if not sessions.full():
+                start_session(hs.conn, hs.addr, hs.mesg)
+            elif len(sessions.queued) < sessions.max_queued:
+                log("%s sessions are running; queueing session for %s" %
+                    (len(sessions.running), hs.addr))
+                sessions.queued.append(
+                    (hs.conn, hs.addr, hs.mesg, time.time()))
+            else:
+                log_warning("too many sessions; refusing session for %s" %
+                            (hs.addr, ))
+                close(hs.conn)
+        elif event == 'send_signal':
+            try:
+                serve_signal(hs.mesg)
+            except Exception as err:
+                log("unable to send signal -- %s" % err)
+            close(hs.conn)
+        elif event == 'server_status':
+            status = sessions.status()
+            status['pid'] = server_pid
+            status['warm'] = len(pool)
+            status['kernels'] = kernels.status()
+            status['handshakes'] = len(handshakes)
+            try:
+                hs.conn.setblocking(True)
+                ConnectionJSON(hs.conn).send_json(
+                    message.server_status(**status))
+            except Exception as err:
+                log("unable to send server status -- %s" % err)
+            close(hs.conn)
+        elif event == 'lease_kernel':
+            pid = hs.mesg.get('pid')
+            name = hs.mesg.get('kernel_name')
+            if pid not in sessions.running:
+                reply = message.kernel_lease(
+                    error="%s is not a session of this server" % pid)
+            else:
+                info = kernels.lease(name, pid, hs.mesg.get('cwd'))
+                reply = message.kernel_lease(
+                    info, error=None if info else "no spare %s kernel" % name)
+            try:
+                hs.conn.setblocking(True)
+                ConnectionJSON(hs.conn).send_json(reply)
+            except Exception as err:
+                log("unable to send kernel lease -- %s" % err)
+            close(hs.conn)
+            # replace the leased kernel, now that the session has it
+            kernels.fill()
+        else:
+            log("Received an unknown message event = %s; closing connection."
+                % event)
+            close(hs.conn)
+
+    log("Starting server listening for connections")
+    try:
+        while True:
+            for pid, status, rusage in child_watcher.reap():
+                if sessions.exited(pid, status, rusage):
+                    kernels.release(pid)
+                    continue
+                if pid in helpers:
+                    helpers.remove(pid)
+                elif kernels.exited(pid):
+                    kernels.fill()
+                elif not pool.exited(pid):
+                    log("reaped unknown child %s" % pid)
+            while sessions.queued and not sessions.full():
+                conn, addr, mesg, queued = sessions.queued.popleft()
+                log("starting session for %s after waiting %.1f seconds" %
+                    (addr, time.time() - queued))
+                safely(conn, addr, start_session, conn, addr, mesg)
+            pool.retire_old()
+            pool.fill()
+
+            t = time.time()
+            for hs in list(handshakes.values()):
+                if t - hs.started > HANDSHAKE_TIMEOUT:
+                    log("dropping connection from %s -- no message after %s seconds"
+                        % (hs.addr, HANDSHAKE_TIMEOUT))
+                    drop(hs)
+            deadlines = [
+                hs.started + HANDSHAKE_TIMEOUT - t
+                for hs in handshakes.values()
+            ]
+            if pool.next_retirement() is not None:
+                deadlines.append(pool.next_retirement())
+            timeout = max(0, min(deadlines)) if deadlines else None
+
+            logger.flush()
+            for key, events in selector.select(timeout):
+                if key.fileobj is s:
+                    accept()
+                elif isinstance(key.data, Handshake):
+                    handle(key.data)
+                # otherwise the child watcher is ready; children are reaped above
 
         # end while
     except Exception as err:
-        log("Error taking connection: ", err)
+        log_warning("Error taking connection: ", err)
         traceback.print_exc(file=open(LOGFILE, 'a'))
         #log.error("error: %s %s", type(err), str(err))
 
     finally:
-        log("closing socket")
-        #s.shutdown(0)
-        s.close()
+        # (sessions forked above leave through here as well)
+        if os.getpid() == server_pid:
+            log("closing socket")
+            #s.shutdown(0)
+            child_watcher.close()
+            child_watcher = None
+            selector.close()
+            pool.close()
+            kernels.close()
+            s.close()
 
 
 def run_server(port, host, pidfile, logfile=None):
@@ -2307,10 +4729,12 @@ def run_server(port, host, pidfile, logfile=None):
         open(pidfile, 'w').write(pid)
     log("run_server: port=%s, host=%s, pidfile='%s', logfile='%s'" %
         (port, host, pidfile, LOGFILE))
+    server_pid = os.getpid()
     try:
         serve(port, host)
     finally:
-        if pidfile:
+        # sessions forked by serve() return through here as well
+        if pidfile and os.getpid() == server_pid:
             os.unlink(pidfile)
 
 
@@ -2329,9 +4753,10 @@ if __name__ == "__main__":
         "-l",
         dest='log_level',
         type=str,
-        default='INFO',
+        default=None,
         help=
-        "log level (default: INFO) useful options include WARNING and DEBUG")
+        "log level (default: $COCALC_SAGE_SERVER_LOG_LEVEL or INFO) useful options include WARNING and DEBUG"
+    )
     parser.add_argument("-d",
                         dest="daemon",
                         default=False,
@@ -2371,6 +4796,65 @@ if __name__ == "__main__":
                         type=str,
                         default='',
                         help="write port to this file")
+    parser.add_argument(
+        "--pool-size",
+        dest="pool_size",
+        type=int,
+        default=None,
+        help="number of pre-forked idle sessions to keep ready (default: %s)"
+        % WARM_POOL_SIZE)
+    parser.add_argument(
+        "--pool-max-age",
+        dest="pool_max_age",
+        type=float,
+        default=None,
+        help="seconds after which an idle pre-forked session is replaced "
+        "(default: %s)" % WARM_POOL_MAX_AGE)
+    parser.add_argument(
+        "--max-sessions",
+        dest="max_sessions",
+        type=int,
+        default=None,
+        help="number of sessions that may run at the same time; further "
+        "sessions wait until one ends (default: %s; 0 = no limit)" %
+        MAX_SESSIONS)
+    parser.add_argument(
+        "--jupyter-pool",
+        dest="jupyter_pool",
+        type=str,
+        default=None,
+        help="comma separated names of Jupyter kernels to start before "
+        "sessions use them (default: '%s')" % ','.join(JUPYTER_POOL_KERNELS))
+    parser.add_argument(
+        "--jupyter-pool-size",
+        dest="jupyter_pool_size",
+        type=int,
+        default=None,
+        help="number of spare Jupyter kernels to keep per kernel name "
+        "(default: %s; 0 = none)" % JUPYTER_POOL_SIZE)
+    parser.add_argument(
+        "--jupyter-pool-max-spares",
+        dest="jupyter_pool_max_spares",
+        type=int,
+        default=None,
+        help="number of spare Jupyter kernels to keep in all "
+        "(default: %s)" % JUPYTER_POOL_MAX_SPARES)
+    parser.add_argument(
+        "--status",
+        dest="status",
+        default=False,
+        action="store_const",
+        const=True,
+        help="print the session counts and resource usage of the running "
+        "server (given by -p or --portfile) and exit")
+    parser.add_argument(
+        "--import-profile",
+        dest="import_profile",
+        default=False,
+        action="store_const",
+        const=True,
+        help="load the Sage library as the server does on startup, print how "
+        "long importing each module took and exit")
 
     args = parser.parse_args()
 
@@ -2379,9 +4863,22 @@ if __name__ == "__main__":
         sys.exit(1)
 
     if args.log_level:
-        pass
-        #level = getattr(logging, args.log_level.upper())
-        #log.setLevel(level)
+        if args.log_level.upper() not in LOG_LEVELS:
+            print(("%s: unknown log level '%s'" % (sys.argv[0], args.log_level)))
+            sys.exit(1)
+        LOG_LEVEL = LOG_LEVELS[args.log_level.upper()]
+
+    if args.import_profile:
+        init_library()
+        print(import_profile.report())
+        sys.exit(0)
+
+    if args.status:
+        status = server_status(
+            port=args.port if args.port else int(open(args.portfile).read()),
+            hostname=args.hostname or 'localhost')
+        print(json.dumps(status, indent=1, sort_keys=True))
+        sys.exit(0)
 
     if args.client:
         client1(
@@ -2405,6 +4902,22 @@ if __name__ == "__main__":
         open(LOGFILE, 'w')  # for now we clear it on restart...
         log("setting logfile to %s" % LOGFILE)
 
+    if args.pool_size is not None:
+        WARM_POOL_SIZE = args.pool_size
+    if args.pool_max_age is not None:
+        WARM_POOL_MAX_AGE = args.pool_max_age
+    if args.max_sessions is not None:
+        MAX_SESSIONS = args.max_sessions
+    if args.jupyter_pool is not None:
+        JUPYTER_POOL_KERNELS = [
+            name.strip() for name in args.jupyter_pool.split(',')
+            if name.strip()
+        ]
+    if args.jupyter_pool_size is not None:
+        JUPYTER_POOL_SIZE = args.jupyter_pool_size
+    if args.jupyter_pool_max_spares is not None:
+        JUPYTER_POOL_MAX_SPARES = args.jupyter_pool_max_spares
+
     main = lambda: run_server(port=args.port, host=args.host, pidfile=pidfile)
     if args.daemon and args.pidfile:
         from . import daemon
@@ -403,11 +403,21 @@ def start_cmd(action='start'):
 ###
 
 
-@pytest.fixture(autouse=True, scope="session")
-def sage_server_setup(pid_file=default_pid_file, log_file=default_log_file):
+@pytest.fixture(autouse=True, scope="module")
+def sage_server_setup(request,
+                      pid_file=default_pid_file,
+                      log_file=default_log_file):
     r"""
     make sure sage_server pid file exists and process running at given pid
+
+    The server is restarted once per test session, before the first test
+    module that needs it; modules that set ``needs_sage_server = False``
+    do not.
     """
+    if sage_server_setup.started or not getattr(request.module,
+                                                'needs_sage_server', True):
+        return
+    sage_server_setup.started = True
     os.system(start_cmd('restart'))
     for loop_count in range(20):
         time.sleep(0.5)
@@ -421,6 +431,9 @@ def sage_server_setup(pid_file=default_pid_file, log_file=default_log_file):
     return
 
 
+sage_server_setup.started = False
+
+
 @pytest.fixture()
 def test_id(request):
     r"""
@@ -0,0 +1,114 @@
+# test the on-disk indexes of sage_index.py; these do not need a sage_server
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sage_index
+
+# see conftest.sage_server_setup
+needs_sage_server = False
+
+
+def test_qualified_name():
+    assert sage_index.qualified_name(
+        os.path.join) == os.path.join.__module__ + '.join'
+    assert sage_index.qualified_name(
+        sage_index.DocIndex.get) == 'sage_index.DocIndex.get'
+    assert sage_index.qualified_name(
+        sage_index.DocIndex().get) == 'sage_index.DocIndex.get'
+    assert sage_index.qualified_name(sage_index.DocIndex()) is None
+    assert sage_index.qualified_name(3) is None
+    builtins = int.__module__
+    assert sage_index.qualified_name(int) == builtins + '.int'
+    assert sage_index.qualified_name([].append) == builtins + '.list.append'
+    # like classes defined in a worksheet, whose namespace has no __name__
+    namespace = {}
+    exec('class Foo(int):\n    pass\nx = Foo(2)', namespace)
+    assert namespace['Foo'].__module__ == builtins
+    assert sage_index.qualified_name(namespace['Foo']) is None
+    assert sage_index.qualified_name(namespace['x'].bit_length) is None
+
+
+def test_doc_index(tmpdir):
+    src = tmpdir.join('mod.py')
+    src.write('x = 1\ndef f(a):\n    return a\n')
+    index = sage_index.DocIndex(path=str(tmpdir.join('index.sqlite')))
+    entry = {
+        'file': str(src),
+        'mtime': os.stat(str(src)).st_mtime,
+        'args': 'a',
+        'doc': 'Return a.',
+        'start': 1,
+        'count': 2
+    }
+    index.put('mod.f', entry)
+    assert index.get('mod.f') == entry
+    assert index.source(entry) == 'def f(a):\n    return a\n'
+    assert index.get('mod.g') is None
+    # entries of files that changed are ignored
+    os.utime(str(src), (0, 0))
+    assert index.get('mod.f') is None
+
+
+def test_trigram_index(tmpdir):
+    root = tmpdir.mkdir('src')
+    root.join('a.py').write('def Foo_bar(): pass\n# foo_bar foo_bar\n')
+    root.mkdir('sub').join('foo_bar.py').write('x = 1\n')
+    root.join('b.txt').write('foo_bar\n')
+    path = str(tmpdir.join('src.idx'))
+    sage_index.TrigramIndex.build(path, str(root), ('.py', ))
+    index = sage_index.TrigramIndex(path)
+    assert index.search('FOO_BAR') == [(3, 'a.py')]
+    assert index.search('x = ') == [(1, os.path.join('sub', 'foo_bar.py'))]
+    assert index.search('py') == []
+    assert index.search('not there') == []
+
+
+def test_trigram_index_in_batches(tmpdir, monkeypatch):
+    root = tmpdir.mkdir('src')
+    for i in range(10):
+        root.join('%s.py' % i).write('def f%s(): return "%s"\n' % (i, i * 7))
+    path = str(tmpdir.join('src.idx'))
+    sage_index.TrigramIndex.build(path, str(root), ('.py', ))
+    monkeypatch.setattr(sage_index, 'BUILD_BATCH_POSTINGS', 5)
+    batched = str(tmpdir.join('batched.idx'))
+    sage_index.TrigramIndex.build(batched, str(root), ('.py', ))
+    assert open(batched, 'rb').read() == open(path, 'rb').read()
+    index = sage_index.TrigramIndex(batched)
+    assert index.search('f3()') == [(1, '3.py')]
+    # only some files are read, those with matching names first
+    root.join('return.py').write('return\n')
+    sage_index.TrigramIndex.build(batched, str(root), ('.py', ))
+    index = sage_index.TrigramIndex(batched)
+    results = index.search('return', max_candidates=2)
+    assert len(results) == 2 and results[0] == (101, 'return.py')
+    assert sorted(os.listdir(str(tmpdir))) == ['batched.idx', 'src', 'src.idx']
+
+
+def test_build_in_background_closes_fds(tmpdir, monkeypatch):
+    r, w = os.pipe()
+    out = str(tmpdir.join('out'))
+
+    def build(kind, root):
+        try:
+            os.fstat(w)
+            result = 'open'
+        except OSError:
+            result = 'closed'
+        with open(out + '.tmp', 'w') as f:
+            f.write(result)
+        os.rename(out + '.tmp', out)
+
+    monkeypatch.setattr(sage_index, 'build_search_index', build)
+    sage_index.build_search_index_in_background('src', str(tmpdir))
+    os.close(w)
+    # the builder does not hold on to the write end of the pipe
+    assert os.read(r, 1) == b''
+    os.close(r)
+    for i in range(100):
+        if os.path.exists(out):
+            break
+        time.sleep(.1)
+    with open(out) as f:
+        assert f.read() == 'closed'
@@ -0,0 +1,81 @@
+# test the completion cache of sage_jupyter.py with a fake kernel client;
+# these do not need a sage_server or jupyter
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sage_jupyter
+
+# see conftest.sage_server_setup
+needs_sage_server = False
+
+NAMES = ['print', 'pow', 'property', 'xyz.append', 'xyz.apply']
+
+
+class FakeShellChannel(object):
+    def __init__(self):
+        self.replies = []
+        self.socket = self
+
+    def poll(self, timeout):
+        return len(self.replies)
+
+    def msg_ready(self):
+        return bool(self.replies)
+
+    def get_msg(self, timeout=None):
+        return self.replies.pop(0)
+
+
+class FakeKernelClient(object):
+    """
+    Answers complete requests for NAMES right away, except for lines in
+    silent, which it never answers.
+    """
+    def __init__(self, silent=()):
+        self.shell_channel = FakeShellChannel()
+        self.requests = []
+        self.silent = silent
+
+    def complete(self, line):
+        self.requests.append(line)
+        msg_id = 'm%s' % len(self.requests)
+        if line not in self.silent:
+            token = re.search(r'[\w.]*$', line).group(0)
+            self.shell_channel.replies.append({
+                'msg_type': 'complete_reply',
+                'parent_header': {
+                    'msg_id': msg_id
+                },
+                'content': {
+                    'status': 'ok',
+                    'cursor_start': len(line) - len(token),
+                    'cursor_end': len(line),
+                    'matches': [n for n in NAMES if n.startswith(token)]
+                }
+            })
+        return msg_id
+
+
+def test_prefix_cache():
+    kc = FakeKernelClient()
+    completer = sage_jupyter.JupyterCompleter(kc)
+    assert completer.complete('a = p') == (['rint', 'ow', 'roperty'], 'p')
+    assert completer.complete('a = pri') == (['nt'], 'pri')
+    assert completer.complete('xyz.ap') == (['pend', 'ply'], 'xyz.ap')
+    assert completer.complete('xyz.appe') == (['nd'], 'xyz.appe')
+    assert kc.requests == ['a = p', 'xyz.ap']
+    # a new name starts, so the kernel is asked again
+    completer.complete('a = p(')
+    assert len(kc.requests) == 3
+    completer.invalidate()
+    completer.complete('a = pri')
+    assert len(kc.requests) == 4
+
+
+def test_timeout_and_superseded():
+    kc = FakeKernelClient(silent=['x'])
+    completer = sage_jupyter.JupyterCompleter(kc)
+    assert completer.complete('x', timeout=0.1) is None
+    assert completer.complete('x', superseded=lambda: True) is None
@@ -0,0 +1,243 @@
+# test_sage_parsing.py
+# differential tests of the cell block splitter in sage_parsing, and tests of
+# the other parsing helpers; these do not need a sage_server
+from __future__ import absolute_import
+import os
+import random
+import string
+import sys
+
+from textwrap import dedent
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sage_parsing
+
+# see conftest.sage_server_setup
+needs_sage_server = False
+
+
+def reference_blocks(code, literals):
+    """
+    The original (quadratic) implementation of the block computation in
+    sage_parsing.divide_into_blocks, which the linear one has to agree with.
+    """
+    # Compute the blocks
+    i = len(code) - 1
+    blocks = []
+    while i >= 0:
+        stop = i
+        paren_depth = code[i].count('(') - code[i].count(')')
+        brack_depth = code[i].count('[') - code[i].count(']')
+        curly_depth = code[i].count('{') - code[i].count('}')
+        while i >= 0 and (
+            (len(code[i]) > 0 and (code[i][0] in string.whitespace))
+                or paren_depth < 0 or brack_depth < 0 or curly_depth < 0):
+            i -= 1
+            if i >= 0:
+                paren_depth += code[i].count('(') - code[i].count(')')
+                brack_depth += code[i].count('[') - code[i].count(']')
+                curly_depth += code[i].count('{') - code[i].count('}')
+        block = ('\n'.join(code[i:])) % literals
+        bs = block.strip()
+        if bs:  # has to not be only whitespace
+            blocks.insert(0, [i, stop, bs])
+        code = code[:i]
+        i = len(code) - 1
+
+    # merge try/except/finally/decorator/else/elif blocks
+    i = 1
+
+    def merge():
+        "Merge block i-1 with block i."
+        blocks[i - 1][-1] += '\n' + blocks[i][-1]
+        blocks[i - 1][1] = blocks[i][1]
+        del blocks[i]
+
+    while i < len(blocks):
+        s = blocks[i][-1].lstrip()
+
+        # finally/except lines after a try
+        if (s.startswith('finally') or s.startswith('except')
+            ) and blocks[i - 1][-1].lstrip().startswith('try'):
+            merge()
+
+        # function definitions
+        elif (s.startswith('def') or s.startswith('@')) and blocks[
+                i - 1][-1].splitlines()[-1].lstrip().startswith('@'):
+            merge()
+
+        # lines starting with else conditions (if *and* for *and* while!)
+        elif s.startswith('else') and (
+                blocks[i - 1][-1].lstrip().startswith('if')
+                or blocks[i - 1][-1].lstrip().startswith('while')
+                or blocks[i - 1][-1].lstrip().startswith('for')
+                or blocks[i - 1][-1].lstrip().startswith('try')
+                or blocks[i - 1][-1].lstrip().startswith('elif')):
+            merge()
+
+        # lines starting with elif
+        elif s.startswith('elif') and blocks[i -
+                                             1][-1].lstrip().startswith('if'):
+            merge()
+
+        # do not merge blocks -- move on to next one
+        else:
+            i += 1
+
+    return blocks
+
+
+def check(code):
+    lines, literals = sage_parsing._code_lines(code)
+    expected = reference_blocks(list(lines), literals)
+    assert sage_parsing._split_blocks(lines, literals) == expected
+
+
+CELLS = [
+    "",
+    "2+2",
+    "x = 1\ny = 2\nx + y",
+    "pi.n().round()\n[x for x in [1,2,3] if x<3]\nfor z in ['a','b']:\n    z\nelse:\n    z",
+    dedent("""
+    def d2(f): return lambda x: f(x)+'-'+f(x)
+    @d2
+    def s(str): return str.upper()
+    s('spam')"""),
+    dedent("""
+    @dummy
+    @dummy
+    def f(x): return 2*x+1
+    f(2)"""),
+    dedent("""
+    try:
+        1/0
+    except ZeroDivisionError:
+        pass
+    finally:
+        print('done')"""),
+    dedent("""
+    if x:
+        a
+    elif y:
+        b
+    else:
+        c
+    while False:
+        pass
+    else:
+        d"""),
+    dedent('''
+    v = [1,
+         2,  # a comment
+         3]
+    s = """
+    a multi line string
+    # that is no comment
+    """
+    w = {'a': (1,
+               2)}'''),
+    "R.<x> = QQ[]\nf = x^2 + 1\n[1..10]\nf.factor?",
+    "%time\nfactor(2^97 - 1)",
+    "x = 5\n%md # title\n!ls -l\ny = ')'",
+    "    indented = 1\n    also = 2",
+    ")\nunbalanced = [\n(",
+    "print('%s' % 5)  # 100%",
+]
+
+
+@pytest.mark.parametrize("code", CELLS)
+def test_divide_into_blocks_cells(code):
+    check(code)
+
+
+def test_divide_into_blocks_random():
+    rnd = random.Random(0)
+    pieces = [
+        'x = 1', '    y', 'try:', 'except:', 'finally:', 'if a:', 'elif b:',
+        'else:', 'for i in v:', 'while 1:', '@dec', 'def f():', '(', ')', '[',
+        ']', '{', '}', '"""', "'", '# comment', '', '  ', '%time', 'f(x,',
+        '  x)', 'pass', '\t tab'
+    ]
+    for _ in range(2000):
+        code = '\n'.join(
+            rnd.choice(pieces) for _ in range(rnd.randint(0, 12)))
+        check(code)
+
+
+def test_divide_into_blocks_without_start():
+    # no line can start a block, so every line is a block by itself; this
+    # must not scan all lines before each one
+    for line in ['  x', ')', '  ]', '}']:
+        blocks = sage_parsing._split_blocks([line] * 20000, {})
+        assert len(blocks) == 20000
+        assert blocks[0] == [-1, 0, line.strip()]
+
+
+@pytest.mark.parametrize("code", CELLS)
+def test_scan(code):
+    s = sage_parsing.scan(code)
+    assert s.code % s.literals == code
+    assert [code[a:b] for a, b in s.comments
+            ] == [v for v in s.literals.values() if v.startswith('#')]
+    assert sage_parsing.scan(code) is s
+    assert sage_parsing.strip_string_literals(code) == (s.code, s.literals,
+                                                        s.state)
+
+
+def test_complete_prefix():
+    names = sorted(['a', 'ab', 'abc', 'b', 'ba', '_a'])
+    assert sage_parsing.complete_prefix(names, 'ab') == ['ab', 'abc']
+    assert sage_parsing.complete_prefix(names, 'c') == []
+    assert sage_parsing.complete_prefix(names, '') == names
+
+
+def test_completion_cache():
+    cache = sage_parsing.CompletionCache()
+    x, y = [1], [2]
+    namespace = {'x': x}
+    key = ('', 'x.append', False)
+    cache.set_object(key, namespace, x.append, 'x.append')
+    assert cache.get_object(key, namespace) == (x.append, 'x.append')
+    # rebinding the variable the expression starts with invalidates it
+    namespace['x'] = y
+    assert cache.get_object(key, namespace) is None
+    names = cache.names(x)
+    assert names == sorted(set(dir(x))) and cache.names(x) is names
+    cache.invalidate()
+    assert cache.names(x) is not names
+
+
+def test_completion_cache_global_names():
+    class Namespace(dict):
+        # like sage_server.Namespace, which counts added and deleted names
+        changes = 0
+
+    cache = sage_parsing.CompletionCache()
+    namespace = Namespace(x=1)
+    assert 'x' in cache.global_names(namespace)
+    # replacing a name keeps the size of the namespace
+    del namespace['x']
+    namespace['y'] = 2
+    namespace.changes += 2
+    names = cache.global_names(namespace)
+    assert 'y' in names and 'x' not in names
+    assert cache.global_names(namespace) is names
+
+
+def test_introspect_without_evaluating():
+    class Touchy(object):
+        def __getattr__(self, name):
+            raise AssertionError("touched")
+
+    namespace = {'touchy': Touchy(), 'os': os}
+    z = sage_parsing.introspect('tou',
+                                namespace,
+                                preparse=False,
+                                evaluate=False)
+    assert z['result'] == ['chy'] and z['target'] == 'tou'
+    # anything that needs an object is left for later
+    for line in ['touchy.x', 'touchy?', 'touchy??', 'os.pa', 'len(']:
+        assert sage_parsing.introspect(
+            line, namespace, preparse=False, evaluate=False) is None
@@ -0,0 +1,91 @@
+# test parts of sage_server.py that run in the server process itself, like
+# the pool of Jupyter kernels; these do not need a running sage_server
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('jupyter_client')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sage_server
+
+# see conftest.sage_server_setup
+needs_sage_server = False
+
+
+@pytest.fixture
+def kernel_pool(tmpdir, monkeypatch):
+    monkeypatch.setattr(sage_server, 'LOGFILE',
+                        str(tmpdir.join('sage_server.log')))
+    pool = sage_server.JupyterKernelPool(1, ['python3'])
+    yield pool
+    pool.close()
+    sage_server.logger.flush()
+
+
+def spare(pool, cwd):
+    (km, pid), = pool._spares[('python3', cwd)]
+    return pid
+
+
+def reaped(pool, pid):
+    # serve() reaps the kernels and tells the pool
+    os.waitpid(pid, 0)
+    return pool.exited(pid)
+
+
+class TestJupyterKernelPool:
+    def test_lease_and_release(self, kernel_pool, tmpdir):
+        cwd = os.getcwd()
+        kernel_pool.fill()
+        assert kernel_pool.status() == {'python3': 1}
+        pid = spare(kernel_pool, cwd)
+        info = kernel_pool.lease('python3', 4242, cwd)
+        assert info['shell_port']
+        assert kernel_pool.status() == {'python3': 0}
+        kernel_pool.fill()
+        assert spare(kernel_pool, cwd) != pid
+        # the leased kernel is killed when its session ends
+        kernel_pool.release(4242)
+        assert reaped(kernel_pool, pid)
+        assert not kernel_pool.exited(pid)
+        kernel_pool.close()
+        sage_server.logger.flush()
+        log = tmpdir.join('sage_server.log').read()
+        assert 'leased python3 kernel %s to session 4242' % pid in log
+
+    def test_working_directory(self, kernel_pool, tmpdir):
+        cwd = str(tmpdir)
+        # there is no spare in this directory yet, but from now on
+        assert kernel_pool.lease('python3', 4242, cwd) is None
+        kernel_pool.fill()
+        pid = spare(kernel_pool, cwd)
+        assert os.readlink('/proc/%s/cwd' % pid) == os.path.realpath(cwd)
+        assert kernel_pool.lease('python3', 4242, cwd) is not None
+        kernel_pool.release(4242)
+        assert reaped(kernel_pool, pid)
+
+    def test_spare_died(self, kernel_pool):
+        kernel_pool.fill()
+        pid = spare(kernel_pool, os.getcwd())
+        os.kill(pid, 9)
+        assert reaped(kernel_pool, pid)
+        assert kernel_pool.status() == {'python3': 0}
+        kernel_pool.fill()
+        assert kernel_pool.status() == {'python3': 1}
+
+    def test_no_such_kernel(self, kernel_pool):
+        assert kernel_pool.lease('no-such-kernel', 4242) is None
+        kernel_pool.fill()
+        assert 'no-such-kernel' not in kernel_pool.status()
+
+    def test_max_spares(self, kernel_pool, tmpdir):
+        kernel_pool.max_spares = 1
+        kernel_pool.fill()
+        pid = spare(kernel_pool, os.getcwd())
+        # the directory asked for most recently takes the only spare
+        assert kernel_pool.lease('python3', 4242, str(tmpdir)) is None
+        kernel_pool.fill()
+        assert reaped(kernel_pool, pid)
+        assert kernel_pool.status() == {'python3': 1}
+        spare(kernel_pool, str(tmpdir))
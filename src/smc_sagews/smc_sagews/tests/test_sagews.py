@@ -4,6 +4,7 @@ from __future__ import absolute_import
 import conftest
 import os
 import re
+import socket
 
 from textwrap import dedent
 
@@ -477,3 +478,211 @@ class TestIdentifiers:
         sage=1
         show_identifiers()""")
         exec2(code, "['sage']\n")
+
+
+class TestCompiledCellCache:
+    def test_rerun_cell(self, exec2):
+        code = dedent(r"""
+        def compiled_cell_test():
+            d, v = dict(globals()), []
+            h = sage_server.compiled_cells.hits
+            for p in [True, False, True]:
+                salvus.execute('w_compiled = 2^3', namespace=d, preparse=p)
+                v.append(d['w_compiled'])
+            return v, sage_server.compiled_cells.hits - h
+        compiled_cell_test()""")
+        exec2(code, "([8, 1, 8], 2)\n")
+
+    def test_implicit_multiplication(self, exec2):
+        code = dedent(r"""
+        def compiled_cell_test():
+            b, v = sage_server.compiled_cells.blocks('w_compiled = 2w')[0], []
+            for level in [False, True, False]:
+                implicit_multiplication(level)
+                v.append('*' in b.source(True))
+            return v
+        compiled_cell_test()""")
+        exec2(code, "[False, True, False]\n")
+
+
+class TestOutputChannel:
+    def test_coalesced_stdout(self, execbuf):
+        code = dedent(r"""
+        for i in range(3000):
+            print(i)
+        print('end')""")
+        execbuf(code, output=''.join('%s\n' % i for i in range(3000)) + 'end')
+
+    def test_large_write(self, execbuf):
+        # more than MAX_STDOUT_SIZE is split into several messages
+        execbuf("print('x' * 100000)", output='x' * 100000)
+
+
+class TestCellProfile:
+    def test_profile(self, execbuf):
+        code = dedent(r"""
+        p = salvus.profile('print(1)')
+        p.totals()['messages'], p.wall is not None""")
+        execbuf(code, output="1\n(1, True)")
+
+    def test_last_profile(self, exec2):
+        exec2("w_p1 = 1\nw_p2 = 2\nw_p3 = 3")
+        exec2("p = salvus.last_profile(); len(p.blocks), p.blocks[-1]['lines']",
+              "(3, [3, 3])")
+
+
+class TestStartup:
+    def test_import_profile(self, exec2):
+        code = dedent("""
+        p = sage_server.ImportProfiler()
+        p.start()
+        import wave
+        p.stop()
+        print('wave' in p.times, 'sage.all' in p.times)""")
+        exec2(code, "True False")
+
+    def test_lazy_module(self, exec2):
+        code = dedent("""
+        lazy_wave = sage_server.LazyModule('wave', globals(), 'lazy_wave')
+        print(lazy_wave.Error.__name__, type(lazy_wave) is type(sage_server))
+        """)
+        exec2(code, "Error True")
+
+
+class TestBusySession:
+    def test_introspect_and_interrupt(self, sagews, test_id):
+        import signal
+        m = conftest.message.execute_code(id=test_id, code='sleep(60)')
+        sagews.send_json(m)
+        # answered while the cell is still running
+        sagews.send_json(
+            conftest.message.introspect('introspect', line='fac', top='fac'))
+        typ, mesg = sagews.recv()
+        assert mesg['event'] == 'introspect_completions'
+        assert mesg['id'] == 'introspect'
+        assert 'tor' in mesg['completions']
+        # interrupt the cell over the session's own connection
+        sagews.send_json(conftest.message.send_signal(0, signal.SIGINT))
+        while True:
+            typ, mesg = sagews.recv()
+            assert mesg['id'] == test_id
+            if mesg.get('done'):
+                break
+
+
+def server_connection():
+    host, port = conftest.get_sage_server_info()
+    sock = socket.create_connection((host, port))
+    conftest.client_unlock_connection(sock)
+    conn = conftest.ConnectionJSON(sock)
+    assert conn._recv(1) == b'y'
+    return conn
+
+
+class TestServerStatus:
+    def test_server_status(self, sagews):
+        conn = server_connection()
+        conn.send_json({'event': 'server_status'})
+        typ, mesg = conn.recv()
+        assert mesg['event'] == 'server_status'
+        assert mesg['sessions'] >= 1
+        assert all(s['pid'] for s in mesg['running'])
+        assert 'kernels' in mesg
+
+    def test_bad_first_message(self, sagews):
+        # the server drops the connection, but keeps serving
+        conn = server_connection()
+        conn.send_json(['server_status'])
+        assert conn._recv(1) == b''
+        conn = server_connection()
+        conn.send_json({'event': 'server_status'})
+        typ, mesg = conn.recv()
+        assert mesg['event'] == 'server_status'
+
+
+def exec_after_file(sagews, test_id, code, output):
+    """
+    Run code right after salvus.file(), and acknowledge the blob only once
+    output appeared, i.e., while the file output is still queued.
+    """
+    code = dedent("""
+    import random
+    with open('w_fork.txt', 'w') as f:
+        f.write(str(random.random()))
+    salvus.file('w_fork.txt')
+    """) + code
+    m = conftest.message.execute_code(code=code, id=test_id)
+    m['preparse'] = True
+    sagews.send_json(m)
+    typ, mesg = sagews.recv()
+    assert typ == 'blob'
+    file_uuid = mesg[:36].decode()
+    outbuf = ''
+    while output not in outbuf:
+        typ, mesg = sagews.recv()
+        assert typ == 'json'
+        assert 'stdout' in mesg
+        outbuf += mesg['stdout']
+    sagews.send_json(conftest.message.save_blob(sha1=file_uuid))
+    conftest.recv_til_done(sagews, test_id)
+
+
+class TestFork:
+    def test_fork_output(self, execbuf):
+        execbuf("%fork\nprint('in fork')\nforked_x = 7", output='in fork')
+
+    def test_fork_result(self, exec2):
+        exec2("forked_x", "7")
+
+    def test_fork_after_file(self, sagews, test_id):
+        exec_after_file(
+            sagews, test_id,
+            "sage_salvus.async_(print, ('in fork',), {}, lambda r: None)",
+            'in fork')
+
+
+class TestParallel:
+    def test_parallel_map(self, exec2):
+        exec2("print(parallel_map(lambda n: n^2, range(10), ncpus=2))",
+              "[0, 1, 4, 9, 16, 25, 36, 49, 64, 81]")
+
+    def test_parallel_cell(self, execbuf):
+        execbuf("%parallel\nfor n in range(3):\n    print('item', n + 10)",
+                pattern=r"(item 1[012]\n){3}")
+
+    def test_parallel_map_after_file(self, sagews, test_id):
+        exec_after_file(
+            sagews, test_id,
+            "parallel_map(lambda n: print('item', n + 20), [0], ncpus=1)",
+            'item 20')
+
+    def test_parallel_map_same_file(self, sagews, test_id):
+        # both workers send the same blob, and each waits for its reply
+        code = dedent("""
+        import random
+        with open('w_same.txt', 'w') as f:
+            f.write(str(random.random()))
+        def show(n):
+            salvus.file('w_same.txt', show=False)
+            print('shown', n)
+        parallel_map(show, range(2), ncpus=2)
+        print('all shown')
+        """)
+        m = conftest.message.execute_code(code=code, id=test_id)
+        m['preparse'] = True
+        sagews.send_json(m)
+        blobs = 0
+        outbuf = ''
+        while True:
+            typ, mesg = sagews.recv()
+            if typ == 'blob':
+                blobs += 1
+                sagews.send_json(
+                    conftest.message.save_blob(sha1=mesg[:36].decode()))
+                continue
+            assert typ == 'json'
+            outbuf += mesg.get('stdout', '')
+            if mesg.get('done'):
+                break
+        assert blobs == 2
+        assert 'all shown' in outbuf
@@ -231,6 +231,31 @@ class TestShDefaultMode:
         execintrospect('echo $TESTV', ["AR29"], '$TESTV')
 
 
+class TestShBashSession:
+    def test_use_bash_session(self, exec2):
+        exec2("%sage\nsh.use_jupyter = False")
+
+    def test_remember_settings_01(self, exec2):
+        exec2("%sh\ncd /tmp\nFOO=bash123")
+
+    def test_remember_settings_02(self, exec2):
+        exec2("%sh echo $FOO; pwd", "bash123\n/tmp\n")
+
+    def test_stderr(self, exec2):
+        exec2("%sh echo oops >&2; false", errout="oops")
+
+    def test_status(self, exec2):
+        exec2("%sage\nsh.bash_session.status", "1")
+
+    def test_script_stderr(self, exec2):
+        exec2("%script('sh')\necho out; echo err >&2",
+              "out\n",
+              errout="err")
+
+    def test_use_jupyter(self, exec2):
+        exec2("%sage\nsh.use_jupyter = True")
+
+
 class TestRMode:
     def test_r_assignment(self, exec2):
         exec2("%r\nxx <- c(4,7,13)\nmean(xx)", html_pattern="^8$")